@@ -0,0 +1,202 @@
+"""
+Admission control for the write paths.
+
+Two independent checks run before a guarded handler touches the database:
+
+* RateLimiter — a token bucket per (route, client IP). The buckets live
+  in process memory; with RATE_LIMIT_REDIS_URL set they are shared by all
+  workers through Redis (one Lua call per request; Redis being down fails
+  open to the local buckets). An empty bucket answers 429 with
+  Retry-After = seconds until the next token.
+* Gate — a concurrency cap with a short bounded queue per route. Requests
+  beyond the queue, or waiting longer than the queue timeout, get 503
+  with Retry-After instead of piling up on the SQLite write lock, so
+  admitted bookings keep their normal latency during a spike.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Dict, Optional, Tuple
+
+from .metrics import admission_rejected
+
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+SHED_RETRY_AFTER = 1  # секунд для 503
+# при недоступном Redis ошибка — на каждый запрос; в лог не чаще раза за интервал
+REDIS_WARN_INTERVAL = 60  # секунд
+
+log = logging.getLogger("carwash.admission")
+
+
+class Limit:
+    """`burst` requests at once, refilled at `per_minute` requests per minute."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60
+        self.burst = burst
+
+
+# маршрут -> лимит на один IP
+RATE_LIMITS: Dict[str, Limit] = {
+    "book": Limit(per_minute=float(os.getenv("RATE_LIMIT_BOOK", "10")), burst=5),
+    "login": Limit(per_minute=float(os.getenv("RATE_LIMIT_LOGIN", "5")), burst=5),
+    "cancel": Limit(per_minute=float(os.getenv("RATE_LIMIT_CANCEL", "20")), burst=10),
+    # каждый клик по слоту — удержание
+    "hold": Limit(per_minute=float(os.getenv("RATE_LIMIT_HOLD", "30")), burst=10),
+}
+
+# маршрут -> (одновременно, ждут в очереди, секунд ожидания)
+GATES: Dict[str, Tuple[int, int, float]] = {
+    "book": (int(os.getenv("BOOK_CONCURRENCY", "8")), int(os.getenv("BOOK_QUEUE", "32")), 2.0),
+    "login": (2, 8, 1.0),
+    "cancel": (8, 32, 2.0),
+    "hold": (8, 32, 2.0),
+}
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, retry_after: int):
+        super().__init__(status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class MemoryBuckets:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        """Take one token; returns 0 if allowed, else seconds until a token is available."""
+        tokens, stamp = self._buckets.pop(key, (limit.burst, now))
+        tokens = min(limit.burst, tokens + (now - stamp) * limit.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / limit.rate
+        self._buckets[key] = (tokens, now)
+        # самые давно не обращавшиеся IP вытесняются — их ведро и так уже полное
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+_TAKE_SCRIPT = """
+local burst = tonumber(ARGV[2])
+local rate = tonumber(ARGV[1])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens = tonumber(state[1]) or burst
+local stamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Token buckets shared by all workers; needs the optional `redis` package."""
+
+    def __init__(self, url: str, prefix: str = "carwash:rl:"):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(_TAKE_SCRIPT)
+        self.prefix = prefix
+
+    async def take(self, key: str, limit: Limit, now: float) -> float:
+        return float(await self.script(keys=[self.prefix + key], args=[limit.rate, limit.burst, now]))
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Limit] = RATE_LIMITS, redis_url: str = RATE_LIMIT_REDIS_URL):
+        self.limits = limits
+        self.local = MemoryBuckets()
+        self.shared = RedisBuckets(redis_url) if redis_url else None
+        self._warned_at = float("-inf")
+        self._redis_errors = 0
+
+    async def check(self, route: str, client: str, now: Optional[float] = None):
+        limit = self.limits.get(route)
+        if limit is None:
+            return
+        now = time.time() if now is None else now
+        key = f"{route}:{client}"
+        wait = None
+        if self.shared is not None:
+            try:
+                wait = await self.shared.take(key, limit, now)
+            except Exception as e:
+                self._redis_errors += 1
+                if now - self._warned_at >= REDIS_WARN_INTERVAL:
+                    log.warning("Redis недоступен, считаем локально (ошибок: %d): %s", self._redis_errors, e)
+                    self._warned_at, self._redis_errors = now, 0
+        if wait is None:
+            wait = await self.local.take(key, limit, now)
+        if wait > 0:
+            admission_rejected.inc(route=route, reason="rate")
+            raise Rejected(429, max(1, math.ceil(wait)))
+
+
+class Gate:
+    """At most `limit` requests inside, `queue` more waiting up to `timeout` seconds; the rest get 503."""
+
+    def __init__(self, route: str, limit: int, queue: int, timeout: float):
+        self.route = route
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.active = 0
+        # futures ждущих; слот передаётся первому из них при выходе
+        self._waiters: deque = deque()
+
+    def _shed(self, reason: str):
+        admission_rejected.inc(route=self.route, reason=reason)
+        raise Rejected(503, SHED_RETRY_AFTER)
+
+    async def enter(self):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        if len(self._waiters) >= self.queue:
+            self._shed("queue_full")
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            self._give_up(waiter)
+            self._shed("queue_timeout")
+        except asyncio.CancelledError:
+            # клиент ушёл, пока ждал в очереди
+            self._give_up(waiter)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def _give_up(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # слот передали в последний момент — отдаём его следующему
+            self.leave()
+        else:
+            waiter.cancel()
+
+    def leave(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # слот переходит к ждущему, active не меняется
+                return
+        self.active -= 1
+
+
+def make_gates(gates: Dict[str, Tuple[int, int, float]] = GATES) -> Dict[str, Gate]:
+    return {route: Gate(route, *config) for route, config in gates.items()}
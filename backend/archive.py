@@ -0,0 +1,150 @@
+"""
+Hot/cold retention for bookings.
+
+ArchiveWorker moves bookings that ended more than ARCHIVE_AFTER_DAYS ago,
+and canceled ones, from `bookings` to `bookings_archive` in small batches
+(one short write transaction each), drops their slot_reservations rows
+and hands the freed pages back with `PRAGMA incremental_vacuum`. The hot
+table then holds roughly the live schedule, whatever the history length.
+
+Run manually:  python -m backend.archive [--vacuum]
+"""
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import DateTime, delete, insert, literal, or_, select
+
+from .models import ArchivedBooking, Booking, SlotReservation
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_VACUUM_PAGES = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000"))
+# пауза между пачками: book() успевает получить блокировку записи SQLite
+ARCHIVE_BATCH_PAUSE = 0.05
+
+ARCHIVE_COLUMNS = [c.name for c in Booking.__table__.columns]
+
+log = logging.getLogger("carwash.archive")
+
+
+def archivable(cutoff: datetime):
+    return or_(Booking.end_time < cutoff, Booking.status == "canceled")
+
+
+async def archive_batch(db, cutoff: datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move one batch into bookings_archive; returns how many bookings were moved."""
+    ids = (await db.execute(
+        select(Booking.id).where(archivable(cutoff)).order_by(Booking.id).limit(batch_size)
+    )).scalars().all()
+    if not ids:
+        return 0
+    hot = Booking.__table__
+    await db.execute(
+        insert(ArchivedBooking.__table__).from_select(
+            ARCHIVE_COLUMNS + ["archived_at"],
+            select(*[hot.c[name] for name in ARCHIVE_COLUMNS], literal(datetime.now(), DateTime))
+            .where(hot.c.id.in_(ids))
+        )
+    )
+    await db.execute(delete(SlotReservation.__table__).where(SlotReservation.booking_id.in_(ids)))
+    await db.execute(delete(hot).where(hot.c.id.in_(ids)))
+    await db.commit()
+    return len(ids)
+
+
+async def incremental_vacuum(engine, pages: int = ARCHIVE_VACUUM_PAGES) -> int:
+    """Return up to `pages` free pages to the OS; 0 unless SQLite runs with auto_vacuum=INCREMENTAL."""
+    if engine.dialect.name != "sqlite":
+        return 0
+    async with engine.connect() as conn:
+        if (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar() != 2:
+            return 0
+        before = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        # через execute() sqlite3 делает один шаг = одна страница;
+        # executescript() выполняет прагму до конца
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        await conn.commit()
+    return before - after
+
+
+class ArchiveWorker:
+    def __init__(self, session_factory, engine, after_days: int = ARCHIVE_AFTER_DAYS,
+                 batch_size: int = ARCHIVE_BATCH_SIZE, interval: float = ARCHIVE_INTERVAL):
+        self.session_factory = session_factory
+        self.engine = engine
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self._task = None
+
+    async def run_once(self) -> int:
+        """Archive everything due, batch by batch, then vacuum; returns the number moved."""
+        cutoff = datetime.now() - timedelta(days=self.after_days)
+        moved = 0
+        while True:
+            async with self.session_factory() as db:
+                count = await archive_batch(db, cutoff, self.batch_size)
+            moved += count
+            if count < self.batch_size:
+                break
+            await asyncio.sleep(ARCHIVE_BATCH_PAUSE)
+        if moved:
+            await incremental_vacuum(self.engine)
+        return moved
+
+    async def _run(self):
+        while True:
+            try:
+                moved = await self.run_once()
+                if moved:
+                    log.info("перенесено в архив %d броней", moved)
+            except Exception as e:
+                # другой воркер мог перенести ту же пачку — повторим в следующий раз
+                log.warning("ошибка архивации: %s", e)
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def vacuum_full(engine):
+    """Разовый VACUUM: переводит существующую базу SQLite в auto_vacuum=INCREMENTAL."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+
+def main():
+    from .database import AsyncSessionLocal, async_engine, engine
+    from .migrations import init_db
+
+    parser = argparse.ArgumentParser(description="Move past and canceled bookings to bookings_archive")
+    parser.add_argument("--vacuum", action="store_true", help="full VACUUM first (enables incremental vacuum)")
+    parser.add_argument("--after-days", type=int, default=ARCHIVE_AFTER_DAYS)
+    args = parser.parse_args()
+
+    init_db(engine)
+    if args.vacuum and engine.dialect.name == "sqlite":
+        vacuum_full(engine)
+    worker = ArchiveWorker(AsyncSessionLocal, async_engine, after_days=args.after_days)
+    print(f"archived: {asyncio.run(worker.run_once())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+In-memory pages and static assets.
+
+Everything under frontend/ that the app serves verbatim is read once,
+hashed and compressed (gzip, and brotli if the module is installed) at
+startup. Static files are addressed by content-hashed URLs such as
+/static/booking.3f2a1c9d0b.js, which never change content and can be
+cached as immutable; pages reference them through those URLs.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from .cache import etag_matches
+
+try:
+    import brotli
+except ImportError:  # опционально: без brotli отдаём только gzip
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+_HASHED_NAME = re.compile(r"^(?P<stem>.+)\.(?P<hash>[0-9a-f]{10})(?P<ext>\.[^.]+)$")
+
+
+class Asset:
+    def __init__(self, path: str, body: bytes, media_type: str):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.media_type = media_type
+        self.body = body
+        self.hash = hashlib.sha256(body).hexdigest()[:10]
+        self.etag = f'"{self.hash}"'
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.variants: Dict[str, bytes] = {}
+        packed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(packed) < len(body):
+            self.variants["gzip"] = packed
+        if brotli is not None:
+            packed = brotli.compress(body, quality=11)
+            if len(packed) < len(body):
+                self.variants["br"] = packed
+
+
+def _accepted_encodings(header: Optional[str]):
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def _not_modified(request: Request, asset: Asset) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag_matches(if_none_match, asset.etag)
+    since = request.headers.get("if-modified-since")
+    if since:
+        try:
+            return int(asset.mtime) <= parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class AssetStore:
+    def __init__(self, frontend_dir: str, pages, reload: bool = False):
+        self.frontend_dir = frontend_dir
+        self.static_dir = os.path.join(frontend_dir, "static")
+        self.page_names = list(pages)
+        self.reload = reload
+        self.pages: Dict[str, Asset] = {}
+        self.static: Dict[str, Asset] = {}
+        self.load()
+
+    def load(self):
+        static = {}
+        for name in sorted(os.listdir(self.static_dir)):
+            path = os.path.join(self.static_dir, name)
+            if os.path.isfile(path):
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                with open(path, "rb") as f:
+                    static[name] = Asset(path, f.read(), media_type)
+        self.static = static
+
+        pages = {}
+        for name in self.page_names:
+            path = os.path.join(self.frontend_dir, name)
+            with open(path, encoding="utf-8") as f:
+                html = self.rewrite_static_urls(f.read())
+            pages[name] = Asset(path, html.encode("utf-8"), "text/html; charset=utf-8")
+        self.pages = pages
+
+    def _changed(self) -> bool:
+        for asset in list(self.pages.values()) + list(self.static.values()):
+            try:
+                if os.stat(asset.path).st_mtime != asset.mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return len(os.listdir(self.static_dir)) != len(self.static)
+
+    def refresh(self):
+        """Dev mode: reload everything if any file changed on disk."""
+        if self.reload and self._changed():
+            self.load()
+
+    def url(self, name: str) -> str:
+        asset = self.static[name]
+        stem, ext = os.path.splitext(name)
+        return f"/static/{stem}.{asset.hash}{ext}"
+
+    def rewrite_static_urls(self, html: str) -> str:
+        for name in self.static:
+            html = html.replace(f'"/static/{name}"', f'"{self.url(name)}"')
+        return html
+
+    def response(self, request: Request, asset: Asset, cache_control: str) -> Response:
+        headers = {
+            "ETag": asset.etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if _not_modified(request, asset):
+            return Response(status_code=304, headers=headers)
+
+        body = asset.body
+        accepted = _accepted_encodings(request.headers.get("accept-encoding"))
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in asset.variants:
+                body = asset.variants[encoding]
+                headers["Content-Encoding"] = encoding
+                break
+        return Response(content=body, media_type=asset.media_type, headers=headers)
+
+    def page_response(self, request: Request, name: str) -> Response:
+        self.refresh()
+        return self.response(request, self.pages[name], REVALIDATE)
+
+    def static_response(self, request: Request, name: str) -> Response:
+        self.refresh()
+        if name in self.static:
+            return self.response(request, self.static[name], REVALIDATE)
+        match = _HASHED_NAME.match(name)
+        if match:
+            plain = match["stem"] + match["ext"]
+            asset = self.static.get(plain)
+            if asset is not None:
+                # устаревший хэш (страница из старого деплоя) — отдаём текущий файл, но без immutable
+                cache_control = IMMUTABLE if asset.hash == match["hash"] else REVALIDATE
+                return self.response(request, asset, cache_control)
+        raise HTTPException(404)
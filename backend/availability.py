@@ -0,0 +1,127 @@
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+# Один бит = один шаг сетки (SLOT_STEP минут) внутри рабочего дня.
+SLOT_STEP = 30
+
+
+class DayGrid:
+    """
+    Slot grid for a single working day.
+
+    Occupancy is kept as an int bitmap: bit i is set when the slot that
+    starts at work_start + i * step is (partly) taken.
+    """
+
+    def __init__(self, work_start: time, work_end: time, step: int = SLOT_STEP):
+        self.work_start = work_start
+        self.work_end = work_end
+        self.step = step
+        self.start_minute = work_start.hour * 60 + work_start.minute
+        self.end_minute = work_end.hour * 60 + work_end.minute
+        self.n_slots = (self.end_minute - self.start_minute) // step
+
+    def day_bounds(self, day: date) -> Tuple[datetime, datetime]:
+        return datetime.combine(day, time.min), datetime.combine(day, time.min) + timedelta(days=1)
+
+    def slots_for(self, duration: int) -> int:
+        return -(-duration // self.step)
+
+    def minute_of(self, index: int) -> int:
+        return self.start_minute + index * self.step
+
+    def index_of(self, minute: int) -> Optional[int]:
+        offset = minute - self.start_minute
+        if offset < 0 or offset % self.step:
+            return None
+        index = offset // self.step
+        return index if index < self.n_slots else None
+
+    def interval_mask(self, day: date, start: datetime, end: datetime) -> int:
+        """Bits covered by [start, end) on the given day, clipped to working hours."""
+        day_start = datetime.combine(day, time.min)
+        first = (start - day_start) // timedelta(minutes=1) - self.start_minute
+        last = (end - day_start) // timedelta(minutes=1) - self.start_minute
+        lo = max(first // self.step, 0)
+        hi = min(-(-last // self.step), self.n_slots)
+        if hi <= lo:
+            return 0
+        return ((1 << (hi - lo)) - 1) << lo
+
+    def bitmap(self, day: date, intervals: Iterable[Tuple[datetime, datetime]]) -> int:
+        busy = 0
+        for start, end in intervals:
+            busy |= self.interval_mask(day, start, end)
+        return busy
+
+    def first_index(self, day: date, not_before: Optional[datetime] = None) -> int:
+        """First slot index that starts at or after `not_before` (n_slots if none)."""
+        if not_before is None:
+            return 0
+        day_start = datetime.combine(day, time.min)
+        if not_before >= day_start + timedelta(days=1):
+            return self.n_slots
+        if not_before <= day_start:
+            return 0
+        seconds = int((not_before - day_start).total_seconds())
+        passed = -(-seconds // 60)
+        return min(max(0, -(-(passed - self.start_minute) // self.step)), self.n_slots)
+
+    def start_mask(self, busy: int, need: int) -> int:
+        """Bits i where `need` consecutive slots starting at i are all free."""
+        free = ~busy & ((1 << self.n_slots) - 1)
+        mask = free
+        for k in range(1, need):
+            mask &= free >> k
+        return mask
+
+    def longest_free_run(self, busy: int) -> int:
+        """Most consecutive free slots in a busy bitmap."""
+        best = run = 0
+        for i in range(self.n_slots):
+            run = 0 if (busy >> i) & 1 else run + 1
+            best = max(best, run)
+        return best
+
+    def free_starts_for(self, day: date, pools: List[List[int]], duration: int,
+                        not_before: Optional[datetime] = None) -> List[int]:
+        """
+        Start minutes where every pool has at least one resource free for `duration`.
+
+        pools: for each resource kind a service requires, the busy bitmaps
+        of all resources of that kind.
+        """
+        need = self.slots_for(duration)
+        fits = (1 << self.n_slots) - 1
+        for bitmaps in pools:
+            any_free = 0
+            for busy in bitmaps:
+                any_free |= self.start_mask(busy, need)
+            fits &= any_free
+        return [self.minute_of(i)
+                for i in range(self.first_index(day, not_before), self.n_slots - need + 1)
+                if (fits >> i) & 1]
+
+    def free_starts(self, day: date, busy: int, duration: int,
+                    not_before: Optional[datetime] = None) -> List[int]:
+        """Start minutes (from midnight) where a service of `duration` fits."""
+        return self.free_starts_for(day, [[busy]], duration, not_before)
+
+
+def snap_interval(start: datetime, end: datetime, step: int = SLOT_STEP) -> Tuple[datetime, datetime]:
+    """[start, end) widened to whole grid steps — the span its slot_keys occupy."""
+    day_start = datetime.combine(start.date(), time.min)
+    first = (start - day_start) // timedelta(minutes=1) // step * step
+    last = -(-((end - day_start) // timedelta(minutes=1)) // step) * step
+    return day_start + timedelta(minutes=first), day_start + timedelta(minutes=last)
+
+
+def slot_keys(start: datetime, end: datetime, step: int = SLOT_STEP) -> List[Tuple[date, int]]:
+    """(day, minute) of every grid step touched by [start, end) — rows of slot_reservations."""
+    first, last = snap_interval(start, end, step)
+    keys = []
+    moment = first
+    while moment < last:
+        keys.append((moment.date(), moment.hour * 60 + moment.minute))
+        moment += timedelta(minutes=step)
+    return keys
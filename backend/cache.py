@@ -0,0 +1,72 @@
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date
+from typing import Hashable, Optional, Tuple
+
+AVAILABILITY_CACHE_SIZE = int(os.getenv("AVAILABILITY_CACHE_SIZE", "2048"))
+AVAILABILITY_CACHE_TTL = float(os.getenv("AVAILABILITY_CACHE_TTL", "300"))
+
+
+class DayCache:
+    """
+    In-process LRU/TTL cache of serialized per-day responses.
+
+    Every day has a version that is bumped by `invalidate()` after a write
+    touching that day. Entries remember the version they were built from,
+    so stale ones are never served and simply age out of the LRU. The
+    version is also what goes into the ETag.
+    """
+
+    def __init__(self, max_entries: int = AVAILABILITY_CACHE_SIZE, ttl: float = AVAILABILITY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # новый epoch на каждый старт процесса — старые ETag клиентов не совпадут
+        self.epoch = uuid.uuid4().hex[:8]
+        self._versions = {}
+        self._entries: "OrderedDict[Tuple[date, Hashable], Tuple[float, int, bytes]]" = OrderedDict()
+
+    def version(self, day: date) -> int:
+        return self._versions.get(day, 0)
+
+    def etag(self, day: date, *parts) -> str:
+        tail = ".".join(str(p) for p in parts)
+        return f'"{self.epoch}.{day.isoformat()}.{self.version(day)}.{tail}"'
+
+    def get(self, day: date, key: Hashable) -> Optional[bytes]:
+        entry = self._entries.get((day, key))
+        if entry is None:
+            return None
+        expires, version, body = entry
+        if version != self.version(day) or expires < time.monotonic():
+            del self._entries[(day, key)]
+            return None
+        self._entries.move_to_end((day, key))
+        return body
+
+    def put(self, day: date, key: Hashable, version: int, body: bytes):
+        # данные прочитаны до записи, которая успела инвалидировать день
+        if version != self.version(day):
+            return
+        self._entries[(day, key)] = (time.monotonic() + self.ttl, version, body)
+        self._entries.move_to_end((day, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *days: date):
+        for day in days:
+            self._versions[day] = self.version(day) + 1
+
+    def clear(self):
+        self._entries.clear()
+        self._versions.clear()
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (c.strip() for c in if_none_match.split(","))
+    return etag in (c[2:] if c.startswith("W/") else c for c in candidates)
@@ -1,12 +1,142 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+import asyncio
+import os
+import weakref
 
-DATABASE_URL = "sqlite:///./bookings.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:////data/bookings.db")
+
+# Пул для async-движка (для SQLite-файла и Postgres)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# SQLite: WAL — читатели /api/busy-slots не блокируют запись в /api/book
+SQLITE_PRAGMAS = {
+    # действует только для новой базы (до первой таблицы); старую переводит
+    # разовый VACUUM: python -m backend.archive --vacuum
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-20000")),  # KiB, если < 0
+    "temp_store": "MEMORY",
+}
+
+
+def async_url(url: str) -> str:
+    """sqlite:// -> sqlite+aiosqlite://, postgresql:// -> postgresql+asyncpg://"""
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    if url.startswith(("postgresql://", "postgres://")):
+        return "postgresql+asyncpg://" + url.split("://", 1)[1]
+    return url
+
+
+def _is_memory(url: str) -> bool:
+    return url.startswith("sqlite") and (url.endswith("://") or ":memory:" in url)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def make_engines(url: str):
+    """Sync engine (migrations, scripts) and async engine (request handlers) for one URL."""
+    sqlite = url.startswith("sqlite")
+    sync_engine = create_engine(
+        url,
+        connect_args={"check_same_thread": False} if sqlite else {}
+    )
+    pool_args = {} if _is_memory(url) else {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": not sqlite,
+    }
+    async_engine = create_async_engine(async_url(url), **pool_args)
+    if sqlite:
+        event.listen(sync_engine, "connect", _set_sqlite_pragmas)
+        event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
+    return sync_engine, async_engine
+
+
+engine, async_engine = make_engines(DATABASE_URL)
+
+# по замку на цикл событий: asyncio.Lock привязывается к циклу первого ожидания
+_write_locks = weakref.WeakKeyDictionary()
+
+
+def _write_lock() -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    lock = _write_locks.get(loop)
+    if lock is None:
+        lock = _write_locks[loop] = asyncio.Lock()
+    return lock
+
+
+class WriteSerializedSession(AsyncSession):
+    """
+    SQLite has a single writer. Left to busy_timeout, every waiting
+    transaction polls for the lock with a growing sleep (up to 100 ms per
+    try, no ordering), and under concurrent writes some of them wait for
+    seconds. On SQLite this session takes a per-process FIFO lock before its
+    first write and keeps it until commit, rollback or close, so the writers
+    of one process queue instead of polling; busy_timeout is left for the
+    other processes. Reads never wait for it. Postgres is not affected.
+    """
+    _write_held = None
+
+    async def _begin_write(self):
+        if self._write_held is None and self.bind is not None and self.bind.dialect.name == "sqlite":
+            # соединение — до очереди: иначе владелец замка ждёт пул, занятый стоящими в очереди
+            await self.connection()
+            lock = _write_lock()
+            await lock.acquire()
+            self._write_held = lock
+
+    def _end_write(self):
+        lock, self._write_held = self._write_held, None
+        if lock is not None:
+            lock.release()
+
+    def _has_changes(self) -> bool:
+        return bool(self.new or self.dirty or self.deleted)
+
+    async def execute(self, statement, *args, **kwargs):
+        if getattr(statement, "is_dml", False):
+            await self._begin_write()
+        return await super().execute(statement, *args, **kwargs)
+
+    async def flush(self, objects=None):
+        if self._has_changes():
+            await self._begin_write()
+        await super().flush(objects)
+
+    async def commit(self):
+        if self._has_changes():
+            await self._begin_write()
+        try:
+            await super().commit()
+        finally:
+            self._end_write()
+
+    async def rollback(self):
+        try:
+            await super().rollback()
+        finally:
+            self._end_write()
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._end_write()
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False}
-)
 
 SessionLocal = sessionmaker(
     autocommit=False,
@@ -14,4 +144,17 @@ SessionLocal = sessionmaker(
     bind=engine
 )
 
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    class_=WriteSerializedSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 Base = declarative_base()
+
+
+async def get_db():
+    """Request-scoped session; closed (and rolled back) even if the handler raises."""
+    async with AsyncSessionLocal() as session:
+        yield session
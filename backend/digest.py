@@ -0,0 +1,140 @@
+"""
+Coalesced admin notifications.
+
+Instead of one "Neue Buchung" mail per booking to every admin, handlers
+record an AdminEvent row in their own transaction (`AdminDigest.notify`).
+AdminDigest turns all events of a window (ADMIN_DIGEST_INTERVAL: 300 for
+every five minutes, 86400 for a daily digest at midnight) into a single
+summary email in the outbox, so admin mail volume follows the clock, not
+the booking count. Urgent events — the appointment starts within
+ADMIN_URGENT_WITHIN — are mailed right away, as before, and also sent to
+ADMIN_WHATSAPP_TO over WhatsApp when that number is set.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+
+from .models import AdminEvent
+from .outbox import enqueue_email, enqueue_whatsapp
+
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", "300"))  # секунд; 0 — без сводок
+ADMIN_URGENT_WITHIN = timedelta(minutes=int(os.getenv("ADMIN_URGENT_WITHIN", "120")))
+ADMIN_DIGEST_MAX = 1000  # событий в одном письме
+# номер администратора для срочных уведомлений (Twilio); пусто — только письмо
+ADMIN_WHATSAPP_TO = os.getenv("ADMIN_WHATSAPP_TO", "")
+
+KINDS = {"booking": "Neue Buchungen", "cancel": "Stornierungen"}
+
+log = logging.getLogger("carwash.digest")
+
+
+def render_digest(events: List[AdminEvent]) -> Tuple[str, str]:
+    counts = {kind: sum(1 for e in events if e.kind == kind) for kind in KINDS}
+    subject = f"Zusammenfassung: {counts['booking']} neue Buchungen, {counts['cancel']} Stornierungen"
+    sections = "".join(
+        f"<h2>{title} ({counts[kind]})</h2><ul>"
+        + "".join(f"<li>{e.summary}</li>" for e in events if e.kind == kind)
+        + "</ul>"
+        for kind, title in KINDS.items() if counts[kind]
+    )
+    since = min(e.created_at for e in events).strftime("%d.%m.%Y %H:%M")
+    until = max(e.created_at for e in events).strftime("%d.%m.%Y %H:%M")
+    body = f"""
+    <html>
+    <body>
+        {sections}
+        <p>Zeitraum: {since} – {until}</p>
+    </body>
+    </html>
+    """
+    return subject, body
+
+
+class AdminDigest:
+    def __init__(self, session_factory, recipients: Callable[[], List[str]],
+                 interval: int = ADMIN_DIGEST_INTERVAL, urgent_within: timedelta = ADMIN_URGENT_WITHIN,
+                 whatsapp_to: str = ADMIN_WHATSAPP_TO):
+        self.session_factory = session_factory
+        self.recipients = recipients
+        self.whatsapp_to = whatsapp_to
+        self.interval = interval
+        self.urgent_within = urgent_within
+        self._task = None
+
+    def is_urgent(self, start: datetime) -> bool:
+        return self.interval <= 0 or start - datetime.now() < self.urgent_within
+
+    def notify(self, db, kind: str, start: datetime, summary: str, subject: str, body: str) -> bool:
+        """Queue an admin notification; True if it was mailed immediately."""
+        if self.is_urgent(start):
+            enqueue_email(db, self.recipients(), subject, body)
+            if self.whatsapp_to:
+                enqueue_whatsapp(db, f"{subject}: {summary}", self.whatsapp_to)
+            return True
+        db.add(AdminEvent(kind=kind, summary=summary))
+        return False
+
+    async def flush(self, before: Optional[datetime] = None) -> int:
+        """Turn pending events (created before `before`) into digest emails; returns how many."""
+        flushed = 0
+        while True:
+            async with self.session_factory() as db:
+                query = select(AdminEvent).order_by(AdminEvent.id).limit(ADMIN_DIGEST_MAX)
+                if before is not None:
+                    query = query.where(AdminEvent.created_at < before)
+                events = (await db.execute(query)).scalars().all()
+                if not events:
+                    return flushed
+                # другой воркер мог забрать те же события — тогда письмо пишет он
+                result = await db.execute(
+                    delete(AdminEvent)
+                    .where(AdminEvent.id.in_([e.id for e in events]))
+                    .execution_options(synchronize_session=False)
+                )
+                if result.rowcount != len(events):
+                    await db.rollback()
+                    return flushed
+                subject, body = render_digest(events)
+                enqueue_email(db, self.recipients(), subject, body)
+                await db.commit()
+            flushed += len(events)
+            if len(events) < ADMIN_DIGEST_MAX:
+                return flushed
+
+    def next_window(self, now: datetime) -> datetime:
+        # границы окон от полуночи: все воркеры просыпаются одновременно,
+        # первый забирает события, остальные находят пустую таблицу
+        midnight = datetime.combine(now.date(), datetime.min.time())
+        elapsed = (now - midnight).total_seconds()
+        return midnight + timedelta(seconds=(elapsed // self.interval + 1) * self.interval)
+
+    async def _run(self):
+        while True:
+            until = self.next_window(datetime.now())
+            await asyncio.sleep(max((until - datetime.now()).total_seconds(), 0))
+            try:
+                await self.flush(before=until)
+            except Exception:
+                log.exception("ошибка отправки сводки")
+
+    async def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # при остановке не ждём конца окна: всё накопленное — в outbox
+        try:
+            await self.flush()
+        except Exception:
+            log.exception("сводка не отправлена при остановке")
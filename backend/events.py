@@ -0,0 +1,80 @@
+"""
+In-process pub/sub for live slot updates.
+
+Every day has its own channel; each subscriber (one open SSE stream) gets
+a bounded queue. A subscriber that cannot keep up is not allowed to grow
+memory: its backlog is dropped and replaced by a single "reset" event,
+after which the client refetches /api/availability.
+"""
+import asyncio
+import os
+from datetime import date
+from typing import Dict, Set
+
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "32"))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "1000"))
+
+RESET = {"type": "reset"}
+
+
+class Subscription:
+    def __init__(self, day: date, queue_size: int):
+        self.day = day
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def push(self, event: dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # медленный клиент: вместо очереди диффов — один reset
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESET)
+
+    async def get(self, timeout: float):
+        """Next event, or None after `timeout` seconds of silence."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class DayChannels:
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE, max_subscribers: int = EVENTS_MAX_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.channels: Dict[date, Set[Subscription]] = {}
+
+    def subscribers(self, day: date) -> int:
+        return len(self.channels.get(day, ()))
+
+    def total(self) -> int:
+        return sum(len(subs) for subs in self.channels.values())
+
+    def subscribe(self, day: date) -> Subscription:
+        if self.total() >= self.max_subscribers:
+            raise OverflowError("too many subscribers")
+        sub = Subscription(day, self.queue_size)
+        self.channels.setdefault(day, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription):
+        subs = self.channels.get(sub.day)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                del self.channels[sub.day]
+
+    def publish(self, day: date, event: dict) -> int:
+        subs = self.channels.get(day, ())
+        for sub in list(subs):
+            sub.push(event)
+        return len(subs)
+
+    def publish_all(self, event: dict) -> int:
+        sent = 0
+        for day in list(self.channels):
+            sent += self.publish(day, event)
+        return sent
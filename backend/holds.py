@@ -0,0 +1,158 @@
+"""
+Slot holds.
+
+POST /api/hold reserves a slot for HOLD_TTL seconds: a Booking with status
+"held" plus its slot_reservations rows and a SlotHold with the token and
+the expiry. Other clients see the interval as busy; /api/book with the
+token only flips the booking to "confirmed" — no new allocation, and the
+slot cannot have been taken in between. A browser session (the hold
+cookie, not the IP: many customers can share one behind NAT or a proxy)
+keeps at most HOLDS_PER_CLIENT holds: a new one replaces the oldest.
+
+HoldSweeper keeps the expiries of the holds it knows about in a heap and
+sleeps until the earliest one, so an expired hold is released within
+moments instead of at the next fixed tick. Holds created by other workers
+are caught by the same query every HOLD_SWEEP_INTERVAL seconds.
+"""
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+
+from .models import Booking, SlotHold, SlotReservation
+
+HOLD_TTL = int(os.getenv("HOLD_TTL", "300"))  # секунд
+HOLD_SWEEP_INTERVAL = float(os.getenv("HOLD_SWEEP_INTERVAL", "30"))
+# активных удержаний на сессию: новое сверх лимита снимает самые старые
+HOLDS_PER_CLIENT = max(1, int(os.getenv("HOLDS_PER_CLIENT", "1")))
+
+log = logging.getLogger("carwash.holds")
+
+# (id брони, начало, конец) освобождённого удержания
+Released = Tuple[int, datetime, datetime]
+
+
+async def _drop(db, condition) -> List[Released]:
+    # сначала условное удаление брони: подтверждённую параллельно бронь оно не тронет
+    released = (await db.execute(
+        delete(Booking)
+        .where(Booking.status == "held", Booking.id.in_(select(SlotHold.booking_id).where(condition)))
+        .returning(Booking.id, Booking.start_time, Booking.end_time)
+        .execution_options(synchronize_session=False)
+    )).all()
+    ids = [row[0] for row in released]
+    if ids:
+        await db.execute(delete(SlotReservation).where(SlotReservation.booking_id.in_(ids)))
+    await db.execute(delete(SlotHold).where(condition))
+    return [tuple(row) for row in released]
+
+
+async def release_hold(db, token: str) -> List[Released]:
+    """Drop one hold in the caller's transaction."""
+    return await _drop(db, SlotHold.token == token)
+
+
+async def release_booking_hold(db, booking_id: int) -> List[Released]:
+    """Drop the hold behind one held booking in the caller's transaction."""
+    return await _drop(db, SlotHold.booking_id == booking_id)
+
+
+async def release_client_holds(db, client: str, keep: int = 0) -> List[Released]:
+    """Drop all but the `keep` latest holds of one session in the caller's transaction."""
+    ids = (await db.execute(
+        select(SlotHold.booking_id).where(SlotHold.client == client)
+        .order_by(SlotHold.expires_at.desc()).offset(keep)
+    )).scalars().all()
+    return await _drop(db, SlotHold.booking_id.in_(ids)) if ids else []
+
+
+async def release_expired(db, now: datetime) -> List[Released]:
+    """Drop every hold that expired by `now` in the caller's transaction."""
+    return await _drop(db, SlotHold.expires_at <= now)
+
+
+async def find_hold(db, token: str) -> Optional[SlotHold]:
+    return (await db.execute(select(SlotHold).where(SlotHold.token == token))).scalars().first()
+
+
+class HoldSweeper:
+    """
+    Releases expired holds; on_release(db, released) runs in the sweep's
+    transaction before the commit, on_released(released) after it.
+    """
+
+    def __init__(self, session_factory, on_release: Callable, on_released: Callable[[List[Released]], Awaitable],
+                 interval: float = HOLD_SWEEP_INTERVAL):
+        self.session_factory = session_factory
+        self.on_release = on_release
+        self.on_released = on_released
+        self.interval = interval
+        self.heap: List[Tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def push(self, expires_at: datetime, booking_id: int):
+        heapq.heappush(self.heap, (expires_at, booking_id))
+        if self.heap[0] == (expires_at, booking_id):
+            # новое удержание истекает раньше всех — пересчитываем сон
+            self._wakeup.set()
+
+    async def load(self):
+        async with self.session_factory() as db:
+            rows = (await db.execute(select(SlotHold.expires_at, SlotHold.booking_id))).all()
+        self.heap = [tuple(row) for row in rows]
+        heapq.heapify(self.heap)
+
+    async def sweep(self, now: Optional[datetime] = None) -> int:
+        """Release all holds expired by `now`; returns how many."""
+        now = now or datetime.now()
+        # подтверждённые и снятые удержания остаются в куче до своего срока — это дешевле поиска
+        while self.heap and self.heap[0][0] <= now:
+            heapq.heappop(self.heap)
+        async with self.session_factory() as db:
+            released = await release_expired(db, now)
+            if released:
+                self.on_release(db, released)
+            await db.commit()
+        if released:
+            await self.on_released(released)
+        return len(released)
+
+    def _delay(self) -> float:
+        if not self.heap:
+            return self.interval
+        return min(self.interval, max(0.0, (self.heap[0][0] - datetime.now()).total_seconds()))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._delay())
+                self._wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.sweep()
+            except Exception as e:
+                # SQLite: параллельная запись — повторим на следующем шаге
+                log.warning("ошибка снятия удержаний: %s", e)
+
+    async def start(self):
+        if self._task is None:
+            await self.load()
+            # Event привязывается к циклу первого wait(): новый запуск — новый цикл
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,164 @@
+"""
+Cross-worker cache coherence.
+
+Each uvicorn/gunicorn worker has its own availability cache, schedule
+index and SSE channels. A booking change adds a CacheInvalidation row in
+its own transaction (`record_change`); CacheSync in every worker polls the
+table and drops the affected days locally. On SQLite the poll first reads
+`PRAGMA data_version` on a dedicated connection, which only changes after
+some other connection committed, so an idle database costs one pragma per
+tick and no table reads.
+
+Ids are not gapless and need not commit in order: a rolled-back insert
+burns a sequence value on Postgres, and a transaction holding a lower id
+can commit after one holding a higher id. Ids skipped over are therefore
+re-read for CACHE_SYNC_GAP_WAIT seconds and applied if they show up late;
+only a worker that did not poll for longer than the retention (rows may
+have been pruned unseen) or a jump too large to track drops everything.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import delete, func, or_, select
+
+from .models import CacheInvalidation
+
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "0.5"))
+CACHE_SYNC_RETENTION = int(os.getenv("CACHE_SYNC_RETENTION", "3600"))  # секунд
+CACHE_SYNC_PRUNE_EVERY = 600  # тиков между чистками старых строк
+# сколько ждать пропущенный id: транзакция с ним ещё может закоммититься
+CACHE_SYNC_GAP_WAIT = float(os.getenv("CACHE_SYNC_GAP_WAIT", "60"))
+CACHE_SYNC_MAX_GAP = 1000  # больше пропущенных id не отслеживаем — сброс
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+log = logging.getLogger("carwash.cache_sync")
+
+
+def record_change(db, *days: date):
+    for day in set(days):
+        db.add(CacheInvalidation(day=day, origin=WORKER_ID))
+
+
+class CacheSync:
+    """
+    Polls cache_invalidations and reports days changed by other workers.
+
+    on_change(days) gets the foreign days of every new batch, including
+    rows that committed late into an id gap; on_reset() is called when rows
+    may have been missed (pruned while this worker was stalled), and
+    everything local must be dropped.
+    """
+
+    def __init__(self, engine, on_change: Callable[[List[date]], None], on_reset: Callable[[], None],
+                 interval: float = CACHE_SYNC_INTERVAL, origin: str = WORKER_ID):
+        self.engine = engine
+        self.on_change = on_change
+        self.on_reset = on_reset
+        self.interval = interval
+        self.origin = origin
+        self.last_id = 0
+        # пропущенные id -> до какого момента (monotonic) их ещё ждать
+        self.missing: Dict[int, float] = {}
+        self._polled_at: Optional[float] = None
+        self._conn = None
+        self._data_version: Optional[int] = None
+        self._task = None
+        self._ticks = 0
+
+    async def prime(self):
+        """Start from the current end of the log: older changes are already in the DB."""
+        if self.engine.dialect.name == "sqlite":
+            self._conn = await self.engine.connect()
+            self._data_version = await self._read_data_version()
+        async with self.engine.connect() as conn:
+            self.last_id = (await conn.execute(select(func.max(CacheInvalidation.id)))).scalar() or 0
+        self.missing = {}
+        self._polled_at = time.monotonic()
+
+    async def _read_data_version(self) -> int:
+        version = (await self._conn.exec_driver_sql("PRAGMA data_version")).scalar()
+        await self._conn.rollback()
+        return version
+
+    async def poll(self) -> int:
+        """One tick; returns how many foreign invalidations were applied."""
+        now = time.monotonic()
+        stalled = self._polled_at is not None and now - self._polled_at > CACHE_SYNC_RETENTION
+        self._polled_at = now
+        # откатившиеся транзакции так и не закоммитят свой id
+        self.missing = {row_id: until for row_id, until in self.missing.items() if until > now}
+        if self._conn is not None:
+            version = await self._read_data_version()
+            if version == self._data_version and not stalled:
+                return 0
+            self._data_version = version
+
+        condition = CacheInvalidation.id > self.last_id
+        if self.missing:
+            condition = or_(condition, CacheInvalidation.id.in_(list(self.missing)))
+        async with self.engine.connect() as conn:
+            rows = (await conn.execute(
+                select(CacheInvalidation.id, CacheInvalidation.day, CacheInvalidation.origin)
+                .where(condition)
+                .order_by(CacheInvalidation.id)
+            )).all()
+
+        overflow = False
+        for row in rows:
+            if row.id <= self.last_id:
+                # закоммитилась позже строк с бОльшими id
+                self.missing.pop(row.id, None)
+                continue
+            if row.id - self.last_id - 1 > CACHE_SYNC_MAX_GAP:
+                overflow = True
+            else:
+                self.missing.update(dict.fromkeys(range(self.last_id + 1, row.id), now + CACHE_SYNC_GAP_WAIT))
+            self.last_id = row.id
+        if stalled or overflow:
+            self.missing = {}
+            self.on_reset()
+            return len(rows)
+        days = sorted({row.day for row in rows if row.origin != self.origin})
+        if days:
+            self.on_change(days)
+        return len(days)
+
+    async def prune(self):
+        cutoff = datetime.now() - timedelta(seconds=CACHE_SYNC_RETENTION)
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(CacheInvalidation).where(CacheInvalidation.created_at < cutoff))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+                self._ticks += 1
+                if self._ticks % CACHE_SYNC_PRUNE_EVERY == 0:
+                    await self.prune()
+            except Exception:
+                log.exception("ошибка опроса")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            await self.prime()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
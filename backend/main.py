@@ -1,17 +1,42 @@
-from fastapi import FastAPI, HTTPException, Request, Form
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Form, Depends, Query
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base
+from fastapi.responses import HTMLResponse, RedirectResponse, Response, StreamingResponse, PlainTextResponse
 from datetime import datetime, timedelta, time
-import uuid
+import json
+import base64
+import csv
+import io
+from sqlalchemy import select, delete, update, tuple_, func, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from pydantic_settings import BaseSettings, SettingsConfigDict
 from fastapi_mail import ConnectionConfig
-from fastapi import BackgroundTasks
-from .services import SERVICES
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import asyncio
+import ipaddress
+import secrets
+from .services import SERVICES, RESOURCE_COUNTS
+from .availability import DayGrid, SLOT_STEP, slot_keys
+from .database import engine, async_engine, get_db, AsyncSessionLocal
+from .models import Booking, ArchivedBooking, SlotReservation, SlotHold, OutboxMessage, DailyStat
+from .migrations import init_db
+from .cache import DayCache, etag_matches
+from .outbox import OutboxWorker, enqueue_email
+from .scheduling import ScheduleIndex
+from .events import DayChannels, RESET
+from .invalidation import CacheSync, record_change
+from .archive import ArchiveWorker
+from .digest import AdminDigest
+from .stats import count_booking
+from .admission import RateLimiter, Rejected, make_gates
+from .holds import (HOLD_TTL, HOLDS_PER_CLIENT, HoldSweeper, find_hold, release_hold, release_booking_hold,
+                    release_client_holds)
+from .tokens import sign as sign_token, verify as verify_token, is_signed, INVALID, EXPIRED
+from .assets import AssetStore
+from .metrics import REGISTRY, MetricsMiddleware, instrument_engine, outbox_pending
 import os
 
 # ================== SETTINGS ==================
@@ -19,8 +44,31 @@ class Settings(BaseSettings):
     MAIL_USERNAME: str
     MAIL_PASSWORD: str
     MAIL_FROM: str
+    MAIL_SERVER: str = "smtp.gmail.com"
+    MAIL_PORT: int = 587
+    MAIL_STARTTLS: bool = True
     DOMAIN: str = "http://localhost:8000"
 
+    # фоновая доставка писем из outbox (в тестах отключаем)
+    OUTBOX_WORKER: bool = True
+    # dev: перечитывать страницы и static при изменении файлов
+    PAGES_RELOAD: bool = False
+    # несколько воркеров: опрашивать cache_invalidations и сбрасывать свои кэши
+    CACHE_SYNC: bool = True
+    # перенос прошедших и отменённых броней в bookings_archive
+    ARCHIVE_WORKER: bool = True
+    # ключ подписи ссылок отмены, общий для всех воркеров (например, `openssl rand -hex 32`);
+    # без него приложение не стартует: подпись не должна зависеть от пароля администратора
+    CANCEL_TOKEN_SECRET: str = Field(min_length=32)
+    # принимать старые UUID-ссылки (переходный период)
+    LEGACY_CANCEL_TOKENS: bool = True
+    # лимиты по IP и ограничение одновременных запросов на записи (в тестах отключаем)
+    ADMISSION_CONTROL: bool = True
+    # адреса/сети обратных прокси через запятую ("127.0.0.1,10.0.0.0/8"): за ними IP клиента
+    # берётся из X-Forwarded-For, иначе все клиенты делят одно ведро лимита адреса прокси.
+    # Пусто — доверяем только адресу соединения (или forwarded_allow_ips самого uvicorn)
+    TRUSTED_PROXIES: str = ""
+
     ADMIN_USER: str
     ADMIN_PASS: str
     ADMIN_EMAILS: str
@@ -30,65 +78,171 @@ class Settings(BaseSettings):
         extra="allow"
     )
 
-settings = Settings()  # создаём объект настроек
+@lru_cache
+def get_settings() -> Settings:
+    # читаем при первом обращении, а не при импорте модуля
+    return Settings()
 
 # ================== CONFIG ==================
 WORK_START = time(7, 30)
 WORK_END = time(18, 0)
 
-DATABASE_URL = "sqlite:////data/bookings.db"
+GRID = DayGrid(WORK_START, WORK_END, SLOT_STEP)
+
+# удержанный термин для остальных клиентов так же занят, как подтверждённый
+BUSY_STATUSES = ("confirmed", "held")
+
+# самая длинная услуга: бронь, пересекающая [start, end), началась не раньше start - MAX_DURATION
+MAX_DURATION = timedelta(minutes=max(s["duration"] for s in SERVICES.values()))
+
+# кэш ответов по дням; сбрасывается в book() и в обоих путях отмены
+availability_cache = DayCache()
+
+# занятость боксов и сотрудников по дням — для выбора ресурса в book()
+schedule_index = ScheduleIndex(step=GRID.step)
+
+# открытые страницы бронирования подписаны на изменения своего дня (SSE)
+slot_events = DayChannels()
+SSE_HEARTBEAT = 15  # секунд; комментарий-пинг не даёт прокси закрыть поток
+SSE_RETRY_MS = 3000
+
+
+def apply_remote_changes(days):
+    """Дни, изменённые другими воркерами: сбрасываем свои кэши, SSE-клиенты перечитывают день."""
+    availability_cache.invalidate(*days)
+    schedule_index.invalidate(*days)
+    for day in days:
+        slot_events.publish(day, RESET)
+
+
+def reset_local_caches():
+    availability_cache.clear()
+    schedule_index.clear()
+    slot_events.publish_all(RESET)
+
+
+cache_sync = CacheSync(async_engine, apply_remote_changes, reset_local_caches)
+
+# прошедшие и отменённые брони уходят в bookings_archive небольшими пачками
+archive_worker = ArchiveWorker(AsyncSessionLocal, async_engine)
 
 
 # ================== DATABASE ==================
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-)
+# схема создаётся и мигрируется в lifespan (init_db), а не при импорте;
+# URL базы — переменная окружения DATABASE_URL (см. database.py)
+
+# время и число SQL-запросов на каждый HTTP-запрос — для /metrics
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
 
-SessionLocal = sessionmaker(bind=engine)
-Base = declarative_base()
+# ================== APP ==================
+router = APIRouter()
 
-class Booking(Base):
-    __tablename__ = "bookings"
-    id = Column(Integer, primary_key=True)
-    name = Column(String)
-    phone = Column(String)
-    email = Column(String)
-    service = Column(String)
-    start_time = Column(DateTime)
-    end_time = Column(DateTime)
-    status = Column(String, default="confirmed")
-    cancel_token = Column(String, unique=True)
+# ================== ADMISSION ==================
+rate_limiter = RateLimiter()
+gates = make_gates()
+REJECT_DETAIL = {429: "Zu viele Anfragen, bitte später erneut versuchen", 503: "Server ausgelastet"}
 
-Base.metadata.create_all(engine)
 
-# ================== APP ==================
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-app.mount("/static", StaticFiles(directory=os.path.join(BASE_DIR, "..", "frontend", "static")), name="static")
+@lru_cache
+def proxy_networks(spec: str):
+    return [ipaddress.ip_network(part.strip(), strict=False) for part in spec.split(",") if part.strip()]
+
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in proxy_networks(get_settings().TRUSTED_PROXIES))
+
+
+def client_address(request: Request) -> str:
+    """
+    Адрес клиента для лимитов. Пока соединение пришло от доверенного прокси,
+    идём по X-Forwarded-For справа налево до первого чужого адреса: левее
+    него значения задаёт сам клиент, им верить нельзя.
+    """
+    host = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(host):
+        return host
+    hops = [hop.strip() for value in request.headers.getlist("x-forwarded-for") for hop in value.split(",")]
+    for hop in reversed(hops):
+        if not hop:
+            continue
+        host = hop
+        if not is_trusted_proxy(hop):
+            break
+    return host
+
+
+def admission(route: str):
+    """Зависимость: лимит по IP, затем место в шлюзе маршрута — до открытия сессии БД."""
+    async def admit(request: Request):
+        if not get_settings().ADMISSION_CONTROL:
+            yield
+            return
+        client = client_address(request)
+        gate = gates[route]
+        try:
+            await rate_limiter.check(route, client)
+            await gate.enter()
+        except Rejected as e:
+            raise HTTPException(e.status, REJECT_DETAIL[e.status], headers={"Retry-After": str(e.retry_after)})
+        try:
+            yield
+        finally:
+            gate.leave()
+    return admit
+
+@lru_cache
+def get_assets() -> AssetStore:
+    # страницы и static читаются и сжимаются один раз (прогрев — в lifespan)
+    return AssetStore(
+        os.path.join(BASE_DIR, "..", "frontend"),
+        pages=["index.html", "success.html", "admin.html", "cancel.html"],
+        reload=get_settings().PAGES_RELOAD
+    )
+
+@router.api_route("/static/{name}", methods=["GET", "HEAD"])
+async def static(name: str, request: Request):
+    return get_assets().static_response(request, name)
 
 # ================== EMAIL CONFIG ==================
-conf = ConnectionConfig(
-    MAIL_USERNAME=settings.MAIL_USERNAME,
-    MAIL_PASSWORD=settings.MAIL_PASSWORD,
-    MAIL_FROM=settings.MAIL_FROM,
-    MAIL_PORT=587,
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_STARTTLS=True,       # вместо MAIL_TLS
-    MAIL_SSL_TLS=False,       # SSL/TLS не используем на порту 587
-    USE_CREDENTIALS=True,
-    TEMPLATE_FOLDER=os.path.join(BASE_DIR, "..", "frontend")  # укажи реально существующую папку
-)
+@lru_cache
+def get_mail_conf() -> ConnectionConfig:
+    settings = get_settings()
+    return ConnectionConfig(
+        MAIL_USERNAME=settings.MAIL_USERNAME,
+        MAIL_PASSWORD=settings.MAIL_PASSWORD,
+        MAIL_FROM=settings.MAIL_FROM,
+        MAIL_PORT=settings.MAIL_PORT,
+        MAIL_SERVER=settings.MAIL_SERVER,
+        MAIL_STARTTLS=settings.MAIL_STARTTLS,  # вместо MAIL_TLS
+        MAIL_SSL_TLS=False,       # SSL/TLS не используем на порту 587
+        USE_CREDENTIALS=True,
+        TEMPLATE_FOLDER=os.path.join(BASE_DIR, "..", "frontend")  # укажи реально существующую папку
+    )
+
+# письма пишутся в outbox вместе с бронью, отправляет их этот воркер
+@lru_cache
+def get_outbox_worker() -> OutboxWorker:
+    return OutboxWorker(AsyncSessionLocal, get_mail_conf())
+
+@lru_cache
+def cancel_secret() -> bytes:
+    return get_settings().CANCEL_TOKEN_SECRET.encode()
+
+
+def cancel_token_for(booking) -> str:
+    """Подписанная ссылка отмены: id брони, действует до начала термина."""
+    return sign_token(cancel_secret(), booking.id, int(booking.start_time.timestamp()))
+
 
 def render_booking_email(name: str, service_name: str, start: datetime, cancel_token: str):
-    cancel_url = f"{settings.DOMAIN}/cancel/{cancel_token}"
+    cancel_url = f"{get_settings().DOMAIN}/cancel/{cancel_token}"
     return f"""
     <html>
     <body>
@@ -103,93 +257,239 @@ def render_booking_email(name: str, service_name: str, start: datetime, cancel_t
     """
 
 # ================== API ==================
-@app.get("/api/services")
+@router.get("/api/services")
 def get_services():
     return SERVICES
 
-@app.get("/api/slots")
-def slots():
-    db = SessionLocal()
-    data = db.query(Booking).filter(Booking.status == "confirmed").all()
-    db.close()
-    return [{"start_time": b.start_time.isoformat(), "end_time": b.end_time.isoformat()} for b in data]
+def parse_day(value: str):
+    """YYYY-MM-DD из запроса; кривая дата — 400, а не 500 из fromisoformat."""
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        raise HTTPException(400, "Ungültiges Datum")
+
+
+def overlaps(start: datetime, end: datetime):
+    """
+    Условия «бронь пересекает [start, end)». Нижняя граница по start_time
+    ограничивает диапазон индекса (status, start_time) одним днём, а не всей историей.
+    """
+    return (
+        Booking.start_time >= start - MAX_DURATION,
+        Booking.start_time < end,
+        Booking.end_time > start,
+    )
+
 
-@app.get("/api/busy-slots")
-def busy_slots(date: str):
+async def cached_day_response(request: Request, day, key: tuple, build):
+    """
+    Serve a per-day JSON payload through availability_cache.
+
+    A matching If-None-Match gets 304 without touching the DB; otherwise
+    the serialized body is reused until the day is invalidated.
+    """
+    etag = availability_cache.etag(day, *key)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    version = availability_cache.version(day)
+    body = availability_cache.get(day, key)
+    if body is None:
+        body = json.dumps(await build(), ensure_ascii=False).encode("utf-8")
+        availability_cache.put(day, key, version, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/api/slots")
+async def slots(request: Request, date: str, db: AsyncSession = Depends(get_db)):
+    # только по дню: без даты это был бы список всех броней
+    day = parse_day(date)
+    day_start, day_end = GRID.day_bounds(day)
+
+    async def build():
+        data = (await db.execute(
+            select(Booking).where(Booking.status.in_(BUSY_STATUSES), *overlaps(day_start, day_end))
+        )).scalars().all()
+        return [{"start_time": b.start_time.isoformat(), "end_time": b.end_time.isoformat()} for b in data]
+
+    return await cached_day_response(request, day, ("slots",), build)
+
+@router.get("/api/availability")
+async def availability(request: Request, date: str, service: str, db: AsyncSession = Depends(get_db)):
     """
     date: YYYY-MM-DD
+    Возвращает минуты от полуночи, с которых можно начать выбранный сервис.
     """
-    day_start = datetime.fromisoformat(date)
-    day_end = day_start + timedelta(days=1)
+    if service not in SERVICES:
+        raise HTTPException(404, "Unbekannter Service")
+    day = parse_day(date)
+    # для сегодняшнего дня ответ меняется с каждым прошедшим слотом
+    first = GRID.first_index(day, datetime.now())
 
-    db = SessionLocal()
-    bookings = db.query(Booking).filter(
-        Booking.status == "confirmed",
-        Booking.start_time >= day_start,
-        Booking.start_time < day_end
-    ).all()
-    db.close()
-
-    return [
-        {
-            "start": b.start_time.isoformat(),
-            "end": b.end_time.isoformat()
+    async def build():
+        # старт подходит, если для каждого нужного вида ресурса свободен хотя бы один
+        schedule = await schedule_index.day(db, day)
+        duration = SERVICES[service]["duration"]
+        pools = schedule.pools(GRID, day, SERVICES[service]["requires"])
+        return {
+            "date": day.isoformat(),
+            "service": service,
+            "duration": duration,
+            "step": GRID.step,
+            "starts": [m for m in GRID.free_starts_for(day, pools, duration) if m >= GRID.minute_of(first)]
         }
-        for b in bookings
+
+    return await cached_day_response(request, day, ("availability", service, first), build)
+
+# поиск ближайшего свободного термина: не дальше горизонта, дни читаются пачками
+NEXT_AVAILABLE_DAYS = int(os.getenv("NEXT_AVAILABLE_DAYS", "60"))
+NEXT_AVAILABLE_CHUNK = 14
+NEXT_AVAILABLE_MAX = 20
+
+
+async def free_starts_ahead(db: AsyncSession, service: str, not_before: datetime, days):
+    """Свободные старты услуги по дням `days` по порядку; расписания читаются пачками."""
+    duration = SERVICES[service]["duration"]
+    requires = SERVICES[service]["requires"]
+    need = GRID.slots_for(duration)
+    for i in range(0, len(days), NEXT_AVAILABLE_CHUNK):
+        chunk = days[i:i + NEXT_AVAILABLE_CHUNK]
+        schedules = await schedule_index.days(db, chunk)
+        for day in chunk:
+            schedule = schedules[day]
+            # нет ни одного достаточно длинного окна — день занят, старты не считаем
+            if not schedule.may_fit(GRID, day, requires, need):
+                continue
+            pools = schedule.pools(GRID, day, requires)
+            for minute in GRID.free_starts_for(day, pools, duration, not_before):
+                yield datetime.combine(day, time.min) + timedelta(minutes=minute)
+
+
+@router.get("/api/next-available")
+async def next_available(service: str, after: str = None, limit: int = 5, db: AsyncSession = Depends(get_db)):
+    """Первые `limit` свободных стартов услуги начиная с `after` (по умолчанию — сейчас)."""
+    if service not in SERVICES:
+        raise HTTPException(404, "Unbekannter Service")
+    now = datetime.now()
+    try:
+        not_before = max(datetime.fromisoformat(after), now) if after else now
+    except ValueError:
+        raise HTTPException(400, "Ungültiges Datum")
+    limit = max(1, min(limit, NEXT_AVAILABLE_MAX))
+
+    # только будни — выходные страница бронирования не принимает
+    last = not_before.date() + timedelta(days=NEXT_AVAILABLE_DAYS - 1)
+    days = [d for d in (not_before.date() + timedelta(days=i) for i in range(NEXT_AVAILABLE_DAYS))
+            if d.weekday() < 5]
+    starts = []
+    async for start in free_starts_ahead(db, service, not_before, days):
+        starts.append(start.isoformat())
+        if len(starts) == limit:
+            break
+    return {
+        "service": service,
+        "duration": SERVICES[service]["duration"],
+        "starts": starts,
+        "searched_until": last.isoformat()
+    }
+
+
+@router.get("/api/busy-slots")
+async def busy_slots(request: Request, date: str, db: AsyncSession = Depends(get_db)):
+    """
+    date: YYYY-MM-DD
+    """
+    day_start = datetime.combine(parse_day(date), time.min)
+    day_end = day_start + timedelta(days=1)
+
+    async def build():
+        bookings = (await db.execute(
+            select(Booking).where(
+                Booking.status.in_(BUSY_STATUSES),
+                Booking.start_time >= day_start,
+                Booking.start_time < day_end
+            )
+        )).scalars().all()
+        return [
+            {
+                "start": b.start_time.isoformat(),
+                "end": b.end_time.isoformat()
+            }
+            for b in bookings
+        ]
+
+    return await cached_day_response(request, day_start.date(), ("busy",), build)
+
+
+def new_booking(data: dict, service_key: str, start: datetime, end: datetime, resources,
+                status: str = "confirmed") -> Booking:
+    booking = Booking(
+        name=data.get("name"),
+        phone=data.get("phone"),
+        email=data.get("email"),
+        service=service_key,
+        start_time=start,
+        end_time=end,
+        status=status,
+    )
+    # Конкурирующая бронь того же ресурса на те же (day, slot) упадёт на
+    # первичном ключе slot_reservations.
+    booking.reservations = [
+        SlotReservation(day=day, resource=resource, slot=slot)
+        for resource in resources
+        for day, slot in slot_keys(start, end, GRID.step)
     ]
+    return booking
+
+
+FIELD_LABELS = {"name": "Name", "phone": "Telefon", "email": "E-Mail", "service": "Service", "start_time": "Startzeit"}
+CONTACT_FIELDS = ("name", "phone", "email")
 
 
-@app.post("/api/book")
-async def book(data: dict, background_tasks: BackgroundTasks):
-    service = SERVICES[data["service"]]
-    start = datetime.fromisoformat(data["start_time"])
+def require_fields(data: dict, *names):
+    """400 до любых запросов к БД, а не KeyError (500) где-то в середине обработчика."""
+    missing = [FIELD_LABELS[name] for name in names if not data.get(name)]
+    if missing:
+        raise HTTPException(400, f"{', '.join(missing)} erforderlich")
+
+
+def booking_interval(service_key: str, start_time: str):
+    """(service, start, end) заявки; 400, если услуга неизвестна или время не подходит."""
+    if service_key not in SERVICES:
+        raise HTTPException(400, "Unbekannter Service")
+    service = SERVICES[service_key]
+    try:
+        start = datetime.fromisoformat(start_time)
+    except (TypeError, ValueError):
+        raise HTTPException(400, "Ungültiges Datum")
     end = start + timedelta(minutes=service["duration"])
 
     if start < datetime.now():
         raise HTTPException(400, "Termin liegt in der Vergangenheit")
     if start.time() < WORK_START or end.time() > WORK_END:
         raise HTTPException(400, "Außerhalb der Arbeitszeiten")
+    return service, start, end
 
-    db = SessionLocal()
-    overlap = db.query(Booking).filter(
-        Booking.status == "confirmed",
-        Booking.start_time < end,
-        Booking.end_time > start
-    ).first()
-    if overlap:
-        db.close()
-        raise HTTPException(400, "Zeit bereits belegt")
 
-    booking = Booking(
-        name=data["name"],
-        phone=data["phone"],
-        email=data["email"],
-        service=data["service"],
-        start_time=start,
-        end_time=end,
-        cancel_token=str(uuid.uuid4())
-    )
-    db.add(booking)
-    db.commit()
-    db.refresh(booking)
-    db.close()
+def admin_emails() -> list:
+    return [e.strip() for e in get_settings().ADMIN_EMAILS.split(",")]
+
+
+# уведомления администратору — сводкой раз в окно, срочные сразу
+admin_digest = AdminDigest(AsyncSessionLocal, admin_emails)
 
-    # Подготовка email клиенту
+
+def enqueue_booking_emails(db: AsyncSession, data: dict, service: dict, booking: Booking):
+    """Письма клиенту и администратору — в outbox той же транзакцией."""
+    start = booking.start_time
     html_body = render_booking_email(
         name=data["name"],
         service_name=service["name"],
         start=start,
-        cancel_token=booking.cancel_token
-    )
-    message_client = MessageSchema(
-        subject="Bestätigung Ihrer Buchung",
-        recipients=[data["email"]],
-        body=html_body,
-        subtype="html"
+        cancel_token=cancel_token_for(booking)
     )
-
-    # Подготовка email администратору
-    admin_emails = [e.strip() for e in settings.ADMIN_EMAILS.split(",")]
+    enqueue_email(db, [data["email"]], "Bestätigung Ihrer Buchung", html_body)
 
     html_body_admin = f"""
     <html>
@@ -203,122 +503,734 @@ async def book(data: dict, background_tasks: BackgroundTasks):
     </body>
     </html>
     """
-    message_admin = MessageSchema(
-        subject="Neue Buchung eingegangen",
-        recipients=admin_emails,
-        body=html_body_admin,
-        subtype="html"
+    admin_digest.notify(
+        db, "booking", start,
+        summary=f"{start.strftime('%d.%m.%Y %H:%M')} – {service['name']} – {data['name']}, {data['phone']}",
+        subject="Neue Buchung eingegangen", body=html_body_admin
     )
 
-    fm = FastMail(conf)
 
-    # Отправка email в фоне
-    background_tasks.add_task(send_email, fm, message_client)
-    background_tasks.add_task(send_email, fm, message_admin)
+def minute_of_day(moment: datetime) -> int:
+    return moment.hour * 60 + moment.minute
+
+
+async def publish_slot_change(db: AsyncSession, kind: str, start: datetime, end: datetime):
+    """
+    Дифф для открытых страниц этого дня: свободные старты каждой услуги в
+    окне (from, to), которое могла затронуть бронь [start, end).
+    """
+    day = start.date()
+    if not slot_events.subscribers(day):
+        return
+    schedule = await schedule_index.day(db, day)
+    lo = minute_of_day(start) - MAX_DURATION // timedelta(minutes=1)
+    hi = minute_of_day(end)
+    now = datetime.now()
+    free = {}
+    for key, service in SERVICES.items():
+        pools = schedule.pools(GRID, day, service["requires"])
+        free[key] = [m for m in GRID.free_starts_for(day, pools, service["duration"], now) if lo < m < hi]
+    slot_events.publish(day, {
+        "type": kind,
+        "date": day.isoformat(),
+        "start": minute_of_day(start),
+        "end": hi,
+        "from": lo,
+        "to": hi,
+        "free": free
+    })
+
+
+@router.get("/api/slots/stream")
+async def slots_stream(date: str):
+    """
+    SSE: события taken/freed для дня date (YYYY-MM-DD).
+    Клиент заменяет свои старты в окне (from, to) на free[service];
+    reset — очередь переполнилась, нужно перечитать /api/availability.
+    """
+    day = parse_day(date)
+    if slot_events.total() >= slot_events.max_subscribers:
+        raise HTTPException(503, "Zu viele Verbindungen", headers={"Retry-After": "30"})
+
+    async def events():
+        sub = slot_events.subscribe(day)
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while True:
+                event = await sub.get(SSE_HEARTBEAT)
+                if event is None:
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            slot_events.unsubscribe(sub)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def place_booking(db: AsyncSession, data: dict, service_key: str, start: datetime, end: datetime,
+                        before_commit, status: str = "confirmed") -> Booking:
+    """
+    Выбрать ресурсы, записать бронь и её слоты, вызвать before_commit(booking)
+    в той же транзакции и закоммитить; затем обновить индекс, кэш и SSE.
+    """
+    # Ресурсы выбираем по индексу в памяти; БД всё равно проверяет их на
+    # первичном ключе slot_reservations. Индекс мог устареть (другой процесс,
+    # параллельная бронь) — тогда перечитываем день из БД и пробуем ещё раз.
+    day = start.date()
+    for attempt in range(2):
+        schedule = await schedule_index.day(db, day)
+        resources = schedule.allocate(SERVICES[service_key]["requires"], start, end)
+        if resources is None:
+            if attempt == 0:
+                schedule_index.invalidate(day)
+                continue
+            raise HTTPException(400, "Zeit bereits belegt")
+
+        booking = new_booking(data, service_key, start, end, resources, status)
+        db.add(booking)
+        record_change(db, day)
+        try:
+            # id нужен для подписи ссылки отмены и для удержания
+            await db.flush()
+            await before_commit(booking)
+            await db.commit()
+            break
+        except IntegrityError:
+            await db.rollback()
+            schedule_index.invalidate(day)
+            if attempt == 1:
+                raise HTTPException(400, "Zeit bereits belegt")
+    schedule_index.add(day, booking.id, resources, start, end)
+    availability_cache.invalidate(day)
+    await publish_slot_change(db, "taken", start, end)
+    return booking
+
+
+async def confirm_hold(db: AsyncSession, token: str, data: dict, start: datetime):
+    """
+    Удержание того же термина и услуги -> подтверждённая бронь без нового
+    выбора ресурсов. None, если удержания нет; просроченное или чужое
+    (другой термин) снимаем, и бронь идёт обычным путём.
+    """
+    hold = await find_hold(db, token)
+    if hold is None:
+        return None
+    booking = await db.get(Booking, hold.booking_id)
+    if (booking is None or booking.status != "held" or hold.expires_at <= datetime.now()
+            or booking.service != data["service"] or booking.start_time != start):
+        await forget_holds(db, await release_hold(db, token))
+        return None
+
+    # условный UPDATE: уборщик мог снять удержание в этот момент
+    result = await db.execute(
+        update(Booking)
+        .where(Booking.id == booking.id, Booking.status == "held")
+        .values(status="confirmed", name=data["name"], phone=data["phone"], email=data["email"])
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        return None
+    await db.execute(delete(SlotHold).where(SlotHold.booking_id == booking.id))
+    await db.refresh(booking)
+    await count_booking(db, booking)
+    enqueue_booking_emails(db, data, SERVICES[booking.service], booking)
+    record_change(db, start.date())
+    await db.commit()
+    availability_cache.invalidate(start.date())
+    return booking
+
+
+@router.post("/api/book", dependencies=[Depends(admission("book"))])
+async def book(data: dict, db: AsyncSession = Depends(get_db)):
+    require_fields(data, "service", "start_time", *CONTACT_FIELDS)
+    service, start, end = booking_interval(data["service"], data["start_time"])
+
+    booking = None
+    if data.get("hold_token"):
+        booking = await confirm_hold(db, data["hold_token"], data, start)
+    if booking is None:
+        async def before_commit(booking):
+            await count_booking(db, booking)
+            enqueue_booking_emails(db, data, service, booking)
+
+        booking = await place_booking(db, data, data["service"], start, end, before_commit)
 
     # Возвращаем ответ сразу, не дожидаясь отправки писем
-    return {"ok": True, "cancel_token": booking.cancel_token}
+    get_outbox_worker().wake()
+    return {"ok": True, "cancel_token": cancel_token_for(booking)}
+
+
+# ================== HOLDS ==================
+def record_released(db: AsyncSession, released):
+    record_change(db, *{start.date() for _, start, _ in released})
+
+
+async def forget_released(released):
+    """После коммита снятия удержаний: индекс, кэш и SSE."""
+    async with AsyncSessionLocal() as db:
+        for booking_id, start, end in released:
+            schedule_index.remove(start.date(), booking_id)
+            availability_cache.invalidate(start.date())
+            await publish_slot_change(db, "freed", start, end)
+
 
+async def forget_holds(db: AsyncSession, released):
+    """Снятие удержаний в транзакции запроса: записать изменение, закоммитить, обновить кэши."""
+    if released:
+        record_released(db, released)
+    await db.commit()
+    if released:
+        await forget_released(released)
 
-async def send_email(fm: FastMail, message: MessageSchema):
+
+hold_sweeper = HoldSweeper(AsyncSessionLocal, record_released, forget_released)
+
+# сессия для лимита удержаний; не IP — за NAT и прокси один адрес у многих клиентов
+HOLD_COOKIE = "hold_session"
+
+
+def hold_session(request: Request) -> str:
+    session = request.cookies.get(HOLD_COOKIE)
+    return session if session and len(session) <= 64 else secrets.token_urlsafe(16)
+
+
+@router.post("/api/hold", dependencies=[Depends(admission("hold"))])
+async def hold_slot(data: dict, request: Request, response: Response, db: AsyncSession = Depends(get_db)):
+    """
+    Удержать термин на HOLD_TTL секунд, пока клиент заполняет форму.
+    release: токен прежнего удержания этого клиента (выбрал другое время).
+    Сверх HOLDS_PER_CLIENT на сессию (cookie) самые старые удержания снимаются.
+    """
+    require_fields(data, "service", "start_time")
+    service, start, end = booking_interval(data["service"], data["start_time"])
+    session = hold_session(request)
+    response.set_cookie(HOLD_COOKIE, session, httponly=True, samesite="lax")
+    released = await release_client_holds(db, session, keep=HOLDS_PER_CLIENT - 1)
+    if data.get("release"):
+        released += await release_hold(db, data["release"])
+    await forget_holds(db, released)
+
+    token = secrets.token_urlsafe(16)
+    expires_at = datetime.now() + timedelta(seconds=HOLD_TTL)
+
+    async def before_commit(booking):
+        db.add(SlotHold(booking_id=booking.id, token=token, expires_at=expires_at, client=session))
+
+    booking = await place_booking(db, {}, data["service"], start, end, before_commit, status="held")
+    hold_sweeper.push(expires_at, booking.id)
+    return {"hold_token": token, "expires_at": expires_at.isoformat(), "ttl": HOLD_TTL}
+
+
+@router.delete("/api/hold/{token}")
+async def release_slot_hold(token: str, db: AsyncSession = Depends(get_db)):
+    await forget_holds(db, await release_hold(db, token))
+    return {"ok": True}
+
+
+BATCH_MAX = 50
+
+
+def render_batch_email(name: str, bookings) -> str:
+    rows = "".join(
+        f"""
+        <tr>
+            <td>{b.start_time.strftime('%d.%m.%Y %H:%M')}</td>
+            <td>{SERVICES[b.service]['name']}</td>
+            <td><a href="{get_settings().DOMAIN}/cancel/{cancel_token_for(b)}">Stornieren</a></td>
+        </tr>"""
+        for b in bookings
+    )
+    return f"""
+    <html>
+    <body>
+        <h2>Hallo {name},</h2>
+        <p>Ihre {len(bookings)} Buchungen wurden erfolgreich bestätigt:</p>
+        <table cellpadding="6">{rows}
+        </table>
+        <hr>
+        <p>Vielen Dank für Ihre Buchung!</p>
+    </body>
+    </html>
+    """
+
+
+@router.post("/api/book/batch", dependencies=[Depends(admission("book"))])
+async def book_batch(data: dict, db: AsyncSession = Depends(get_db)):
+    """
+    Бронь для автопарка: {"name", "phone", "email", "items": [{"service", "start_time"}, ...]}.
+
+    Все дни читаются одним запросом, заявки проверяются друг против друга
+    в памяти, и всё сохраняется одной транзакцией — либо все, либо ничего.
+    Письма: одно общее клиенту и одно администратору.
+    """
+    require_fields(data, *CONTACT_FIELDS)
+    items = data.get("items") or []
+    if not isinstance(items, list) or not 0 < len(items) <= BATCH_MAX:
+        raise HTTPException(400, f"1 bis {BATCH_MAX} Fahrzeuge pro Buchung")
+
+    wanted = []
+    for number, item in enumerate(items, 1):
+        try:
+            wanted.append((item["service"], *booking_interval(item["service"], item["start_time"])))
+        except HTTPException as e:
+            raise HTTPException(400, f"Fahrzeug {number}: {e.detail}")
+        except (KeyError, TypeError):
+            raise HTTPException(400, f"Fahrzeug {number}: Service und Startzeit erforderlich")
+
+    # свежие расписания, не из индекса: занятые заявками интервалы добавляем
+    # прямо в них, чтобы следующие заявки их видели
+    schedules = await schedule_index.load(db, {start.date() for _, _, start, _ in wanted})
+    plan = []
+    for number, (key, service, start, end) in enumerate(wanted, 1):
+        schedule = schedules[start.date()]
+        resources = schedule.allocate(service["requires"], start, end)
+        if resources is None:
+            raise HTTPException(400, f"Fahrzeug {number}: Zeit bereits belegt")
+        schedule.add(-number, resources, start, end)
+        plan.append((key, start, end, resources))
+
+    bookings = [new_booking(data, key, start, end, resources) for key, start, end, resources in plan]
+    db.add_all(bookings)
     try:
-        await fm.send_message(message)
-    except Exception as e:
-        print(f"Ошибка при отправке email: {e}")
+        await db.flush()
+        for booking in bookings:
+            await count_booking(db, booking)
+    except IntegrityError:
+        await db.rollback()
+        schedule_index.invalidate(*{start.date() for _, start, _, _ in plan})
+        raise HTTPException(400, "Zeit bereits belegt")
+
+    enqueue_email(db, [data["email"]], "Bestätigung Ihrer Buchungen", render_batch_email(data["name"], bookings))
+    lines = "".join(
+        f"<li>{b.start_time.strftime('%d.%m.%Y %H:%M')} – {SERVICES[b.service]['name']}</li>" for b in bookings
+    )
+    html_body_admin = f"""
+    <html>
+    <body>
+        <h2>Neue Sammelbuchung</h2>
+        <p>Name: {data['name']}</p>
+        <p>Telefon: {data['phone']}</p>
+        <p>Email: {data['email']}</p>
+        <ul>{lines}</ul>
+    </body>
+    </html>
+    """
+    first = min(b.start_time for b in bookings)
+    admin_digest.notify(
+        db, "booking", first,
+        summary=f"{first.strftime('%d.%m.%Y %H:%M')} – Sammelbuchung ({len(bookings)} Fahrzeuge) – "
+                f"{data['name']}, {data['phone']}",
+        subject=f"Neue Sammelbuchung ({len(bookings)} Fahrzeuge)", body=html_body_admin
+    )
+
+    days = {start.date() for _, start, _, _ in plan}
+    record_change(db, *days)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        schedule_index.invalidate(*days)
+        raise HTTPException(400, "Zeit bereits belegt")
+    for booking, (_, start, end, resources) in zip(bookings, plan):
+        schedule_index.add(start.date(), booking.id, resources, start, end)
+    availability_cache.invalidate(*days)
+    for _, start, end, _ in plan:
+        await publish_slot_change(db, "taken", start, end)
+
+    get_outbox_worker().wake()
+    return {
+        "ok": True,
+        "bookings": [
+            {"service": b.service, "start_time": b.start_time.isoformat(), "cancel_token": cancel_token_for(b)}
+            for b in bookings
+        ]
+    }
+
+
+async def release_slots(db: AsyncSession, booking_id: int):
+    await db.execute(delete(SlotReservation).where(SlotReservation.booking_id == booking_id))
+
+
+async def mark_canceled(db: AsyncSession, booking: Booking):
+    """
+    Условный UPDATE -> canceled и освобождение слотов. Прежний статус или None,
+    если бронь уже отменил параллельный запрос (двойной клик, сканер ссылок):
+    тогда статистику, SSE и уведомления не трогаем.
+    """
+    old_status = booking.status
+    result = await db.execute(
+        update(Booking)
+        .where(Booking.id == booking.id, Booking.status == old_status)
+        .values(status="canceled")
+    )
+    if result.rowcount != 1:
+        # писать нечего; откат сделает get_db (rollback здесь сбросил бы поля брони для страницы)
+        return None
+    await release_slots(db, booking.id)
+    return old_status
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics(db: AsyncSession = Depends(get_db)):
+    # глубина очереди считается при опросе, а не на каждой записи
+    pending = (await db.execute(
+        select(OutboxMessage.channel, func.count())
+        .where(OutboxMessage.status == "pending")
+        .group_by(OutboxMessage.channel)
+    )).all()
+    for channel in ("email", "whatsapp"):
+        outbox_pending.set(0, channel=channel)
+    for channel, count in pending:
+        outbox_pending.set(count, channel=channel)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 
 # ================== PAGES ==================
-@app.get("/", response_class=HTMLResponse)
-def index():
-    return open(os.path.join(BASE_DIR, "..", "frontend", "index.html"), encoding="utf-8").read()
+@router.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    return get_assets().page_response(request, "index.html")
 
-@app.get("/success", response_class=HTMLResponse)
-def success():
-    return open(os.path.join(BASE_DIR, "..", "frontend", "success.html"), encoding="utf-8").read()
+@router.get("/success", response_class=HTMLResponse)
+async def success(request: Request):
+    return get_assets().page_response(request, "success.html")
 
-@app.get("/admin", response_class=HTMLResponse)
-def admin():
-    return open(os.path.join(BASE_DIR, "..", "frontend", "admin.html"), encoding="utf-8").read()
+@router.get("/admin", response_class=HTMLResponse)
+async def admin(request: Request):
+    return get_assets().page_response(request, "admin.html")
 
-@app.post("/admin/login")
+@router.post("/admin/login", dependencies=[Depends(admission("login"))])
 def admin_login(user: str = Form(...), password: str = Form(...)):
+    settings = get_settings()
     if user == settings.ADMIN_USER and password == settings.ADMIN_PASS:
         return {"ok": True}
     raise HTTPException(401)
 
 
-@app.get("/api/admin/bookings")
-def admin_bookings():
-    db = SessionLocal()
-    data = db.query(Booking).all()
-    db.close()
-    result = []
-    for b in data:
-        service_name = SERVICES.get(b.service, {"name": b.service})["name"]
-        result.append({
-            "id": b.id,
-            "name": b.name,
-            "phone": b.phone,
-            "service": service_name,
-            "date": b.start_time.strftime("%d.%m.%Y") if b.start_time else "–",
-            "time": b.start_time.strftime("%H:%M") if b.start_time else "–",
-            "status": b.status
-        })
-    return result
-
-@app.post("/api/admin/cancel/{id}")
-def admin_cancel(id: int):
-    db = SessionLocal()
-    b = db.query(Booking).get(id)
+ADMIN_PAGE_SIZE = 100
+ADMIN_PAGE_MAX = 500
+EXPORT_COLUMNS = ["id", "name", "phone", "email", "service", "start_time", "end_time", "status"]
+EXPORT_CHUNK = 500
+STATS_DEFAULT_DAYS = 30
+STATS_MAX_DAYS = 366
+# минуты боксов и мест для салона за рабочий день — знаменатель загрузки
+STATION_MINUTES = GRID.n_slots * GRID.step * (RESOURCE_COUNTS["bay"] + RESOURCE_COUNTS["interior"])
+
+
+def encode_cursor(b: Booking) -> str:
+    raw = f"{b.start_time.isoformat()}|{b.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        start, id_ = raw.split("|")
+        return datetime.fromisoformat(start), int(id_)
+    except ValueError:
+        raise HTTPException(400, "Ungültiger Cursor")
+
+
+def booking_filters(date_from: str = None, date_to: str = None, status: str = None, service: str = None,
+                    model=Booking):
+    """WHERE-условия админки для bookings или bookings_archive; даты YYYY-MM-DD, date_to включительно."""
+    conditions = []
+    if date_from:
+        conditions.append(model.start_time >= datetime.combine(parse_day(date_from), time.min))
+    if date_to:
+        conditions.append(model.start_time < datetime.combine(parse_day(date_to) + timedelta(days=1), time.min))
+    if status:
+        conditions.append(model.status == status)
+    else:
+        # удержания — ещё не брони
+        conditions.append(model.status != "held")
+    if service:
+        conditions.append(model.service == service)
+    return conditions
+
+
+def admin_row(b: Booking) -> dict:
+    service_name = SERVICES.get(b.service, {"name": b.service})["name"]
+    return {
+        "id": b.id,
+        "name": b.name,
+        "phone": b.phone,
+        "service": service_name,
+        "date": b.start_time.strftime("%d.%m.%Y") if b.start_time else "–",
+        "time": b.start_time.strftime("%H:%M") if b.start_time else "–",
+        "status": b.status,
+        "archived": isinstance(b, ArchivedBooking)
+    }
+
+
+@router.get("/api/admin/bookings")
+async def admin_bookings(response: Response, cursor: str = None, limit: int = ADMIN_PAGE_SIZE,
+                         date_from: str = None, date_to: str = None,
+                         status: str = None, service: str = None,
+                         db: AsyncSession = Depends(get_db)):
+    """
+    Keyset-пагинация по (start_time, id): следующая страница —
+    ?cursor=<X-Next-Cursor из предыдущего ответа>.
+    Архив читается так же: по странице из каждой таблицы (обе по индексу
+    (start_time, id)), затем слияние — id при переносе сохраняется.
+    """
+    limit = max(1, min(limit, ADMIN_PAGE_MAX))
+    after = decode_cursor(cursor) if cursor else None
+    data = []
+    for model in (Booking, ArchivedBooking):
+        query = select(model).where(*booking_filters(date_from, date_to, status, service, model))
+        if after:
+            query = query.where(tuple_(model.start_time, model.id) > after)
+        query = query.order_by(model.start_time, model.id).limit(limit + 1)
+        data += (await db.execute(query)).scalars().all()
+    data.sort(key=lambda b: (b.start_time, b.id))
+
+    if len(data) > limit:
+        data = data[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(data[-1])
+    return [admin_row(b) for b in data]
+
+
+def _csv_line(row) -> str:
+    buf = io.StringIO()
+    csv.writer(buf).writerow(v.isoformat() if isinstance(v, datetime) else v for v in row)
+    return buf.getvalue()
+
+
+def _ndjson_line(row) -> str:
+    return json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False, default=datetime.isoformat) + "\n"
+
+
+EXPORT_FORMATTERS = {"csv": _csv_line, "ndjson": _ndjson_line}
+
+
+@router.get("/api/admin/bookings/export")
+async def admin_bookings_export(format: str = "csv", date_from: str = None, date_to: str = None,
+                                status: str = None, service: str = None):
+    """Выгрузка CSV/NDJSON: строки читаются серверным курсором и сразу уходят клиенту."""
+    if format not in ("csv", "ndjson"):
+        raise HTTPException(400, "Format: csv oder ndjson")
+    both = union_all(*[
+        select(*[getattr(model, c) for c in EXPORT_COLUMNS])
+        .where(*booking_filters(date_from, date_to, status, service, model))
+        for model in (Booking, ArchivedBooking)
+    ]).subquery()
+    query = (
+        select(*[both.c[c] for c in EXPORT_COLUMNS])
+        .order_by(both.c.start_time, both.c.id)
+        .execution_options(yield_per=EXPORT_CHUNK)
+    )
+
+    async def rows():
+        # своя сессия: живёт, пока идёт поток, а не до конца обработчика
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(query)
+            if format == "csv":
+                yield ",".join(EXPORT_COLUMNS) + "\r\n"
+            async for chunk in result.partitions():
+                yield "".join(EXPORT_FORMATTERS[format](row) for row in chunk)
+
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    filename = f"bookings.{format}"
+    return StreamingResponse(rows(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@router.get("/api/admin/stats")
+async def admin_stats(date_from: str = Query(None, alias="from"), date_to: str = Query(None, alias="to"),
+                      db: AsyncSession = Depends(get_db)):
+    """Брони, занятые минуты и выручка по дням и услугам — из daily_stats, без чтения броней."""
+    last = parse_day(date_to) if date_to else datetime.now().date()
+    first = parse_day(date_from) if date_from else last - timedelta(days=STATS_DEFAULT_DAYS - 1)
+    if first > last or (last - first).days >= STATS_MAX_DAYS:
+        raise HTTPException(400, "Ungültiger Zeitraum")
+
+    rows = (await db.execute(
+        select(DailyStat)
+        .where(DailyStat.day >= first, DailyStat.day <= last)
+        .order_by(DailyStat.day, DailyStat.service)
+    )).scalars().all()
+
+    counters = ("bookings", "canceled", "minutes", "revenue")
+    days, total = {}, dict.fromkeys(counters, 0)
+    for row in rows:
+        day = days.setdefault(row.day, {"date": row.day.isoformat(), **dict.fromkeys(counters, 0), "services": {}})
+        values = {name: getattr(row, name) for name in counters}
+        day["services"][row.service] = {**values, "revenue": values["revenue"] / 100}
+        for name in counters:
+            day[name] += values[name]
+            total[name] += values[name]
+    for day in days.values():
+        day["utilization"] = round(day["minutes"] / STATION_MINUTES, 3) if STATION_MINUTES else 0
+        day["revenue"] /= 100
+    total["revenue"] /= 100
+    return {"from": first.isoformat(), "to": last.isoformat(), "days": list(days.values()), "total": total}
+
+
+@router.post("/api/admin/cancel/{id}")
+async def admin_cancel(id: int, db: AsyncSession = Depends(get_db)):
+    b = await db.get(Booking, id)
     if not b:
         raise HTTPException(404)
-    b.status = "canceled"
-    db.commit()
-    db.close()
+    if b.status == "held":
+        # удержание ещё не бронь: снимаем его, как по истечении, — без отмены в статистике
+        await forget_holds(db, await release_booking_hold(db, b.id))
+        return {"ok": True}
+    old_status = None if b.status == "canceled" else await mark_canceled(db, b)
+    if old_status is None:
+        return {"ok": True}
+    await count_booking(db, b, old_status=old_status)
+    record_change(db, b.start_time.date())
+    await db.commit()
+    schedule_index.remove(b.start_time.date(), b.id)
+    availability_cache.invalidate(b.start_time.date())
+    await publish_slot_change(db, "freed", b.start_time, b.end_time)
     return {"ok": True}
 
 
 
-@app.get("/cancel", response_class=HTMLResponse)
-def cancel():
-    return open(os.path.join(BASE_DIR, "..", "frontend", "cancel.html"), encoding="utf-8").read()
+@router.get("/cancel", response_class=HTMLResponse)
+async def cancel(request: Request):
+    return get_assets().page_response(request, "cancel.html")
+
+@lru_cache
+def get_templates() -> Jinja2Templates:
+    return Jinja2Templates(directory=os.path.join(BASE_DIR, "..", "frontend"))
+
+
+def enqueue_cancel_notice(db: AsyncSession, booking: Booking):
+    """Отмена клиентом по ссылке — администратору (в сводке или сразу, если термин скоро)."""
+    start = booking.start_time
+    service_name = SERVICES.get(booking.service, {"name": booking.service})["name"]
+    html_body_admin = f"""
+    <html>
+    <body>
+        <h2>Buchung storniert</h2>
+        <p>Service: {service_name}</p>
+        <p>Name: {booking.name}</p>
+        <p>Telefon: {booking.phone}</p>
+        <p>Datum & Uhrzeit: {start.strftime('%d.%m.%Y um %H:%M')}</p>
+    </body>
+    </html>
+    """
+    admin_digest.notify(
+        db, "cancel", start,
+        summary=f"{start.strftime('%d.%m.%Y %H:%M')} – {service_name} – {booking.name}, {booking.phone}",
+        subject="Buchung storniert", body=html_body_admin
+    )
 
-templates = Jinja2Templates(directory=os.path.join(BASE_DIR, "..", "frontend"))
 
+def cancel_page(request: Request, status: str, title: str, booking=None):
+    context = {"status": status, "service": "–", "date": "–", "time": "–", "title": title}
+    if booking is not None:
+        start = booking.start_time
+        context.update(service=SERVICES.get(booking.service, {"name": booking.service})["name"],
+                       date=start.strftime("%d.%m.%Y"), time=start.strftime("%H:%M"))
+    return get_templates().TemplateResponse(request, "cancel.html", context)
 
-@app.get("/cancel/{token}", response_class=HTMLResponse)
-def cancel_booking(token: str, request: Request):
-    db = SessionLocal()
-    booking = db.query(Booking).filter(Booking.cancel_token == token).first()
+
+def rejected_cancel_link(status: str):
+    """Поддельная или просроченная ссылка: на статическую страницу из памяти, без БД и шаблона."""
+    return RedirectResponse(f"/cancel?status={status}", status_code=303)
+
+
+@router.get("/cancel/{token}", response_class=HTMLResponse, dependencies=[Depends(admission("cancel"))])
+async def cancel_booking(token: str, request: Request, db: AsyncSession = Depends(get_db)):
+    if is_signed(token):
+        # подпись и срок проверяются до любого запроса; бронь — по первичному ключу
+        verdict, booking_id, expires = verify_token(cancel_secret(), token, datetime.now().timestamp())
+        if verdict == INVALID:
+            return rejected_cancel_link("not_found")
+        if verdict == EXPIRED:
+            return rejected_cancel_link("expired")
+        booking = await db.get(Booking, booking_id)
+        archived = None if booking else await db.get(ArchivedBooking, booking_id)
+        # срок ссылки = начало её брони: чужая бронь под тем же id не совпадёт
+        row = booking or archived
+        if row and int(row.start_time.timestamp()) != expires:
+            return rejected_cancel_link("not_found")
+    elif get_settings().LEGACY_CANCEL_TOKENS:
+        # UUID-ссылки из писем до перехода на подписанные токены
+        booking = (await db.execute(
+            select(Booking).where(Booking.cancel_token == token)
+        )).scalars().first()
+        archived = None if booking else (await db.execute(
+            select(ArchivedBooking).where(ArchivedBooking.cancel_token == token)
+        )).scalars().first()
+    else:
+        return rejected_cancel_link("not_found")
 
     if not booking:
-        db.close()
-        return templates.TemplateResponse(
-            "cancel.html",
-            {"request": request, "status": "not_found", "service": "–", "date": "–", "time": "–", "title": "Buchung nicht gefunden"}
-        )
+        # бронь могла уже уйти в архив
+        if archived:
+            if archived.status == "canceled":
+                return cancel_page(request, "already_canceled", "Bereits storniert", archived)
+            return cancel_page(request, "expired", "Termin liegt in der Vergangenheit", archived)
+        return cancel_page(request, "not_found", "Buchung nicht gefunden")
 
     if booking.status == "canceled":
-        service_name = SERVICES.get(booking.service, {"name": booking.service})["name"]
-        start = booking.start_time
-        db.close()
-        return templates.TemplateResponse(
-            "cancel.html",
-            {"request": request, "status": "already_canceled", "service": service_name,
-             "date": start.strftime("%d.%m.%Y"), "time": start.strftime("%H:%M"),
-             "title": "Bereits storniert"}
-        )
+        return cancel_page(request, "already_canceled", "Bereits storniert", booking)
 
     # если не отменено — отменяем
-    booking.status = "canceled"
-    service_name = SERVICES.get(booking.service, {"name": booking.service})["name"]
+    old_status = await mark_canceled(db, booking)
+    if old_status is None:
+        return cancel_page(request, "already_canceled", "Bereits storniert", booking)
+    await count_booking(db, booking, old_status=old_status)
     start = booking.start_time
-    db.commit()
-    db.close()
-
-    return templates.TemplateResponse(
-        "cancel.html",
-        {"request": request, "status": "canceled", "service": service_name,
-         "date": start.strftime("%d.%m.%Y"), "time": start.strftime("%H:%M"),
-         "title": "Buchung storniert"}
-    )
\ No newline at end of file
+    record_change(db, start.date())
+    enqueue_cancel_notice(db, booking)
+    await db.commit()
+    schedule_index.remove(start.date(), booking.id)
+    availability_cache.invalidate(start.date())
+    await publish_slot_change(db, "freed", start, booking.end_time)
+    get_outbox_worker().wake()
+
+    return cancel_page(request, "canceled", "Buchung storniert", booking)
+
+
+# ================== APP FACTORY ==================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    # миграции синхронные — в потоке; при нескольких воркерах их выполняет один
+    await asyncio.to_thread(init_db, engine)
+    get_assets()
+    if settings.CACHE_SYNC:
+        await cache_sync.start()
+    if settings.ARCHIVE_WORKER:
+        await archive_worker.start()
+    if settings.OUTBOX_WORKER:
+        await get_outbox_worker().start()
+    await admin_digest.start()
+    await hold_sweeper.start()
+    yield
+    await hold_sweeper.stop()
+    # накопленная сводка уходит в outbox до остановки
+    await admin_digest.stop()
+    await cache_sync.stop()
+    await archive_worker.stop()
+    if settings.OUTBOX_WORKER:
+        await get_outbox_worker().stop()
+
+
+def create_app() -> FastAPI:
+    """
+    uvicorn backend.main:app --workers N
+    или uvicorn --factory backend.main:create_app
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Next-Cursor"],
+    )
+    app.add_middleware(MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
@@ -0,0 +1,255 @@
+"""
+Minimal Prometheus-style instrumentation.
+
+Counters, gauges and histograms live in REGISTRY and are rendered in the
+text exposition format by /metrics. MetricsMiddleware times every request
+(labelled by route template, not raw path), and `instrument_engine` hooks
+SQLAlchemy cursor events so each request knows how many queries it ran and
+which one was the slowest — that statement is named in the slow-request log.
+Event streams (SSE) are counted in their own gauge once the response starts
+and stay out of the latency histogram and the slow-request log.
+"""
+import bisect
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+
+log = logging.getLogger("carwash.slow")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        return tuple(labels.get(n, "") for n in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple, list] = {}  # key -> [counts per bucket..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def count(self, **labels) -> int:
+        series = self.series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def render(self):
+        lines = self.header()
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets, series):
+                cumulative += hits
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {series[-2]!r}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ================== HTTP ==================
+http_requests = Counter("http_requests_total", "HTTP requests by route and status", ["method", "route", "status"])
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+http_in_flight = Gauge("http_requests_in_flight", "Requests currently being served")
+# SSE-потоки открыты часами: считаем отдельно, не в in-flight и не в гистограмме задержек
+http_streams_open = Gauge("http_streams_open", "Event streams (text/event-stream) currently open", ["route"])
+
+# ================== DB ==================
+db_queries = Counter("db_queries_total", "SQL statements executed", ["route"])
+db_query_latency = Histogram("db_query_duration_seconds", "SQL statement latency", ["operation"])
+db_queries_per_request = Histogram("db_queries_per_request", "SQL statements per HTTP request", ["route"],
+                                   buckets=COUNT_BUCKETS)
+
+# ================== OUTBOX ==================
+outbox_pending = Gauge("outbox_pending_messages", "Notifications waiting for delivery", ["channel"])
+outbox_delivered = Counter("outbox_delivered_total", "Notification delivery attempts", ["channel", "result"])
+outbox_delivery_latency = Histogram("outbox_delivery_seconds", "Time from enqueue to successful delivery",
+                                    ["channel"], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600))
+
+# ================== ADMISSION ==================
+admission_rejected = Counter("admission_rejected_total", "Requests refused by rate limits and load shedding",
+                             ["route", "reason"])
+
+
+class RequestStats:
+    __slots__ = ("queries", "slowest", "slowest_sql")
+
+    def __init__(self):
+        self.queries = 0
+        self.slowest = 0.0
+        self.slowest_sql = ""
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+def instrument_engine(engine):
+    """Attach query timing hooks to a sync Engine (use async_engine.sync_engine for async)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started"].pop()
+        db_query_latency.observe(elapsed, operation=statement.split(None, 1)[0].upper())
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            if elapsed > stats.slowest:
+                stats.slowest = elapsed
+                stats.slowest_sql = statement
+
+
+def _is_event_stream(message) -> bool:
+    return any(name.lower() == b"content-type" and value.startswith(b"text/event-stream")
+               for name, value in message.get("headers", []))
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: no BaseHTTPMiddleware overhead, works with streaming responses."""
+
+    def __init__(self, app, slow_request_ms: Optional[float] = None):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = {"code": 500, "stream": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if _is_event_stream(message):
+                    status["stream"] = True
+                    http_in_flight.dec()
+                    http_streams_open.inc(route=getattr(scope.get("route"), "path", "unmatched"))
+            await send(message)
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        http_in_flight.inc()
+        began = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - began
+            current_request.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method=method, route=route, status=status["code"])
+            db_queries.inc(stats.queries, route=route)
+            db_queries_per_request.observe(stats.queries, route=route)
+            if status["stream"]:
+                http_streams_open.dec(route=route)
+            else:
+                http_in_flight.dec()
+                http_latency.observe(elapsed, method=method, route=route)
+                self.log_if_slow(method, route, elapsed, stats)
+
+    def log_if_slow(self, method: str, route: str, elapsed: float, stats: RequestStats):
+        threshold = SLOW_REQUEST_MS if self.slow_request_ms is None else self.slow_request_ms
+        if elapsed * 1000 >= threshold:
+            log.warning("slow request %s %s: %.1f ms, %d queries, slowest %.1f ms: %s",
+                        method, route, elapsed * 1000, stats.queries, stats.slowest * 1000,
+                        " ".join(stats.slowest_sql.split())[:500])
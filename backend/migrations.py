@@ -0,0 +1,190 @@
+"""
+Versioned schema migrations.
+
+Applied versions are recorded in `schema_version`; every migration must be
+idempotent so that databases created by `create_all` (which already have
+the current schema) can be stamped without errors.
+
+Run manually:  python -m backend.migrations
+"""
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, MetaData, Table, func, select, insert, inspect
+from sqlalchemy.schema import CreateTable
+from .database import engine as default_engine, Base
+
+try:
+    import fcntl
+except ImportError:  # не POSIX: без блокировки, запускайте один воркер на миграции
+    fcntl = None
+from .models import (Booking, ArchivedBooking, SlotReservation, OutboxMessage, CacheInvalidation, AdminEvent,
+                     DailyStat, SlotHold)
+from .availability import slot_keys
+from .scheduling import allocate_keys, requirements, resources_by_kind
+from .stats import rebuild as rebuild_stats
+
+_meta = MetaData()
+schema_version = Table(
+    "schema_version", _meta,
+    Column("version", Integer, primary_key=True),
+)
+
+
+def _create_table(model):
+    def migrate(conn):
+        model.__table__.create(conn, checkfirst=True)
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    return migrate
+
+
+def _booking_indexes(conn):
+    for index in Booking.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _slot_reservations(conn):
+    _create_table(SlotReservation)(conn)
+
+    bookings = Booking.__table__
+    kinds = resources_by_kind()
+    taken = set(conn.execute(select(SlotReservation.day, SlotReservation.resource, SlotReservation.slot)).all())
+    rows = conn.execute(
+        select(bookings.c.id, bookings.c.service, bookings.c.start_time, bookings.c.end_time)
+        .where(bookings.c.status == "confirmed")
+        .order_by(bookings.c.id)
+    ).all()
+    for booking_id, service, start, end in rows:
+        # уже пересекающиеся старые брони: первая занимает ресурс, остальные пропускаем
+        keys = slot_keys(start, end)
+        resources = allocate_keys(taken, requirements(service), keys, kinds)
+        if resources:
+            conn.execute(insert(SlotReservation.__table__), [
+                {"day": day, "resource": resource, "slot": slot, "booking_id": booking_id}
+                for resource in resources for day, slot in keys
+            ])
+
+
+def _resource_reservations(conn):
+    # ключ (day, slot) -> (day, resource, slot): первичный ключ не изменить
+    # ALTER'ом, поэтому пересоздаём таблицу и раздаём ресурсы заново
+    columns = {c["name"] for c in inspect(conn).get_columns("slot_reservations")}
+    if "resource" in columns:
+        return
+    SlotReservation.__table__.drop(conn)
+    _slot_reservations(conn)
+
+
+def _daily_stats(conn):
+    # сводка по уже существующим броням (и архиву) — дальше её ведут обработчики
+    _create_table(DailyStat)(conn)
+    rebuild_stats(conn)
+
+
+def _bookings_autoincrement(conn):
+    # id удалённых броней не должны переиспользоваться: архив хранит их под тем же id
+    if conn.dialect.name != "sqlite":
+        return
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type='table' AND name='bookings'").scalar()
+    if "AUTOINCREMENT" not in sql.upper():
+        # порядок из документации SQLite: новая таблица, копия, DROP старой, RENAME новой —
+        # тогда внешние ключи slot_reservations по-прежнему ссылаются на "bookings"
+        columns = ", ".join(c.name for c in Booking.__table__.columns)
+        create = str(CreateTable(Booking.__table__).compile(dialect=conn.dialect))
+        conn.exec_driver_sql(create.replace("CREATE TABLE bookings ", "CREATE TABLE bookings_new ", 1))
+        conn.exec_driver_sql(f"INSERT INTO bookings_new ({columns}) SELECT {columns} FROM bookings")
+        conn.exec_driver_sql("DROP TABLE bookings")
+        conn.exec_driver_sql("ALTER TABLE bookings_new RENAME TO bookings")
+        _booking_indexes(conn)
+    # счётчик — выше всех id, уже выданных когда-либо (в т.ч. ушедших в архив)
+    top = max(conn.execute(select(func.max(Booking.id))).scalar() or 0,
+              conn.execute(select(func.max(ArchivedBooking.id))).scalar() or 0)
+    seq = conn.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name='bookings'").scalar()
+    if seq is None:
+        conn.exec_driver_sql(f"INSERT INTO sqlite_sequence (name, seq) VALUES ('bookings', {int(top)})")
+    elif seq < top:
+        conn.exec_driver_sql(f"UPDATE sqlite_sequence SET seq = {int(top)} WHERE name='bookings'")
+
+
+def _slot_holds_client(conn):
+    columns = {c["name"] for c in inspect(conn).get_columns("slot_holds")}
+    if "client" not in columns:
+        conn.exec_driver_sql("ALTER TABLE slot_holds ADD COLUMN client VARCHAR")
+    _create_table(SlotHold)(conn)
+
+
+# (версия, функция) — только добавлять в конец
+MIGRATIONS = [
+    (1, _booking_indexes),
+    (2, _slot_reservations),
+    (3, _create_table(OutboxMessage)),
+    (4, _booking_indexes),
+    (5, _resource_reservations),
+    (6, _create_table(CacheInvalidation)),
+    (7, _create_table(ArchivedBooking)),
+    (8, _create_table(AdminEvent)),
+    (9, _daily_stats),
+    (10, _create_table(SlotHold)),
+    (11, _bookings_autoincrement),
+    (12, _slot_holds_client),
+]
+
+
+def current_version(conn) -> int:
+    versions = conn.execute(select(schema_version.c.version)).scalars().all()
+    return max(versions, default=0)
+
+
+def run_migrations(engine=None) -> int:
+    engine = engine or default_engine
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+        version = current_version(conn)
+        for number, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            migrate(conn)
+            conn.execute(insert(schema_version).values(version=number))
+            version = number
+    return version
+
+
+# ключ pg_advisory_lock для миграций (Postgres)
+MIGRATION_LOCK_ID = 8146001
+
+
+@contextmanager
+def migration_lock(engine):
+    """
+    Воркеры стартуют одновременно: схему обновляет один, остальные ждут,
+    а потом видят уже записанную версию.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as conn:
+            conn.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+            try:
+                yield
+            finally:
+                conn.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+        return
+    path = engine.url.database if engine.dialect.name == "sqlite" else None
+    if not path or path == ":memory:" or fcntl is None:
+        yield
+        return
+    with open(path + ".migrate.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def init_db(engine=None) -> int:
+    """create_all + миграции; вызывается из lifespan каждого воркера."""
+    engine = engine or default_engine
+    with migration_lock(engine):
+        Base.metadata.create_all(engine)
+        return run_migrations(engine)
+
+
+if __name__ == "__main__":
+    print(f"schema version: {init_db()}")
@@ -1,13 +1,164 @@
-from sqlalchemy import Column, Integer, String, DateTime
-from database import Base
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Index
+from sqlalchemy.orm import relationship
+from .database import Base
 
-class Booking(Base):
+class BookingFields:
+    """Columns shared by the hot `bookings` table and `bookings_archive`."""
+    name = Column(String)
+    phone = Column(String)
+    email = Column(String)
+    service = Column(String)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+    status = Column(String, default="confirmed")
+    cancel_token = Column(String, unique=True)
+
+
+class Booking(BookingFields, Base):
     __tablename__ = "bookings"
 
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, nullable=False)
-    phone = Column(String, nullable=False)
-    email = Column(String, nullable=False)
-    start_time = Column(DateTime, nullable=False)
-    end_time = Column(DateTime, nullable=False)
-    status = Column(String, default="confirmed")
+    id = Column(Integer, primary_key=True)
+
+    reservations = relationship("SlotReservation", cascade="all, delete-orphan")
+
+    # Горячие запросы: пересечение интервалов в book() и выборка дня в
+    # busy_slots()/availability() — всегда по status + одной из границ.
+    __table_args__ = (
+        Index("ix_bookings_status_start", "status", "start_time"),
+        Index("ix_bookings_status_end", "status", "end_time"),
+        # keyset-пагинация админки
+        Index("ix_bookings_start_id", "start_time", "id"),
+        # AUTOINCREMENT: без него SQLite отдаёт новой брони id удалённой
+        # (перенесённой в архив) — и ссылку отмены, и строку архива
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ArchivedBooking(BookingFields, Base):
+    """
+    Cold storage: past and canceled bookings moved out of `bookings` by
+    backend.archive, so the hot table stays as small as the live schedule.
+    """
+    __tablename__ = "bookings_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)  # тот же id, что был в bookings
+    archived_at = Column(DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_bookings_archive_start_id", "start_time", "id"),
+    )
+
+
+class SlotReservation(Base):
+    """
+    One row per grid step and resource occupied by a confirmed booking.
+
+    The primary key (day, resource, slot) makes the database reject a second
+    booking of the same bay or employee for the same step, so two concurrent
+    book() calls cannot both win.
+    """
+    __tablename__ = "slot_reservations"
+
+    day = Column(Date, primary_key=True)
+    resource = Column(String, primary_key=True)  # ключ из services.RESOURCES
+    slot = Column(Integer, primary_key=True)  # минуты от полуночи
+    booking_id = Column(Integer, ForeignKey("bookings.id", ondelete="CASCADE"), nullable=False, index=True)
+
+
+class DailyStat(Base):
+    """
+    Per-day, per-service totals for the admin dashboard.
+
+    Kept up to date in the same transaction as every booking and
+    cancellation (`stats.count_booking`), so reading a range touches one row
+    per day and service instead of every booking. Archiving does not touch
+    it; `python -m backend.stats` rebuilds it from both tables.
+    """
+    __tablename__ = "daily_stats"
+
+    day = Column(Date, primary_key=True)
+    service = Column(String, primary_key=True)
+    bookings = Column(Integer, nullable=False, default=0)  # подтверждённые
+    canceled = Column(Integer, nullable=False, default=0)
+    minutes = Column(Integer, nullable=False, default=0)   # занятые минуты подтверждённых
+    revenue = Column(Integer, nullable=False, default=0)   # в центах
+
+
+class SlotHold(Base):
+    """
+    Short-lived hold on a slot while the customer fills in the form.
+
+    The held interval is a Booking with status "held" and ordinary
+    slot_reservations rows, so the primary key keeps it exclusive and
+    availability shows it as busy in every worker. /api/book with the token
+    confirms that booking; expired holds are deleted by holds.HoldSweeper.
+    """
+    __tablename__ = "slot_holds"
+
+    booking_id = Column(Integer, ForeignKey("bookings.id", ondelete="CASCADE"), primary_key=True)
+    token = Column(String, nullable=False, unique=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    client = Column(String, index=True)  # сессия из cookie: holds.HOLDS_PER_CLIENT на сессию
+
+
+class OutboxMessage(Base):
+    """
+    Notification waiting for delivery.
+
+    Written in the same transaction as the booking change that caused it,
+    so a crash between commit and send never loses it; the outbox worker
+    delivers it later.
+    """
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    channel = Column(String, nullable=False, default="email")  # email | whatsapp
+    recipients = Column(String, nullable=False)  # через запятую
+    subject = Column(String)
+    body = Column(Text, nullable=False)
+    subtype = Column(String, default="html")
+    status = Column(String, nullable=False, default="pending")  # pending | sent | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    sent_at = Column(DateTime)
+    last_error = Column(String)
+
+    __table_args__ = (
+        Index("ix_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+
+class CacheInvalidation(Base):
+    """
+    Day touched by a committed booking change, for the other workers.
+
+    Written in the same transaction as the change; every worker polls new
+    rows and drops its per-process caches for those days.
+    """
+    __tablename__ = "cache_invalidations"
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    origin = Column(String, nullable=False)  # воркер, который записал изменение
+    created_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
+
+    # AUTOINCREMENT: id не переиспользуются после чистки старых строк,
+    # иначе воркер с last_id пропустил бы новые
+    __table_args__ = {"sqlite_autoincrement": True}
+
+
+class AdminEvent(Base):
+    """
+    Admin notification waiting for the next digest.
+
+    Written in the same transaction as the booking or cancellation; the
+    digest turns all events of a window into one summary email and deletes them.
+    """
+    __tablename__ = "admin_events"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)   # booking | cancel
+    summary = Column(Text, nullable=False)  # одна строка сводки (HTML)
+    created_at = Column(DateTime, nullable=False, default=datetime.now, index=True)
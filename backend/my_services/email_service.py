@@ -1,15 +1,70 @@
-import smtplib
+import time
 from email.message import EmailMessage
-import os
+from typing import List
 
-def send_email(to, subject, body):
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+
+# Держим одно SMTP-соединение открытым между пачками писем и закрываем,
+# если оно простаивает дольше SMTP_IDLE_TIMEOUT секунд.
+SMTP_IDLE_TIMEOUT = 60
+
+
+def build_message(conf: ConnectionConfig, recipients: List[str], subject: str,
+                  body: str, subtype: str = "html") -> EmailMessage:
     msg = EmailMessage()
-    msg["From"] = os.getenv("SMTP_USER")
-    msg["To"] = to
+    msg["From"] = conf.MAIL_FROM
+    msg["To"] = ", ".join(recipients)
     msg["Subject"] = subject
-    msg.set_content(body)
+    msg.set_content(body, subtype=subtype)
+    return msg
+
+
+class SmtpConnection:
+    """Long-lived SMTP session reused for every message of a batch."""
+
+    def __init__(self, conf: ConnectionConfig, idle_timeout: float = SMTP_IDLE_TIMEOUT):
+        self.conf = conf
+        self.idle_timeout = idle_timeout
+        self._smtp = None
+        self._last_used = 0.0
+        self.connects = 0
+
+    async def _connect(self):
+        conf = self.conf
+        self._smtp = aiosmtplib.SMTP(
+            hostname=conf.MAIL_SERVER,
+            port=conf.MAIL_PORT,
+            username=conf.MAIL_USERNAME if conf.USE_CREDENTIALS else None,
+            password=conf.MAIL_PASSWORD.get_secret_value() if conf.USE_CREDENTIALS else None,
+            use_tls=conf.MAIL_SSL_TLS,
+            start_tls=conf.MAIL_STARTTLS,
+            validate_certs=conf.VALIDATE_CERTS,
+            timeout=conf.TIMEOUT,
+        )
+        await self._smtp.connect()
+        self.connects += 1
+
+    async def send(self, message: EmailMessage):
+        if self._smtp is None or not self._smtp.is_connected:
+            await self._connect()
+        try:
+            await self._smtp.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:
+            # сервер закрыл простаивающее соединение — одна попытка переподключиться
+            await self._connect()
+            await self._smtp.send_message(message)
+        self._last_used = time.monotonic()
+
+    async def close_if_idle(self):
+        if self._smtp is not None and time.monotonic() - self._last_used > self.idle_timeout:
+            await self.close()
 
-    with smtplib.SMTP(os.getenv("SMTP_HOST"), 587) as s:
-        s.starttls()
-        s.login(os.getenv("SMTP_USER"), os.getenv("SMTP_PASS"))
-        s.send_message(msg)
+    async def close(self):
+        if self._smtp is None:
+            return
+        smtp, self._smtp = self._smtp, None
+        try:
+            await smtp.quit()
+        except aiosmtplib.SMTPException:
+            smtp.close()
@@ -1,14 +1,19 @@
+from functools import lru_cache
 from twilio.rest import Client
 import os
 
-def send_whatsapp(message: str):
-    account_sid = os.getenv("TWILIO_SID")
-    auth_token = os.getenv("TWILIO_AUTH_TOKEN")
+
+@lru_cache(maxsize=1)
+def get_client() -> Client:
+    # один HTTP-клиент Twilio на процесс вместо нового на каждое сообщение
+    return Client(os.getenv("TWILIO_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+
+
+def send_whatsapp(message: str, to: str = None):
     from_whatsapp = os.getenv("TWILIO_WHATSAPP_FROM")
-    to_whatsapp = os.getenv("ADMIN_WHATSAPP_TO")
+    to_whatsapp = to or os.getenv("ADMIN_WHATSAPP_TO")
 
-    client = Client(account_sid, auth_token)
-    client.messages.create(
+    get_client().messages.create(
         body=message,
         from_=f'whatsapp:{from_whatsapp}',
         to=f'whatsapp:{to_whatsapp}'
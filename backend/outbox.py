@@ -0,0 +1,159 @@
+"""
+Persistent notification outbox.
+
+Request handlers only insert OutboxMessage rows (in their own transaction)
+and wake the worker; OutboxWorker delivers them in batches over one
+long-lived SMTP connection and retries failures with exponential backoff.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import select, update
+
+from .models import OutboxMessage
+from .metrics import outbox_delivered, outbox_delivery_latency
+from .my_services.email_service import SmtpConnection, build_message
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = 10  # секунд, удваивается с каждой попыткой
+OUTBOX_BACKOFF_MAX = 3600
+# пока сообщение в работе, next_attempt_at сдвинут на это время — если
+# процесс упал посреди отправки, сообщение снова станет «due» после аренды
+OUTBOX_LEASE = 120
+
+log = logging.getLogger("carwash.outbox")
+
+
+def enqueue_email(db, recipients: List[str], subject: str, body: str, subtype: str = "html"):
+    db.add(OutboxMessage(
+        channel="email",
+        recipients=",".join(recipients),
+        subject=subject,
+        body=body,
+        subtype=subtype,
+    ))
+
+
+def enqueue_whatsapp(db, body: str, to: str = ""):
+    db.add(OutboxMessage(channel="whatsapp", recipients=to, body=body))
+
+
+def backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX))
+
+
+class OutboxWorker:
+    def __init__(self, session_factory, conf, batch_size: int = OUTBOX_BATCH_SIZE,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.session_factory = session_factory
+        self.conf = conf
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.smtp = SmtpConnection(conf)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.smtp.close()
+
+    async def _run(self):
+        while True:
+            try:
+                handled = await self.process_batch()
+            except Exception:
+                log.exception("ошибка обработки очереди")
+                handled = 0
+            if handled == self.batch_size:
+                continue
+            await self.smtp.close_if_idle()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _claim(self, db) -> List[OutboxMessage]:
+        now = datetime.now()
+        due = (await db.execute(
+            select(OutboxMessage)
+            .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+            .limit(self.batch_size)
+        )).scalars().all()
+
+        claimed = []
+        lease = now + timedelta(seconds=OUTBOX_LEASE)
+        for message in due:
+            # условный UPDATE: другой воркер мог забрать сообщение раньше
+            result = await db.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id == message.id,
+                       OutboxMessage.next_attempt_at == message.next_attempt_at)
+                .values(next_attempt_at=lease)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                claimed.append(message)
+        await db.commit()
+        return claimed
+
+    async def _deliver(self, message: OutboxMessage):
+        if message.channel == "whatsapp":
+            from .my_services.whatsapp_service import send_whatsapp
+            await asyncio.to_thread(send_whatsapp, message.body, message.recipients or None)
+            return
+        recipients = [r for r in message.recipients.split(",") if r]
+        await self.smtp.send(build_message(self.conf, recipients, message.subject, message.body, message.subtype))
+
+    async def process_batch(self) -> int:
+        """Deliver one batch of due messages; returns how many were handled."""
+        async with self.session_factory() as db:
+            claimed = await self._claim(db)
+            for message in claimed:
+                try:
+                    await self._deliver(message)
+                except Exception as e:
+                    await self.smtp.close()
+                    attempts = message.attempts + 1
+                    values = {"attempts": attempts, "last_error": str(e)[:500]}
+                    if attempts >= OUTBOX_MAX_ATTEMPTS:
+                        values["status"] = "failed"
+                    else:
+                        values["next_attempt_at"] = datetime.now() + backoff(attempts)
+                    outbox_delivered.inc(channel=message.channel, result=values.get("status", "retry"))
+                    log.warning("ошибка при отправке (%s #%d, попытка %d): %s",
+                                message.channel, message.id, attempts, e)
+                else:
+                    values = {"status": "sent", "sent_at": datetime.now(), "attempts": message.attempts + 1}
+                    outbox_delivered.inc(channel=message.channel, result="sent")
+                    outbox_delivery_latency.observe((values["sent_at"] - message.created_at).total_seconds(),
+                                                    channel=message.channel)
+                # коммит на каждое сообщение: не держим блокировку записи SQLite,
+                # пока ждём SMTP, и не отправляем повторно уже доставленное
+                await db.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id == message.id)
+                    .values(**values)
+                    .execution_options(synchronize_session=False)
+                )
+                await db.commit()
+        return len(claimed)
@@ -0,0 +1,216 @@
+"""
+Resource allocation: wash bays, interior stations and staff.
+
+A service needs one resource of every kind listed in its "requires"
+(services.RESOURCES says which resources exist). ScheduleIndex keeps, per
+day, the confirmed intervals of each resource as sorted lists loaded from
+slot_reservations, so checking a resource is two bisects instead of a
+range query. The database stays authoritative: slot_reservations is keyed
+by (day, resource, slot), and a stale index only costs a retry.
+"""
+import bisect
+import os
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from .availability import SLOT_STEP, snap_interval
+from .models import Booking, SlotReservation
+from .services import RESOURCES, SERVICES
+
+SCHEDULE_INDEX_DAYS = int(os.getenv("SCHEDULE_INDEX_DAYS", "400"))
+
+# старые/неизвестные услуги считаем обычной мойкой
+DEFAULT_REQUIRES = ["bay", "staff"]
+
+
+def requirements(service: str) -> List[str]:
+    return SERVICES.get(service, {}).get("requires", DEFAULT_REQUIRES)
+
+
+def resources_by_kind(resources: Dict[str, dict] = RESOURCES) -> Dict[str, List[str]]:
+    kinds: Dict[str, List[str]] = {}
+    for name, resource in resources.items():
+        kinds.setdefault(resource["kind"], []).append(name)
+    return kinds
+
+
+def allocate_keys(taken: Set[Tuple], requires: Iterable[str], keys: List[Tuple[date, int]],
+                  kinds: Dict[str, List[str]]) -> List[str]:
+    """
+    First-fit against a set of taken (day, resource, slot) — for backfills.
+
+    Kinds without a free resource are skipped (old overlapping bookings);
+    the chosen keys are added to `taken`.
+    """
+    chosen = []
+    for kind in requires:
+        for name in kinds.get(kind, ()):
+            if not any((day, name, slot) in taken for day, slot in keys):
+                taken.update((day, name, slot) for day, slot in keys)
+                chosen.append(name)
+                break
+    return chosen
+
+
+class Timeline:
+    """Non-overlapping [start, end) intervals of one resource, sorted by start."""
+
+    def __init__(self):
+        self.starts: List[datetime] = []
+        self.ends: List[datetime] = []
+        self.ids: List[int] = []
+
+    def is_free(self, start: datetime, end: datetime) -> bool:
+        # интервалы не пересекаются, поэтому ends тоже отсортирован:
+        # достаточно проверить последний интервал, начавшийся до end
+        i = bisect.bisect_left(self.starts, end)
+        return i == 0 or self.ends[i - 1] <= start
+
+    def add(self, start: datetime, end: datetime, booking_id: int):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.ids.insert(i, booking_id)
+
+    def remove(self, booking_id: int):
+        if booking_id in self.ids:
+            i = self.ids.index(booking_id)
+            del self.starts[i], self.ends[i], self.ids[i]
+
+    def intervals(self):
+        return zip(self.starts, self.ends)
+
+
+class DaySchedule:
+    def __init__(self, resources: Dict[str, dict], step: int = SLOT_STEP):
+        self.step = step
+        self.kinds = resources_by_kind(resources)
+        self.timelines = {name: Timeline() for name in resources}
+        # самый длинный свободный отрезок по видам ресурсов; сбрасывается при изменениях
+        self._gaps: Dict[str, int] = {}
+
+    def allocate(self, requires: Iterable[str], start: datetime, end: datetime) -> Optional[List[str]]:
+        """One free resource per required kind (first fit), or None if some kind is full."""
+        start, end = snap_interval(start, end, self.step)
+        chosen = []
+        for kind in requires:
+            for name in self.kinds.get(kind, ()):
+                if self.timelines[name].is_free(start, end):
+                    chosen.append(name)
+                    break
+            else:
+                return None
+        return chosen
+
+    def add(self, booking_id: int, resources: Iterable[str], start: datetime, end: datetime):
+        start, end = snap_interval(start, end, self.step)
+        for name in resources:
+            if name in self.timelines:
+                self.timelines[name].add(start, end, booking_id)
+        self._gaps.clear()
+
+    def remove(self, booking_id: int):
+        for timeline in self.timelines.values():
+            timeline.remove(booking_id)
+        self._gaps.clear()
+
+    def longest_gap(self, grid, day: date, kind: str) -> int:
+        """Longest free run, in grid steps, that any resource of `kind` has on this day."""
+        if kind not in self._gaps:
+            self._gaps[kind] = max(
+                (grid.longest_free_run(grid.bitmap(day, self.timelines[name].intervals()))
+                 for name in self.kinds.get(kind, ())),
+                default=0
+            )
+        return self._gaps[kind]
+
+    def may_fit(self, grid, day: date, requires: Iterable[str], need: int) -> bool:
+        """False when some required kind has no gap of `need` steps — the day is full for the service."""
+        return all(self.longest_gap(grid, day, kind) >= need for kind in requires)
+
+    def pools(self, grid, day: date, requires: Iterable[str]) -> List[List[int]]:
+        """Busy bitmaps per required kind — input for DayGrid.free_starts_for."""
+        return [[grid.bitmap(day, self.timelines[name].intervals()) for name in self.kinds.get(kind, ())]
+                for kind in requires]
+
+
+class ScheduleIndex:
+    """
+    Per-day DaySchedule objects, loaded lazily from the DB and kept in LRU order.
+
+    `epoch` changes on every write so that a load which raced with a booking
+    or a cancellation is used once but not cached.
+    """
+
+    def __init__(self, resources: Dict[str, dict] = RESOURCES, step: int = SLOT_STEP,
+                 max_days: int = SCHEDULE_INDEX_DAYS):
+        self.resources = resources
+        self.step = step
+        self.max_days = max_days
+        self.epoch = 0
+        self._days: "OrderedDict[date, DaySchedule]" = OrderedDict()
+
+    async def load(self, db, days: Iterable[date]) -> Dict[date, DaySchedule]:
+        """Fresh schedules for several days in one query; not cached, callers may mutate them."""
+        days = sorted(set(days))
+        schedules = {day: DaySchedule(self.resources, self.step) for day in days}
+        if not days:
+            return schedules
+        rows = (await db.execute(
+            select(SlotReservation.day, SlotReservation.resource, Booking.id, Booking.start_time, Booking.end_time)
+            .join(Booking, Booking.id == SlotReservation.booking_id)
+            .where(SlotReservation.day.in_(days))
+            .distinct()
+        )).all()
+        for day, resource, booking_id, start, end in rows:
+            schedules[day].add(booking_id, [resource], start, end)
+        return schedules
+
+    async def day(self, db, day: date) -> DaySchedule:
+        return (await self.days(db, [day]))[day]
+
+    async def days(self, db, days: Iterable[date]) -> Dict[date, DaySchedule]:
+        """Cached schedules for `days`; the missing ones are loaded together in one query."""
+        result, missing = {}, []
+        for day in days:
+            schedule = self._days.get(day)
+            if schedule is not None:
+                self._days.move_to_end(day)
+                result[day] = schedule
+            else:
+                missing.append(day)
+        if not missing:
+            return result
+
+        epoch = self.epoch
+        loaded = await self.load(db, missing)
+        if epoch == self.epoch:
+            self._days.update(loaded)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+        result.update(loaded)
+        return result
+
+    def add(self, day: date, booking_id: int, resources: Iterable[str], start: datetime, end: datetime):
+        self.epoch += 1
+        schedule = self._days.get(day)
+        if schedule is not None:
+            schedule.add(booking_id, resources, start, end)
+
+    def remove(self, day: date, booking_id: int):
+        self.epoch += 1
+        schedule = self._days.get(day)
+        if schedule is not None:
+            schedule.remove(booking_id)
+
+    def invalidate(self, *days: date):
+        self.epoch += 1
+        for day in days:
+            self._days.pop(day, None)
+
+    def clear(self):
+        self.epoch += 1
+        self._days.clear()
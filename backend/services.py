@@ -1,8 +1,11 @@
+import os
+
 SERVICES = {
     "car_spa": {
         "name": "CAR SPA®",
         "price": 24,
         "duration": 30,
+        "requires": ["bay", "staff"],
         "description": "Schnelle, günstige und schonende textile Außenwäsche. "
                        "Manuelle Vorreinigung – Aktivschaum – Shampoowäsche – "
                        "Radwäsche – maschinelles Trocknen."
@@ -11,6 +14,7 @@ SERVICES = {
         "name": "CAR SOFT",
         "price": 36,
         "duration": 30,
+        "requires": ["bay", "staff"],
         "description": "Intensive, schonende textile Außenwäsche mit Felgenreinigung extra. "
                        "Manuelle Vorreinigung – händische Felgenreinigung – Aktivschaum – "
                        "Shampoowäsche – Radwäsche – maschinelle Trocknung & zusätzliche "
@@ -20,6 +24,7 @@ SERVICES = {
         "name": "CAR EASY",
         "price": 74,
         "duration": 90,
+        "requires": ["bay", "staff"],
         "description": "Einfache Außen- und Innenreinigung (ohne Kofferraum oder Ladefläche). "
                        "Manuelle Vorreinigung – händische Felgenreinigung – Aktivschaum – "
                        "Shampoowäsche – Radwäsche – maschinelle Trocknung & zusätzliche "
@@ -32,6 +37,7 @@ SERVICES = {
         "name": "CAR WELLNESS",
         "price": 86,
         "duration": 120,
+        "requires": ["bay", "staff"],
         "description": "Intensive Außen- und Innenreinigung (mit Kofferraum oder Ladefläche). "
                        "Manuelle Vorreinigung – händische Felgenreinigung – Aktivschaum – "
                        "Shampoowäsche – Radwäsche – maschinelle Trocknung & zusätzliche "
@@ -44,9 +50,27 @@ SERVICES = {
         "name": "CAR INTENSE (Innen)",
         "price": 68,
         "duration": 90,
+        "requires": ["interior", "staff"],
         "description": "Intensive Innenreinigung (mit Kofferraum oder Ladefläche). "
                        "Reinigung von Fußmatten, Innenflächen (nur glatte Flächen) "
                        "und Armaturen – Saugen von Teppichen, Sitzen, Seitenverkleidungen – "
                        "Reinigung von Scheiben und Spiegeln – fachgerechte Endkontrolle."
     }
 }
+
+
+# ================== RESOURCES ==================
+# Каждая услуга занимает по одному ресурсу каждого вида из "requires":
+# мойки — бокс (bay), чистка салона — место для салона (interior),
+# и всем нужен сотрудник (staff). Количество задаётся через env.
+RESOURCE_COUNTS = {
+    "bay": int(os.getenv("BAYS", "1")),
+    "interior": int(os.getenv("INTERIOR_STATIONS", "1")),
+    "staff": int(os.getenv("STAFF", "2")),
+}
+
+RESOURCES = {
+    f"{kind}{i}": {"kind": kind}
+    for kind, count in RESOURCE_COUNTS.items()
+    for i in range(1, count + 1)
+}
@@ -0,0 +1,65 @@
+"""
+Signed cancel links.
+
+    c1.<booking id, base36>.<expiry unix time, base36>.<HMAC-SHA256, base64url, 128 bit>
+
+The signature covers the id and the expiry, so /cancel/{token} rejects
+forged or expired links without touching the database and loads valid
+ones by primary key. Tokens are derived, not stored: the same booking
+always gets the same link. The expiry is the booking's start time, so the
+caller also checks it against the loaded row: a link to a deleted booking
+never matches a later booking that happens to get the same id.
+"""
+import base64
+import hashlib
+import hmac
+from typing import Optional, Tuple
+
+PREFIX = "c1"
+SIG_BYTES = 16
+
+VALID = "valid"
+INVALID = "invalid"
+EXPIRED = "expired"
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _b36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _DIGITS[r] + out
+        if not n:
+            return out
+
+
+def _signature(secret: bytes, payload: str) -> str:
+    digest = hmac.new(secret, payload.encode(), hashlib.sha256).digest()[:SIG_BYTES]
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def is_signed(token: str) -> bool:
+    return token.startswith(PREFIX + ".")
+
+
+def sign(secret: bytes, booking_id: int, expires: int) -> str:
+    payload = f"{PREFIX}.{_b36(booking_id)}.{_b36(expires)}"
+    return f"{payload}.{_signature(secret, payload)}"
+
+
+def verify(secret: bytes, token: str, now: float) -> Tuple[str, Optional[int], Optional[int]]:
+    """(VALID | INVALID | EXPIRED, booking id, expiry) — no I/O, signature compared in constant time."""
+    parts = token.split(".")
+    if len(parts) != 4 or parts[0] != PREFIX:
+        return INVALID, None, None
+    payload = ".".join(parts[:3])
+    if not hmac.compare_digest(_signature(secret, payload).encode(), parts[3].encode()):
+        return INVALID, None, None
+    try:
+        booking_id, expires = int(parts[1], 36), int(parts[2], 36)
+    except ValueError:
+        return INVALID, None, None
+    if expires < now:
+        return EXPIRED, booking_id, expires
+    return VALID, booking_id, expires
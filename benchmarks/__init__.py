@@ -0,0 +1,18 @@
+import os
+
+
+def app_env(db_path: str):
+    """Environment for importing backend.main against a benchmark database."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    for key in ("MAIL_USERNAME", "MAIL_PASSWORD", "ADMIN_USER", "ADMIN_PASS"):
+        os.environ.setdefault(key, "bench")
+    os.environ.setdefault("MAIL_FROM", "bench@example.com")
+    os.environ.setdefault("CANCEL_TOKEN_SECRET", "bench-cancel-secret-0123456789abcdef")
+    os.environ.setdefault("ADMIN_EMAILS", "bench@example.com")
+    # письма при замерах не отправляем
+    os.environ["OUTBOX_WORKER"] = "false"
+    # история сида целиком в прошлом — архиватор не должен переносить её во время замера
+    os.environ["ARCHIVE_WORKER"] = "false"
+    # вся нагрузка идёт с одного IP — лимиты на клиента исказили бы замер
+    os.environ["ADMISSION_CONTROL"] = "false"
+    return dict(os.environ)
@@ -0,0 +1,318 @@
+"""
+Latency/throughput benchmark for the booking hot paths.
+
+    python -m benchmarks.run --bookings 100000 --concurrency 16
+    python -m benchmarks.run --mode uvicorn --workers 2
+    python -m benchmarks.run --against origin/main  # regression gate vs a revision, same host
+    python -m benchmarks.run --check              # regression gate vs this machine's baseline
+    python -m benchmarks.run --update-baseline    # accept current numbers for this machine
+
+Each scenario fires --requests requests through --concurrency concurrent
+clients, either in-process (httpx over ASGI) or against a local uvicorn,
+and records p50/p99 latency (ms), throughput (req/s) and errors (any
+answer but 200: a scenario that starts failing with 400 must not pass as
+fast). Results are written as JSON; the gate fails (exit 1) on errors or
+if any scenario's p50 or p99 is more than --margin (p50) / --p99-margin
+(p99) slower than the reference.
+
+Absolute milliseconds only compare on the same hardware. --against runs
+the same benchmark for a git revision in a temporary worktree on this host
+and compares against that; --check uses baseline.json, which is keyed by
+machine (CPU model and count) and fails if this machine has none.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import httpx
+
+from . import app_env
+from .seed import seed
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, "baseline.json")
+
+SCENARIOS = ["book", "slots", "busy_slots", "admin_bookings", "cancel", "cancel_legacy"]
+# сценарии, которые меняют данные: без прогрева, каждый запрос — своя бронь
+WRITES = ("book", "cancel", "cancel_legacy")
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[k]
+
+
+def summarize(latencies, elapsed, errors):
+    ms = [x * 1000 for x in latencies]
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+class Workload:
+    """Request factories for every scenario, drawn from the seeded data."""
+
+    def __init__(self, db_path: str, n_requests: int, rnd: random.Random):
+        import sqlite3
+        from backend.main import cancel_secret
+        from backend.tokens import sign
+
+        today = date.today().isoformat()
+        conn = sqlite3.connect(db_path)
+        days = [r[0][:10] for r in conn.execute(
+            "SELECT DISTINCT substr(start_time, 1, 10) FROM bookings ORDER BY 1 DESC LIMIT 400")]
+        # UUID-ссылки старых писем: по прошедшим броням, поиск по cancel_token
+        legacy = [r[0] for r in conn.execute(
+            "SELECT cancel_token FROM bookings WHERE status = 'confirmed' AND start_time < ? ORDER BY id LIMIT ?",
+            (today, n_requests))]
+        # подписанные ссылки: будущие брони из seed(upcoming=...), срок ссылки — начало брони
+        upcoming = conn.execute(
+            "SELECT id, start_time FROM bookings WHERE status = 'confirmed' AND start_time >= ? ORDER BY id LIMIT ?",
+            (today, n_requests)).fetchall()
+        last = conn.execute("SELECT max(substr(start_time, 1, 10)) FROM bookings").fetchone()[0]
+        conn.close()
+        self.rnd = rnd
+        self.days = days or [today]
+        self.legacy_tokens = legacy
+        self.tokens = [sign(cancel_secret(), booking_id, int(datetime.fromisoformat(start).timestamp()))
+                       for booking_id, start in upcoming]
+        # /api/book: свободные будущие слоты после засеянных, каждый запрос — свой слот
+        self.free = []
+        day = max(date.today() + timedelta(days=30),
+                  date.fromisoformat(last) + timedelta(days=1) if last else date.today())
+        while len(self.free) < n_requests:
+            if day.weekday() < 5:
+                self.free += [f"{day.isoformat()}T{h:02d}:{m:02d}:00" for h in range(8, 17) for m in (0, 30)]
+            day += timedelta(days=1)
+
+    def request(self, scenario: str, i: int):
+        if scenario == "book":
+            return "POST", "/api/book", {"json": {
+                "name": f"Bench {i}", "phone": str(i), "email": f"bench{i}@example.com",
+                "service": "car_spa", "start_time": self.free[i]}}
+        if scenario == "slots":
+            return "GET", "/api/slots", {"params": {"date": self.rnd.choice(self.days)}}
+        if scenario == "busy_slots":
+            return "GET", "/api/busy-slots", {"params": {"date": self.rnd.choice(self.days)}}
+        if scenario == "admin_bookings":
+            day = self.rnd.choice(self.days)
+            return "GET", "/api/admin/bookings", {"params": {"date_from": day, "date_to": day}}
+        if scenario == "cancel":
+            return "GET", f"/cancel/{self.tokens[i % len(self.tokens)]}", {}
+        if scenario == "cancel_legacy":
+            return "GET", f"/cancel/{self.legacy_tokens[i % len(self.legacy_tokens)]}", {}
+        raise ValueError(scenario)
+
+
+async def run_scenario(client: httpx.AsyncClient, workload: Workload, scenario: str,
+                       n_requests: int, concurrency: int):
+    latencies, errors = [], 0
+    counter = iter(range(n_requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            method, url, kwargs = workload.request(scenario, i)
+            began = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - began)
+            # каждый запрос сценария должен пройти: 4xx — тоже сломанный сценарий, а не быстрый ответ
+            if response.status_code != 200:
+                errors += 1
+
+    began = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - began, errors)
+
+
+async def run_all(client, workload, scenarios, n_requests, concurrency, warmup):
+    results = {}
+    for scenario in scenarios:
+        if warmup and scenario not in WRITES:
+            await run_scenario(client, workload, scenario, warmup, concurrency)
+        results[scenario] = await run_scenario(client, workload, scenario, n_requests, concurrency)
+        print(f"  {scenario:<15} {results[scenario]}")
+    return results
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def bench_inprocess(db_path, args, workload):
+    from backend.main import app
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        return await run_all(client, workload, args.scenarios, args.requests, args.concurrency, args.warmup)
+
+
+async def bench_uvicorn(db_path, args, workload):
+    port = _free_port()
+    env = app_env(db_path)
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(args.workers), "--log-level", "warning"],
+        cwd=ROOT, env=env,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            for _ in range(200):
+                try:
+                    await client.get("/api/services")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.05)
+            else:
+                raise RuntimeError("uvicorn did not start")
+            return await run_all(client, workload, args.scenarios, args.requests, args.concurrency, args.warmup)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def compare(results: dict, baseline: dict, margin: float, p99_margin: float = None):
+    """List of human-readable regressions (empty if within margin)."""
+    failures = []
+    for scenario, base in baseline.items():
+        current = results.get(scenario)
+        if current is None:
+            continue
+        if current.get("errors"):
+            failures.append(f"{scenario}: {current['errors']} failed requests")
+        for metric, allowed in (("p50_ms", margin), ("p99_ms", margin if p99_margin is None else p99_margin)):
+            limit = base[metric] * (1 + allowed)
+            if current[metric] > limit:
+                failures.append(f"{scenario}.{metric}: {current[metric]} > {limit:.3f} "
+                                f"(baseline {base[metric]}, margin {allowed:.0%})")
+    return failures
+
+
+def profile_key(args) -> str:
+    return f"{args.mode}-{args.bookings}-c{args.concurrency}"
+
+
+def machine_key() -> str:
+    """CPU model and count: baselines from other hardware are not comparable."""
+    model = platform.machine()
+    try:
+        with open("/proc/cpuinfo") as f:
+            model = next(line.split(":", 1)[1].strip() for line in f if line.startswith("model name"))
+    except (OSError, StopIteration):
+        pass
+    return f"{model} x{os.cpu_count()}"
+
+
+def run_revision(rev: str, args) -> dict:
+    """The same benchmark for git revision `rev`, in a temporary worktree on this host."""
+    tmp = tempfile.mkdtemp(prefix="carwash-bench-rev-")
+    tree = os.path.join(tmp, "tree")
+    subprocess.run(["git", "worktree", "add", "--detach", tree, rev], cwd=ROOT, check=True, capture_output=True)
+    try:
+        out = os.path.join(tmp, "results.json")
+        # сценарии не передаём: у старой ревизии их может не быть, сравнение — по общим
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.run", "--mode", args.mode, "--bookings", str(args.bookings),
+             "--requests", str(args.requests), "--concurrency", str(args.concurrency),
+             "--warmup", str(args.warmup), "--workers", str(args.workers), "--seed", str(args.seed),
+             "--db", os.path.join(tmp, "bench.db"), "--out", out, "--baseline", os.path.join(tmp, "baseline.json")],
+            cwd=tree, check=True,
+        )
+        with open(out) as f:
+            return json.load(f)[profile_key(args)]
+    finally:
+        subprocess.run(["git", "worktree", "remove", "--force", tree], cwd=ROOT, capture_output=True)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Booking hot-path benchmark")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn"], default="inprocess")
+    parser.add_argument("--bookings", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--db", help="SQLite file to use (default: temporary)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--margin", type=float, default=0.25, help="allowed p50 slowdown, 0.25 = +25%%")
+    # хвост записи в SQLite шумный (busy_timeout), поэтому допуск шире
+    parser.add_argument("--p99-margin", type=float, default=0.5, help="allowed p99 slowdown")
+    parser.add_argument("--check", action="store_true", help="fail if slower than this machine's baseline")
+    parser.add_argument("--against", metavar="REV", help="fail if slower than git revision REV on this host")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="carwash-bench-"), "bench.db")
+    app_env(db_path)
+    print(f"seeding {args.bookings} + {args.requests} upcoming bookings -> {db_path}")
+    # будущих броней — по одной на запрос сценария cancel
+    seed(db_path, args.bookings, args.seed, upcoming=args.requests)
+    workload = Workload(db_path, args.requests, random.Random(args.seed))
+
+    print(f"{args.mode}: {args.requests} requests x {len(args.scenarios)} scenarios, concurrency {args.concurrency}")
+    bench = bench_inprocess if args.mode == "inprocess" else bench_uvicorn
+    results = asyncio.run(bench(db_path, args, workload))
+
+    key = profile_key(args)
+    with open(args.out, "w") as f:
+        json.dump({key: results}, f, indent=2, sort_keys=True)
+
+    machine = machine_key()
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines.setdefault(machine, {})[key] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline updated: {machine} / {key}")
+
+    if args.against:
+        print(f"reference: {args.against} on this host")
+        reference = run_revision(args.against, args)
+    elif args.check:
+        reference = baselines.get(machine, {}).get(key)
+        if reference is None:
+            print(f"no baseline for {key} on {machine}; use --against REV or run with --update-baseline first")
+            return 1
+    else:
+        return 0
+    failures = compare(results, reference, args.margin, args.p99_margin)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    if failures:
+        return 1
+    print("within baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,141 @@
+"""
+Fill a bookings database with realistic history for benchmarks.
+
+    python -m benchmarks.seed --db /tmp/bench.db --bookings 100000 --upcoming 500
+
+Confirmed bookings never overlap (they also get slot_reservations rows),
+about 15% of the history is canceled, and days run backwards from
+yesterday. --upcoming adds bookings from tomorrow on, whose signed cancel
+links have not expired yet; the days after them stay free for /api/book.
+"""
+import argparse
+import itertools
+import random
+import uuid
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import create_engine, insert, text
+
+from . import app_env
+
+CANCELED_SHARE = 0.15
+CHUNK = 10_000
+
+
+def _days_back(start: date):
+    day = start
+    while True:
+        if day.weekday() < 5:
+            yield day
+        day -= timedelta(days=1)
+
+
+def _days_forward(start: date):
+    day = start
+    while True:
+        if day.weekday() < 5:
+            yield day
+        day += timedelta(days=1)
+
+
+def generate(n: int, seed: int = 1, days=None, first_id: int = 1):
+    """Yield (booking row, reservation keys) tuples day by day (default: from yesterday backwards)."""
+    from backend.availability import slot_keys
+    from backend.main import GRID as grid
+    from backend.services import SERVICES
+
+    rnd = random.Random(seed)
+    services = list(SERVICES)
+    made = 0
+    for day in days or _days_back(date.today() - timedelta(days=1)):
+        slot = 0
+        while slot < grid.n_slots and made < n:
+            key = rnd.choice(services)
+            need = grid.slots_for(SERVICES[key]["duration"])
+            if slot + need > grid.n_slots:
+                break
+            start = datetime.combine(day, time.min) + timedelta(minutes=grid.minute_of(slot))
+            end = start + timedelta(minutes=SERVICES[key]["duration"])
+            status = "canceled" if rnd.random() < CANCELED_SHARE else "confirmed"
+            booking_id = first_id + made
+            made += 1
+            yield {
+                "id": booking_id,
+                "name": f"Kunde {booking_id}",
+                "phone": f"+43 660 {booking_id:07d}",
+                "email": f"kunde{booking_id}@example.com",
+                "service": key,
+                "start_time": start,
+                "end_time": end,
+                "status": status,
+                "cancel_token": str(uuid.UUID(int=rnd.getrandbits(128))),
+            }, (slot_keys(start, end) if status == "confirmed" else [])
+            # иногда окно между бронями
+            slot += need + (1 if rnd.random() < 0.3 else 0)
+        if made >= n:
+            return
+
+
+def seed(db_path: str, n: int, seed: int = 1, upcoming: int = 0) -> int:
+    """Refill db_path with n past and `upcoming` future bookings; backend.main must point at the same file."""
+    app_env(db_path)
+    from backend.migrations import init_db
+    from backend.models import Booking, SlotReservation
+    from backend.scheduling import requirements, resources_by_kind
+    from backend.stats import rebuild as rebuild_stats
+
+    engine = create_engine(f"sqlite:///{db_path}")
+    init_db(engine)
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM slot_reservations"))
+        conn.execute(text("DELETE FROM slot_holds"))
+        conn.execute(text("DELETE FROM bookings"))
+        conn.execute(text("DELETE FROM outbox"))
+        conn.execute(text("DELETE FROM cache_invalidations"))
+        conn.execute(text("DELETE FROM admin_events"))
+
+    bookings, reservations = [], []
+
+    def flush():
+        with engine.begin() as conn:
+            conn.execute(insert(Booking.__table__), bookings)
+            if reservations:
+                conn.execute(insert(SlotReservation.__table__), reservations)
+        bookings.clear()
+        reservations.clear()
+
+    # брони дня идут подряд без пересечений — первый ресурс каждого вида всегда свободен
+    kinds = resources_by_kind()
+    rows = itertools.chain(
+        generate(n, seed),
+        generate(upcoming, seed + 1, _days_forward(date.today() + timedelta(days=1)), first_id=n + 1),
+    )
+    for row, keys in rows:
+        bookings.append(row)
+        reservations.extend({"day": d, "resource": kinds[kind][0], "slot": s, "booking_id": row["id"]}
+                            for kind in requirements(row["service"]) for d, s in keys)
+        if len(bookings) >= CHUNK:
+            flush()
+    if bookings:
+        flush()
+
+    with engine.begin() as conn:
+        rebuild_stats(conn)
+        conn.execute(text("ANALYZE"))
+    engine.dispose()
+    return n + upcoming
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--db", required=True, help="path of the SQLite file to (re)fill")
+    parser.add_argument("--bookings", type=int, default=10_000)
+    parser.add_argument("--upcoming", type=int, default=0, help="future bookings (signed cancel links)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    seed(args.db, args.bookings, args.seed, args.upcoming)
+    print(f"{args.bookings} + {args.upcoming} bookings -> {args.db}")
+
+
+if __name__ == "__main__":
+    main()
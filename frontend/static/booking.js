@@ -10,12 +10,17 @@ const dateInput = document.getElementById('date');
 const timeSlotsDiv = document.getElementById('timeSlots');
 const form = document.getElementById('bookingForm');
 const messageDiv = document.getElementById('message');
+const nextFreeButton = document.getElementById('nextFree');
 
 // ================= STATE =================
 let services = {};
-let busySlots = [];
+let freeStarts = new Set();
 let selectedStartMinutes = null;
 let selectedService = null;
+let slotStream = null;
+let hold = null; // { token, date, service, minutes } — удержание выбранного времени; token null, пока ждём ответ
+let heldToken = null; // удержание, которое сейчас держит сервер
+let holdQueue = Promise.resolve(); // запросы удержания по очереди: release всегда знает прежний токен
 
 // ================= HELPERS =================
 function pad(n) {
@@ -41,41 +46,178 @@ function getAllSlotMinutes() {
 }
 
 // ================= LOGIC =================
-function isRangeFree(start, end) {
-    for (const b of busySlots) {
-        if (start < b.end && end > b.start) return false;
-    }
-    return true;
-}
-
 function clearSelection() {
     selectedStartMinutes = null;
     document.querySelectorAll('.slot').forEach(s => s.classList.remove('selected'));
 }
 
+function selectSlot(minutes) {
+    clearSelection();
+    selectedStartMinutes = minutes;
+
+    const blocks = Math.ceil(services[selectedService].duration / SLOT_STEP);
+    for (let i = 0; i < blocks; i++) {
+        const m = minutes + i * SLOT_STEP;
+        const el = document.querySelector(`.slot[data-minutes='${m}']`);
+        if (el) el.classList.add('selected');
+    }
+}
+
+// своё удержание для других занято, для нас — свободно
+function isHeldByMe(minutes) {
+    return hold !== null && hold.date === dateInput.value && hold.service === selectedService && hold.minutes === minutes;
+}
+
+function slotStartTime(minutes) {
+    const date = parseDate(dateInput.value);
+    date.setHours(Math.floor(minutes / 60), minutes % 60, 0, 0);
+    return toLocalISOString(date);
+}
+
+// Удерживаем выбранное время на несколько минут, пока заполняется форма.
+// Удержание отмечаем сразу: событие taken о нём приходит по SSE раньше ответа
+function holdSlot(minutes) {
+    const mine = { token: null, date: dateInput.value, service: selectedService, minutes };
+    hold = mine;
+    holdQueue = holdQueue.then(() => requestHold(mine));
+    return holdQueue;
+}
+
+async function requestHold(mine) {
+    // пока ждали очереди, выбрали другое время или сняли выбор
+    if (hold !== mine) return;
+    const payload = { service: mine.service, start_time: slotStartTime(mine.minutes) };
+    if (heldToken) payload.release = heldToken;
+    try {
+        const res = await fetch('/api/hold', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(payload)
+        });
+        // прежнее удержание сервер снял в любом случае
+        heldToken = null;
+        if (res.ok) {
+            heldToken = (await res.json()).hold_token;
+            mine.token = heldToken;
+            if (hold !== mine) await releaseHeld();
+            return;
+        }
+        if (hold !== mine) return;
+        hold = null;
+        if (res.status === 400) {
+            messageDiv.textContent = 'Die gewählte Uhrzeit ist nicht mehr frei. Bitte wählen Sie eine andere.';
+            renderSlots();
+        } else {
+            drawSlots();
+        }
+    } catch (err) {
+        console.error('holdSlot error:', err);
+        if (hold === mine) {
+            hold = null;
+            drawSlots();
+        }
+    }
+}
+
+// Снять удержание при смене услуги или дня, иначе своё время до HOLD_TTL видно занятым
+function releaseHold() {
+    hold = null;
+    holdQueue = holdQueue.then(releaseHeld);
+}
+
+async function releaseHeld() {
+    // новый выбор уже в очереди — он снимет прежнее удержание через release
+    if (hold !== null || !heldToken) return;
+    const token = heldToken;
+    heldToken = null;
+    try {
+        await fetch(`/api/hold/${encodeURIComponent(token)}`, { method: 'DELETE' });
+    } catch (err) {
+        console.error('releaseHold error:', err);
+    }
+}
+
 // ================= API =================
-// Глобальная функция для загрузки занятых слотов
+// Глобальная функция для загрузки свободных стартов (считает сервер)
 window.loadBusySlots = async function() {
-    busySlots = [];
-    if (!dateInput.value) return;
+    freeStarts = new Set();
+    if (!dateInput.value || !selectedService) return;
 
     try {
-        const res = await fetch(`/api/slots?date=${dateInput.value}`);
+        const params = new URLSearchParams({ date: dateInput.value, service: selectedService });
+        const res = await fetch(`/api/availability?${params}`);
         if (!res.ok) return;
         const data = await res.json();
-        busySlots = data.map(b => ({
-            start: new Date(b.start_time),
-            end: new Date(b.end_time)
-        }));
+        freeStarts = new Set(data.starts);
     } catch (err) {
         console.error('loadBusySlots error:', err);
     }
 };
 
+// Живые обновления дня (SSE): сервер присылает свободные старты каждой
+// услуги в окне (from, to), которое затронула бронь или отмена
+function subscribeSlots() {
+    if (slotStream) {
+        slotStream.close();
+        slotStream = null;
+    }
+    if (!dateInput.value || !window.EventSource) return;
+
+    const stream = new EventSource(`/api/slots/stream?date=${encodeURIComponent(dateInput.value)}`);
+    const applyDiff = e => {
+        const diff = JSON.parse(e.data);
+        if (diff.date !== dateInput.value || !selectedService) return;
+        for (const m of [...freeStarts]) {
+            if (m > diff.from && m < diff.to) freeStarts.delete(m);
+        }
+        (diff.free[selectedService] || []).forEach(m => freeStarts.add(m));
+        drawSlots();
+    };
+    stream.addEventListener('taken', applyDiff);
+    stream.addEventListener('freed', applyDiff);
+    // очередь на сервере переполнилась — перечитываем день целиком
+    stream.addEventListener('reset', () => renderSlots());
+    slotStream = stream;
+}
+
+// Ближайший свободный термин: сервер ищет по дням сам, один запрос вместо перебора дат
+async function jumpToNextFree() {
+    if (!selectedService) {
+        alert('Bitte Service auswählen');
+        return;
+    }
+    try {
+        const params = new URLSearchParams({ service: selectedService, limit: 1 });
+        const res = await fetch(`/api/next-available?${params}`);
+        if (!res.ok) return;
+        const data = await res.json();
+        if (!data.starts.length) {
+            messageDiv.textContent = 'In den nächsten Wochen ist leider kein Termin frei.';
+            return;
+        }
+        const [day, clock] = data.starts[0].split('T');
+        const [h, m] = clock.split(':').map(Number);
+        if (day !== dateInput.value) releaseHold();
+        dateInput.value = day;
+        subscribeSlots();
+        await renderSlots();
+        const slot = document.querySelector(`.slot[data-minutes='${h * 60 + m}']`);
+        if (slot) slot.click();
+    } catch (err) {
+        console.error('jumpToNextFree error:', err);
+    }
+}
+
 // Отрисовка слотов
 async function renderSlots() {
     await window.loadBusySlots();
     clearSelection();
+    drawSlots();
+}
+
+function drawSlots() {
+    const selected = selectedStartMinutes;
+    selectedStartMinutes = null;
 
     const date = parseDate(dateInput.value);
     if (!date) {
@@ -88,47 +230,38 @@ async function renderSlots() {
         return;
     }
 
-    const service = services[selectedService];
-    const duration = service.duration;
-
     timeSlotsDiv.innerHTML = '';
 
     for (const minutes of getAllSlotMinutes()) {
         const slotStart = new Date(date);
         slotStart.setHours(Math.floor(minutes / 60), minutes % 60, 0, 0);
 
-        const slotEnd = new Date(slotStart.getTime() + duration * 60000);
-
         const div = document.createElement('div');
         div.classList.add('slot');
         div.dataset.minutes = minutes;
         div.textContent = `${pad(slotStart.getHours())}:${pad(slotStart.getMinutes())}`;
 
-        let busy = false;
-
-        if (slotEnd.getTime() > new Date(date).setHours(18, 0, 0, 0)) busy = true;
-        if (slotEnd <= new Date()) busy = true;
-        if (!isRangeFree(slotStart, slotEnd)) busy = true;
+        const busy = !freeStarts.has(minutes) && !isHeldByMe(minutes);
 
         if (busy) {
             div.classList.add('busy');
         } else {
             div.classList.add('free');
             div.addEventListener('click', () => {
-                clearSelection();
-                selectedStartMinutes = minutes;
-
-                const blocks = Math.ceil(duration / SLOT_STEP);
-                for (let i = 0; i < blocks; i++) {
-                    const m = minutes + i * SLOT_STEP;
-                    const el = document.querySelector(`.slot[data-minutes='${m}']`);
-                    if (el) el.classList.add('selected');
-                }
+                selectSlot(minutes);
+                if (!isHeldByMe(minutes)) holdSlot(minutes);
             });
         }
 
         timeSlotsDiv.appendChild(div);
     }
+
+    // выбранное время осталось свободным — сохраняем выбор
+    if (selected !== null && (freeStarts.has(selected) || isHeldByMe(selected))) {
+        selectSlot(selected);
+    } else if (selected !== null) {
+        messageDiv.textContent = 'Die gewählte Uhrzeit wurde gerade gebucht. Bitte wählen Sie eine andere.';
+    }
 }
 
 async function loadServices() {
@@ -176,6 +309,7 @@ async function loadServices() {
             card.addEventListener('click', () => {
                 document.querySelectorAll('.service-card').forEach(c => c.classList.remove('selected'));
                 card.classList.add('selected');
+                if (key !== selectedService) releaseHold();
                 selectedService = key;
                 serviceInput.value = key;
                 renderSlots();
@@ -193,6 +327,7 @@ async function loadServices() {
 
 // ================= EVENTS =================
 dateInput.addEventListener('change', () => {
+    releaseHold();
     const d = parseDate(dateInput.value);
     if (!d) return;
     if (d.getDay() === 0 || d.getDay() === 6) {
@@ -201,11 +336,15 @@ dateInput.addEventListener('change', () => {
         timeSlotsDiv.innerHTML = '';
         return;
     }
+    subscribeSlots();
     renderSlots();
 });
 
+nextFreeButton.addEventListener('click', jumpToNextFree);
+
 window.addEventListener('DOMContentLoaded', async () => {
     await loadServices();
+    subscribeSlots();
     renderSlots();
 });
 
@@ -233,6 +372,9 @@ form.addEventListener('submit', async e => {
         service: selectedService,
         start_time: toLocalISOString(date)
     };
+    // удержание могло ещё не вернуться с сервера
+    await holdQueue;
+    if (isHeldByMe(selectedStartMinutes) && hold.token) payload.hold_token = hold.token;
 
     const res = await fetch('/api/book', {
         method: 'POST',
@@ -1,38 +1,72 @@
 import sys
 import os
+import time
+import subprocess
+import csv
+import io
+import json
+import re
+import socket
+import asyncio
+import tempfile
 import pytest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, inspect, text, event
 from sqlalchemy.pool import StaticPool
 
-# --- путь к backend ---
+# --- путь к корню репозитория (backend — пакет) ---
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
-BACKEND_DIR = os.path.join(BASE_DIR, "backend")
-sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BASE_DIR)
 
-from main import app, Base, Booking
+# --- настройки для импорта приложения без .env ---
+# файл, а не :memory: — sync- и async-движки должны видеть одну базу
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+for key in ("MAIL_USERNAME", "MAIL_PASSWORD", "ADMIN_USER", "ADMIN_PASS"):
+    os.environ.setdefault(key, "test")
+os.environ.setdefault("MAIL_FROM", "noreply@test.com")
+os.environ.setdefault("CANCEL_TOKEN_SECRET", "test-cancel-secret-0123456789abcdef")
+os.environ.setdefault("ADMIN_EMAILS", "admin@test.com")
+os.environ.setdefault("OUTBOX_WORKER", "false")
+os.environ.setdefault("ADMISSION_CONTROL", "false")
 
-# ------------------ engine ------------------
-engine = create_engine(
-    "sqlite://",
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
-)
-
-TestingSessionLocal = sessionmaker(bind=engine)
-Base.metadata.create_all(bind=engine)
+from backend.main import app, Booking, availability_cache, schedule_index, slot_events, overlaps, \
+    apply_remote_changes, cancel_secret, admin_digest, GRID, get_settings, hold_sweeper
+import backend.main as main_module
+from backend.database import engine, async_engine, Base, SessionLocal, AsyncSessionLocal
+from backend.cache import DayCache
+from backend.models import OutboxMessage, CacheInvalidation, ArchivedBooking, SlotReservation, AdminEvent, \
+    DailyStat, SlotHold
+from backend.invalidation import CacheSync, CACHE_SYNC_RETENTION
+from backend.archive import ArchiveWorker
+from backend.digest import AdminDigest
+from backend.admission import Gate, Limit, MemoryBuckets, RateLimiter, Rejected
+from backend.stats import rebuild as rebuild_stats
+from backend.services import SERVICES
+from backend.outbox import OutboxWorker
+from backend.scheduling import DaySchedule
+from backend.tokens import sign
+from backend.events import DayChannels, RESET
+from backend.metrics import http_in_flight, http_latency, http_streams_open
+from fastapi_mail import ConnectionConfig
+from aiosmtpd.controller import Controller
+from backend.migrations import run_migrations, init_db, MIGRATIONS
+from benchmarks.run import compare, percentile, run_scenario, machine_key
 
 # ------------------ фикстура ------------------
 @pytest.fixture(autouse=True)
-def override_db(monkeypatch):
-    monkeypatch.setattr("main.SessionLocal", TestingSessionLocal)
+def clean_db():
     yield
     # чистим таблицы после каждого теста
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    availability_cache.clear()
+    schedule_index.clear()
 
 # ------------------ клиент ------------------
+# схему создаёт lifespan; модульный client работает без него
+init_db(engine)
 client = TestClient(app)
 
 # ------------------ ТЕСТЫ ------------------
@@ -41,7 +75,7 @@ def test_create_booking():
         "name": "Test User",
         "phone": "123456",
         "email": "test@test.com",
-        "service": "reinigung1",
+        "service": "car_spa",
         "start_time": "2099-12-31T12:00:00"
     })
     assert response.status_code == 200
@@ -53,7 +87,7 @@ def test_booking_overlap():
         "name": "A",
         "phone": "1",
         "email": "a@test.com",
-        "service": "reinigung1",
+        "service": "car_easy",
         "start_time": "2099-12-31T10:00:00"
     })
 
@@ -61,7 +95,7 @@ def test_booking_overlap():
         "name": "B",
         "phone": "2",
         "email": "b@test.com",
-        "service": "reinigung1",
+        "service": "car_spa",
         "start_time": "2099-12-31T10:30:00"
     })
 
@@ -75,7 +109,7 @@ def test_cancel_booking():
         "name": "Cancel",
         "phone": "3",
         "email": "c@test.com",
-        "service": "reinigung1",
+        "service": "car_spa",
         "start_time": "2099-12-31T15:00:00"
     })
 
@@ -93,3 +127,1235 @@ def test_cancel_booking():
     assert response.status_code == 200
     assert response.json()["ok"] is True
 
+
+def test_availability_excludes_booked_range():
+    client.post("/api/book", json={
+        "name": "A",
+        "phone": "1",
+        "email": "a@test.com",
+        "service": "car_easy",
+        "start_time": "2099-12-31T10:00:00"
+    })
+
+    response = client.get("/api/availability", params={"date": "2099-12-31", "service": "car_wellness"})
+    assert response.status_code == 200
+    starts = response.json()["starts"]
+
+    # 120 минут: не пересекается с 10:00–11:30 и заканчивается до 18:00
+    assert starts[0] == 7 * 60 + 30
+    assert 8 * 60 in starts
+    assert 8 * 60 + 30 not in starts
+    assert 11 * 60 not in starts
+    assert 11 * 60 + 30 in starts
+    assert starts[-1] == 16 * 60
+
+
+def test_availability_is_scoped_to_day():
+    client.post("/api/book", json={
+        "name": "A",
+        "phone": "1",
+        "email": "a@test.com",
+        "service": "car_spa",
+        "start_time": "2099-12-30T07:30:00"
+    })
+
+    response = client.get("/api/availability", params={"date": "2099-12-31", "service": "car_spa"})
+    assert 7 * 60 + 30 in response.json()["starts"]
+
+    response = client.get("/api/slots", params={"date": "2099-12-31"})
+    assert response.json() == []
+
+
+def test_availability_unknown_service():
+    response = client.get("/api/availability", params={"date": "2099-12-31", "service": "reinigung1"})
+    assert response.status_code == 404
+
+
+def test_day_endpoints_reject_bad_dates():
+    for url, params in (("/api/availability", {"service": "car_spa"}), ("/api/slots", {}),
+                        ("/api/busy-slots", {}), ("/api/slots/stream", {})):
+        response = client.get(url, params={"date": "31.12.2099", **params})
+        assert response.status_code == 400, url
+        assert response.json()["detail"] == "Ungültiges Datum"
+    # без даты /api/slots вернул бы все брони
+    assert client.get("/api/slots").status_code == 422
+
+
+# ------------------ схема / индексы ------------------
+def _query_plan(query):
+    compiled = query.statement.compile(dialect=engine.dialect)
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), tuple(compiled.params[k] for k in compiled.positiontup))
+        return " | ".join(r[-1] for r in rows)
+
+
+def test_hot_queries_use_indexes():
+    start, end = datetime(2099, 12, 31, 10), datetime(2099, 12, 31, 11)
+    db = SessionLocal()
+    overlap = db.query(Booking).filter(
+        Booking.status == "confirmed",
+        *overlaps(start, end)
+    )
+    day = db.query(Booking).filter(
+        Booking.status == "confirmed",
+        Booking.start_time >= start,
+        Booking.start_time < end
+    )
+    db.close()
+
+    for query in (overlap, day):
+        plan = _query_plan(query)
+        assert "USING INDEX ix_bookings_status_" in plan, plan
+        assert "SCAN bookings" not in plan, plan
+        # диапазон по start_time ограничен с обеих сторон, а не «всё до end»
+        assert "start_time>? AND start_time<?" in plan, plan
+
+
+def test_migration_adds_indexes_to_old_database():
+    old = create_engine("sqlite://", poolclass=StaticPool)
+    with old.begin() as conn:
+        # схема, которую создавал старый main.py
+        conn.exec_driver_sql(
+            "CREATE TABLE bookings (id INTEGER NOT NULL, name VARCHAR, phone VARCHAR, "
+            "email VARCHAR, service VARCHAR, start_time DATETIME, end_time DATETIME, "
+            "status VARCHAR, cancel_token VARCHAR, PRIMARY KEY (id), UNIQUE (cancel_token))"
+        )
+        conn.exec_driver_sql(
+            "INSERT INTO bookings (service, start_time, end_time, status, cancel_token) "
+            "VALUES ('car_easy', '2099-12-31 10:00:00.000000', '2099-12-31 11:30:00.000000', 'confirmed', 't1')"
+        )
+
+    assert run_migrations(old) == MIGRATIONS[-1][0]
+    # повторный запуск ничего не ломает
+    assert run_migrations(old) == MIGRATIONS[-1][0]
+
+    names = {i["name"] for i in inspect(old).get_indexes("bookings")}
+    assert {"ix_bookings_status_start", "ix_bookings_status_end"} <= names
+
+    with old.connect() as conn:
+        slots = conn.exec_driver_sql(
+            "SELECT resource, slot FROM slot_reservations ORDER BY resource, slot").all()
+    assert [tuple(r) for r in slots] == [("bay1", 600), ("bay1", 630), ("bay1", 660),
+                                         ("staff1", 600), ("staff1", 630), ("staff1", 660)]
+
+    # bookings пересоздана с AUTOINCREMENT, строки и id сохранены
+    with old.begin() as conn:
+        sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'bookings'").scalar()
+        assert "AUTOINCREMENT" in sql
+        assert conn.exec_driver_sql("SELECT id, cancel_token FROM bookings").all() == [(1, "t1")]
+        conn.exec_driver_sql("DELETE FROM bookings")
+        conn.exec_driver_sql("INSERT INTO bookings (service, cancel_token) VALUES ('car_easy', 't2')")
+        assert conn.exec_driver_sql("SELECT id FROM bookings").scalar() == 2
+
+
+def test_migration_rebuilds_reservations_per_resource():
+    old = create_engine("sqlite://", poolclass=StaticPool)
+    with old.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE bookings (id INTEGER NOT NULL, name VARCHAR, phone VARCHAR, "
+            "email VARCHAR, service VARCHAR, start_time DATETIME, end_time DATETIME, "
+            "status VARCHAR, cancel_token VARCHAR, PRIMARY KEY (id), UNIQUE (cancel_token))"
+        )
+        conn.exec_driver_sql(
+            "INSERT INTO bookings (service, start_time, end_time, status, cancel_token) "
+            "VALUES ('car_intense', '2099-12-31 10:00:00.000000', '2099-12-31 10:30:00.000000', 'confirmed', 't1')"
+        )
+        # таблица версии 2: ключ (day, slot) без ресурса
+        conn.exec_driver_sql(
+            "CREATE TABLE slot_reservations (day DATE NOT NULL, slot INTEGER NOT NULL, "
+            "booking_id INTEGER NOT NULL, PRIMARY KEY (day, slot))"
+        )
+        conn.exec_driver_sql("INSERT INTO slot_reservations VALUES ('2099-12-31', 600, 1)")
+        conn.exec_driver_sql("CREATE TABLE schema_version (version INTEGER NOT NULL PRIMARY KEY)")
+        conn.exec_driver_sql("INSERT INTO schema_version VALUES (1), (2), (3), (4)")
+
+    assert run_migrations(old) == MIGRATIONS[-1][0]
+    with old.connect() as conn:
+        rows = conn.exec_driver_sql("SELECT resource, slot FROM slot_reservations ORDER BY resource").all()
+    assert [tuple(r) for r in rows] == [("interior1", 600), ("staff1", 600)]
+
+
+# ------------------ конкурентность ------------------
+def test_concurrent_bookings_never_double_book():
+    # 20 слотов × 15 конкурентов на каждый
+    starts = [f"2099-12-{day}T{hour:02d}:{minute:02d}:00"
+              for day in (28, 29)
+              for hour in range(8, 13)
+              for minute in (0, 30)]
+    payloads = [{
+        "name": f"U{i}",
+        "phone": str(i),
+        "email": f"u{i}@test.com",
+        "service": "car_spa",
+        "start_time": starts[i % len(starts)]
+    } for i in range(len(starts) * 15)]
+
+    began = time.perf_counter()
+    with TestClient(app) as stress_client, ThreadPoolExecutor(max_workers=32) as pool:
+        post = lambda payload: stress_client.post("/api/book", json=payload).status_code
+        codes = list(pool.map(post, payloads))
+    elapsed = time.perf_counter() - began
+
+    assert set(codes) <= {200, 400}
+    assert codes.count(200) == len(starts)
+
+    db = SessionLocal()
+    confirmed = db.query(Booking).filter(Booking.status == "confirmed").order_by(Booking.start_time).all()
+    db.close()
+    for prev, cur in zip(confirmed, confirmed[1:]):
+        assert prev.end_time <= cur.start_time
+    # грубая граница: без глобальной блокировки сотни запросов проходят быстро
+    assert len(payloads) / elapsed > 20, f"{len(payloads) / elapsed:.1f} req/s"
+
+
+def test_interior_service_runs_alongside_wash():
+    # бокс один, место для салона одно, сотрудников двое
+    assert _book("2099-12-31T10:00:00", service="car_spa").status_code == 200
+    assert _book("2099-12-31T10:00:00", service="car_intense").status_code == 200
+    # бокс занят — вторая мойка не помещается
+    assert _book("2099-12-31T10:00:00", service="car_soft").status_code == 400
+
+    starts = lambda service: client.get("/api/availability", params={
+        "date": "2099-12-31", "service": service}).json()["starts"]
+    assert 600 not in starts("car_spa")
+    assert 630 in starts("car_spa")
+    assert 600 not in starts("car_intense")
+
+
+def test_allocator_picks_next_free_bay():
+    resources = {"bay1": {"kind": "bay"}, "bay2": {"kind": "bay"}, "staff1": {"kind": "staff"}}
+    schedule = DaySchedule(resources)
+    start = datetime(2099, 12, 31, 10)
+    end = start + timedelta(minutes=90)
+    assert schedule.allocate(["bay", "staff"], start, end) == ["bay1", "staff1"]
+    schedule.add(1, ["bay1"], start, end)
+    assert schedule.allocate(["bay"], start + timedelta(minutes=30), end) == ["bay2"]
+    # граница интервала не считается пересечением
+    assert schedule.allocate(["bay"], end, end + timedelta(minutes=30)) == ["bay1"]
+    schedule.add(2, ["bay2"], start, end)
+    assert schedule.allocate(["bay"], start, start + timedelta(minutes=30)) is None
+    schedule.remove(1)
+    assert schedule.allocate(["bay"], start, start + timedelta(minutes=30)) == ["bay1"]
+
+
+def test_next_available_skips_full_days_and_weekends():
+    # пятница занята целиком, суббота и воскресенье не предлагаются
+    for minute in range(450, 1080, 30):
+        assert _book(f"2099-12-25T{minute // 60:02d}:{minute % 60:02d}:00").status_code == 200
+    _book("2099-12-28T07:30:00")
+
+    response = client.get("/api/next-available", params={
+        "service": "car_spa", "after": "2099-12-25T00:00:00", "limit": 3})
+    assert response.status_code == 200
+    assert response.json()["starts"] == ["2099-12-28T08:00:00", "2099-12-28T08:30:00", "2099-12-28T09:00:00"]
+    # индекс свободных окон отбрасывает полный день без расчёта стартов
+    schedule = asyncio.run(_schedule(datetime(2099, 12, 25).date()))
+    assert not schedule.may_fit(GRID, datetime(2099, 12, 25).date(), ["bay", "staff"], 1)
+
+    # услуге для салона бокс не нужен: второй сотрудник и место для салона свободны
+    starts = client.get("/api/next-available", params={
+        "service": "car_intense", "after": "2099-12-25T00:00:00", "limit": 1}).json()["starts"]
+    assert starts == ["2099-12-25T07:30:00"]
+    assert client.get("/api/next-available", params={"service": "nope"}).status_code == 404
+
+
+async def _schedule(day):
+    async with AsyncSessionLocal() as db:
+        return await schedule_index.day(db, day)
+
+
+def _hold(start_time, service="car_spa", **extra):
+    return client.post("/api/hold", json={"service": service, "start_time": start_time, **extra})
+
+
+def _starts(day="2099-12-31", service="car_spa"):
+    return client.get("/api/availability", params={"date": day, "service": service}).json()["starts"]
+
+
+def test_hold_blocks_slot_and_converts_into_booking():
+    response = _hold("2099-12-31T10:00:00")
+    assert response.status_code == 200
+    token = response.json()["hold_token"]
+    assert 600 not in _starts()
+    # другой клиент не может ни удержать, ни забронировать это время
+    other = TestClient(app, client=("10.0.0.2", 50000))
+    assert other.post("/api/hold", json={"service": "car_spa", "start_time": "2099-12-31T10:00:00"}).status_code == 400
+    assert _book("2099-12-31T10:00:00").status_code == 400
+    assert client.get("/api/admin/bookings").json() == []
+
+    response = client.post("/api/book", json={
+        "name": "A", "phone": "1", "email": "a@test.com",
+        "service": "car_spa", "start_time": "2099-12-31T10:00:00", "hold_token": token})
+    assert response.status_code == 200
+    with SessionLocal() as db:
+        assert db.query(SlotHold).count() == 0
+        assert [b.status for b in db.query(Booking).all()] == ["confirmed"]
+        assert db.query(SlotReservation).count() == 2  # бокс и сотрудник — те же строки
+    assert [b["name"] for b in client.get("/api/admin/bookings").json()] == ["A"]
+    assert _stats(**{"from": "2099-12-31", "to": "2099-12-31"})["total"]["bookings"] == 1
+
+
+def test_expired_holds_are_swept_and_slot_freed():
+    first = _hold("2099-12-31T10:00:00").json()["hold_token"]
+    # новый выбор того же клиента снимает прежнее удержание
+    second = _hold("2099-12-31T11:00:00", release=first).json()["hold_token"]
+    assert 600 in _starts() and 660 not in _starts()
+
+    later = datetime.now() + timedelta(hours=1)
+    assert asyncio.run(hold_sweeper.sweep(now=later)) == 1
+    assert hold_sweeper.heap == []
+    assert 660 in _starts()
+    with SessionLocal() as db:
+        assert db.query(Booking).count() == 0 and db.query(SlotReservation).count() == 0
+
+    # просроченный токен: бронь проходит обычным путём
+    response = client.post("/api/book", json={
+        "name": "A", "phone": "1", "email": "a@test.com",
+        "service": "car_spa", "start_time": "2099-12-31T11:00:00", "hold_token": second})
+    assert response.status_code == 200
+
+
+def test_new_hold_replaces_previous_hold_of_same_client():
+    _hold("2099-12-31T10:00:00")
+    _hold("2099-12-31T11:00:00")
+    assert 600 in _starts() and 660 not in _starts()
+    # тот же IP (NAT, прокси), но другая сессия — её удержание не снимает чужие
+    other = TestClient(app)
+    assert other.post("/api/hold", json={"service": "car_spa", "start_time": "2099-12-31T12:00:00"}).status_code == 200
+    assert 660 not in _starts() and 720 not in _starts()
+    with SessionLocal() as db:
+        sessions = [h.client for h in db.query(SlotHold).all()]
+    assert sorted(sessions) == sorted([client.cookies["hold_session"], other.cookies["hold_session"]])
+    assert len(set(sessions)) == 2
+
+
+def test_admin_cancel_of_hold_releases_it_without_stats():
+    _hold("2099-12-31T10:00:00")
+    held = client.get("/api/admin/bookings", params={"status": "held"}).json()
+    assert client.post(f"/api/admin/cancel/{held[0]['id']}").json() == {"ok": True}
+    assert 600 in _starts()
+    with SessionLocal() as db:
+        assert db.query(Booking).count() == 0 and db.query(SlotHold).count() == 0
+    assert all(value == 0 for value in _stats(**{"from": "2099-12-31", "to": "2099-12-31"})["total"].values())
+
+
+def test_cancel_frees_reserved_slots():
+    payload = {
+        "name": "A",
+        "phone": "1",
+        "email": "a@test.com",
+        "service": "car_easy",
+        "start_time": "2099-12-31T10:00:00"
+    }
+    client.post("/api/book", json=payload)
+    booking_id = client.get("/api/admin/bookings").json()[0]["id"]
+    client.post(f"/api/admin/cancel/{booking_id}")
+
+    response = client.post("/api/book", json=payload)
+    assert response.status_code == 200
+
+
+# ------------------ сессии / SQLite ------------------
+def test_sqlite_runs_in_wal_mode():
+    db = SessionLocal()
+    assert db.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+    assert db.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+    db.close()
+
+
+def test_sqlite_writers_queue_in_process_instead_of_busy_waiting():
+    from sqlalchemy import delete, update
+    from backend.database import SQLITE_PRAGMAS
+
+    async def run():
+        async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+            # без busy handler: запись второго пройдёт, только если он ждёт в очереди процесса
+            # (соединение открываем заранее — PRAGMA при подключении тоже ждут блокировку)
+            await second.execute(text("PRAGMA busy_timeout=0"))
+            await first.execute(update(Booking).values(status="confirmed"))
+
+            async def write():
+                try:
+                    await second.execute(delete(SlotHold))
+                finally:
+                    await second.execute(text(f"PRAGMA busy_timeout={SQLITE_PRAGMAS['busy_timeout']}"))
+                await second.commit()
+
+            task = asyncio.create_task(write())
+            await asyncio.sleep(0.05)
+            assert not task.done()
+            await first.commit()
+            await task
+
+    asyncio.run(run())
+
+
+def test_session_released_when_handler_raises():
+    response = client.post("/api/admin/cancel/999")
+    assert response.status_code == 404
+    assert async_engine.pool.checkedout() == 0
+
+
+def test_cancel_link():
+    token = client.post("/api/book", json={
+        "name": "A",
+        "phone": "1",
+        "email": "a@test.com",
+        "service": "car_spa",
+        "start_time": "2099-12-31T10:00:00"
+    }).json()["cancel_token"]
+
+    response = client.get(f"/cancel/{token}")
+    assert response.status_code == 200
+    assert client.get("/api/admin/bookings").json()[0]["status"] == "canceled"
+
+    # повторный переход по ссылке
+    response = client.get(f"/cancel/{token}")
+    assert response.status_code == 200
+
+
+def test_forged_and_expired_cancel_links_skip_database():
+    token = _book("2099-12-31T10:00:00").json()["cancel_token"]
+    forged = token[:-2] + ("AA" if not token.endswith("AA") else "BB")
+    booking_id = int(token.split(".")[1], 36)
+    expired = sign(cancel_secret(), booking_id, int(datetime(2000, 1, 1).timestamp()))
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(async_engine.sync_engine, "before_cursor_execute", listener)
+    try:
+        for link, status in ((forged, "not_found"), (expired, "expired"), ("c1.zz", "not_found")):
+            response = client.get(f"/cancel/{link}", follow_redirects=False)
+            assert response.status_code == 303
+            assert response.headers["location"] == f"/cancel?status={status}"
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", listener)
+    assert statements == []
+    assert client.get("/api/admin/bookings").json()[0]["status"] == "confirmed"
+
+
+def test_cancel_link_does_not_match_other_booking_with_same_id():
+    token = _book("2099-12-31T10:00:00").json()["cancel_token"]
+    booking_id = int(token.split(".")[1], 36)
+    with SessionLocal() as db:
+        db.query(Booking).filter(Booking.id == booking_id).update({"start_time": datetime(2099, 12, 31, 12)})
+        db.commit()
+    response = client.get(f"/cancel/{token}", follow_redirects=False)
+    assert response.headers["location"] == "/cancel?status=not_found"
+    assert client.get("/api/admin/bookings").json()[0]["status"] == "confirmed"
+
+
+def test_cancel_secret_is_required_and_not_derived_from_admin_password(monkeypatch):
+    from pydantic import ValidationError
+    Settings = type(get_settings())
+    for value in (None, "short"):
+        if value is None:
+            monkeypatch.delenv("CANCEL_TOKEN_SECRET", raising=False)
+        else:
+            monkeypatch.setenv("CANCEL_TOKEN_SECRET", value)
+        with pytest.raises(ValidationError):
+            Settings(_env_file=None)
+    assert cancel_secret() == get_settings().CANCEL_TOKEN_SECRET.encode() != get_settings().ADMIN_PASS.encode()
+
+
+def test_legacy_uuid_cancel_link_still_works():
+    _book("2099-12-31T10:00:00")
+    with SessionLocal() as db:
+        db.query(Booking).update({"cancel_token": "3f2c8a4e-legacy"})
+        db.commit()
+    assert client.get("/cancel/3f2c8a4e-legacy").status_code == 200
+    assert client.get("/api/admin/bookings").json()[0]["status"] == "canceled"
+
+
+def test_rate_limit_per_ip_and_route(monkeypatch):
+    monkeypatch.setattr(get_settings(), "ADMISSION_CONTROL", True)
+    monkeypatch.setattr(main_module, "rate_limiter", RateLimiter())
+    login = lambda: client.post("/admin/login", data={"user": "x", "password": "y"})
+    assert [login().status_code for _ in range(5)] == [401] * 5
+    response = login()
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    # у другого маршрута своё ведро
+    assert _book("2099-12-31T10:00:00").status_code == 200
+
+
+def test_client_address_behind_trusted_proxy(monkeypatch):
+    from starlette.requests import Request
+
+    def address(peer, forwarded=None):
+        headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+        return main_module.client_address(Request({"type": "http", "client": (peer, 5000), "headers": headers}))
+
+    # без настройки заголовок никто не читает: его может прислать сам клиент
+    assert address("203.0.113.7", "198.51.100.1") == "203.0.113.7"
+    monkeypatch.setattr(get_settings(), "TRUSTED_PROXIES", "127.0.0.1, 10.0.0.0/8")
+    assert address("127.0.0.1", "198.51.100.1") == "198.51.100.1"
+    # цепочка прокси; подделанный клиентом левый адрес игнорируется
+    assert address("127.0.0.1", "6.6.6.6, 198.51.100.1, 10.1.2.3") == "198.51.100.1"
+    # прямое соединение не от прокси — заголовок не учитывается
+    assert address("203.0.113.7", "198.51.100.1") == "203.0.113.7"
+    assert address("127.0.0.1") == "127.0.0.1"
+
+
+def test_token_bucket_refills_over_time():
+    buckets, limit = MemoryBuckets(), Limit(per_minute=60, burst=2)
+    assert [asyncio.run(buckets.take("ip", limit, 100.0)) for _ in range(3)] == [0, 0, 1.0]
+    assert asyncio.run(buckets.take("ip", limit, 101.0)) == 0
+    assert asyncio.run(buckets.take("other", limit, 101.0)) == 0
+
+
+def test_rate_limiter_falls_back_locally_and_logs_redis_outage_once(caplog):
+    class DownRedis:
+        async def take(self, key, limit, now):
+            raise ConnectionError("down")
+
+    limiter = RateLimiter()
+    limiter.shared = DownRedis()
+    with caplog.at_level("WARNING", logger="carwash.admission"):
+        for second in range(3):
+            asyncio.run(limiter.check("book", "ip", now=100.0 + second))
+        asyncio.run(limiter.check("book", "ip", now=200.0))
+    warnings = [r.getMessage() for r in caplog.records if r.name == "carwash.admission"]
+    assert len(warnings) == 2 and "ошибок: 3" in warnings[1]
+
+
+def test_gate_sheds_load_beyond_queue():
+    async def run():
+        gate = Gate("book", limit=1, queue=1, timeout=0.05)
+        await gate.enter()
+        waiting = asyncio.create_task(gate.enter())
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as full:
+            await gate.enter()
+        # слот освобождается — его получает ждущий, а не новый запрос
+        gate.leave()
+        await waiting
+        assert gate.active == 1
+        with pytest.raises(Rejected) as timeout:
+            await gate.enter()
+        gate.leave()
+        assert gate.active == 0
+        return full.value, timeout.value
+
+    full, timeout = asyncio.run(run())
+    assert (full.status, full.retry_after) == (503, 1)
+    assert timeout.status == 503
+
+
+# ------------------ кэш / ETag ------------------
+def _book(start_time, service="car_spa"):
+    return client.post("/api/book", json={
+        "name": "A",
+        "phone": "1",
+        "email": "a@test.com",
+        "service": service,
+        "start_time": start_time
+    })
+
+
+def test_availability_etag_304_without_db():
+    params = {"date": "2099-12-31", "service": "car_spa"}
+    first = client.get("/api/availability", params=params)
+    etag = first.headers["etag"]
+
+    statements = []
+    def count(*args):
+        statements.append(args)
+    event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+    try:
+        second = client.get("/api/availability", params=params, headers={"If-None-Match": etag})
+        third = client.get("/api/availability", params=params)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", count)
+
+    assert second.status_code == 304
+    assert second.content == b""
+    assert third.content == first.content
+    assert statements == []
+
+
+def test_write_invalidates_only_affected_day():
+    params_31 = {"date": "2099-12-31", "service": "car_spa"}
+    params_30 = {"date": "2099-12-30", "service": "car_spa"}
+    etag_31 = client.get("/api/availability", params=params_31).headers["etag"]
+    etag_30 = client.get("/api/availability", params=params_30).headers["etag"]
+
+    token = _book("2099-12-31T10:00:00").json()["cancel_token"]
+
+    response = client.get("/api/availability", params=params_31, headers={"If-None-Match": etag_31})
+    assert response.status_code == 200
+    assert 600 not in response.json()["starts"]
+    assert client.get("/api/availability", params=params_30, headers={"If-None-Match": etag_30}).status_code == 304
+
+    # отмена снова открывает слот
+    busy = client.get("/api/busy-slots", params={"date": "2099-12-31"})
+    assert len(busy.json()) == 1
+    client.get(f"/cancel/{token}")
+    response = client.get("/api/busy-slots", params={"date": "2099-12-31"},
+                          headers={"If-None-Match": busy.headers["etag"]})
+    assert response.status_code == 200
+    assert response.json() == []
+
+
+def test_slot_events_push_diffs_on_book_and_cancel():
+    day = datetime(2099, 12, 31).date()
+    sub = slot_events.subscribe(day)
+    try:
+        token = _book("2099-12-31T10:00:00").json()["cancel_token"]
+        taken = sub.queue.get_nowait()
+        assert (taken["type"], taken["start"], taken["end"]) == ("taken", 600, 630)
+        # окно (from, to) покрывает все старты, которые могла задеть бронь
+        assert taken["free"]["car_spa"] == [510, 540, 570]
+        # салон и второй сотрудник свободны
+        assert 600 in taken["free"]["car_intense"]
+
+        client.get(f"/cancel/{token}")
+        freed = sub.queue.get_nowait()
+        assert freed["type"] == "freed"
+        assert 600 in freed["free"]["car_spa"]
+        assert sub.queue.empty()
+    finally:
+        slot_events.unsubscribe(sub)
+    assert slot_events.total() == 0
+
+
+def test_slow_subscriber_gets_reset_instead_of_backlog():
+    channels = DayChannels(queue_size=2)
+    day = datetime(2099, 12, 31).date()
+    slow = channels.subscribe(day)
+    other_day = channels.subscribe(datetime(2099, 12, 30).date())
+    for i in range(5):
+        channels.publish(day, {"type": "taken", "start": i})
+    assert slow.queue.qsize() <= 2
+    assert RESET in [slow.queue.get_nowait() for _ in range(slow.queue.qsize())]
+    assert other_day.queue.empty()
+
+
+def test_slots_stream_sends_events_over_sse():
+    day = datetime(2099, 12, 31).date()
+
+    async def run():
+        chunks, disconnect = [], asyncio.Event()
+
+        async def receive():
+            await disconnect.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                chunks.append(dict(message["headers"])[b"content-type"])
+            elif message.get("body"):
+                chunks.append(message["body"])
+                if b"event: taken" in message["body"]:
+                    disconnect.set()
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": "/api/slots/stream", "raw_path": b"/api/slots/stream",
+                 "query_string": b"date=2099-12-31", "headers": [], "server": ("test", 80),
+                 "client": ("127.0.0.1", 1), "root_path": ""}
+        in_flight = http_in_flight.values.get((), 0)
+        timed = dict(http_latency.series)
+        stream = asyncio.create_task(app(scope, receive, send))
+        while not slot_events.subscribers(day):
+            await asyncio.sleep(0.01)
+        # открытый поток — в своём счётчике, не среди обрабатываемых запросов
+        assert http_streams_open.values[("/api/slots/stream",)] == 1
+        assert http_in_flight.values.get((), 0) == in_flight
+        slot_events.publish(day, {"type": "taken", "from": 480, "to": 630, "free": {}})
+        await asyncio.wait_for(stream, 5)
+        # поток не попал в гистограмму задержек
+        assert {k: v[-1] for k, v in http_latency.series.items()} == {k: v[-1] for k, v in timed.items()}
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert chunks[0].startswith(b"text/event-stream")
+    assert chunks[1].startswith(b"retry:")
+    assert b'event: taken\ndata: {"type": "taken", "from": 480' in b"".join(chunks)
+    # поток закрыт — подписка снята
+    assert slot_events.subscribers(day) == 0
+    assert http_streams_open.values[("/api/slots/stream",)] == 0
+
+
+def test_cache_sync_applies_other_workers_changes():
+    day = datetime(2099, 12, 31).date()
+    changed, resets = [], []
+    sync = CacheSync(async_engine, changed.extend, lambda: resets.append(True), origin="worker-a")
+
+    def write(origin, d=day, row_id=None):
+        db = SessionLocal()
+        db.add(CacheInvalidation(id=row_id, day=d, origin=origin))
+        db.commit()
+        row_id = db.query(CacheInvalidation.id).order_by(CacheInvalidation.id.desc()).first()[0]
+        db.close()
+        return row_id
+
+    async def run():
+        await sync.prime()
+        try:
+            assert await sync.poll() == 0
+            write("worker-b")
+            write("worker-a", day - timedelta(days=1))  # свои изменения уже применены
+            assert await sync.poll() == 1
+            assert changed == [day]
+            write("worker-a")
+            assert await sync.poll() == 0
+
+            # id пропущен (откат или транзакция ещё не закоммитилась) — это не повод сбрасывать всё
+            last = write("worker-b", day - timedelta(days=2))
+            skipped = last + 1
+            write("worker-b", day - timedelta(days=3), row_id=last + 2)
+            assert await sync.poll() == 2
+            assert list(sync.missing) == [skipped] and resets == []
+            # транзакция с меньшим id закоммитилась позже — изменение не теряется
+            write("worker-b", day - timedelta(days=4), row_id=skipped)
+            assert await sync.poll() == 1
+            assert changed[-1] == day - timedelta(days=4)
+            assert sync.missing == {}
+
+            # воркер не опрашивал дольше хранения строк — мог пропустить удалённые, сбрасываем всё
+            sync._polled_at -= CACHE_SYNC_RETENTION + 1
+            await sync.poll()
+            assert resets == [True]
+        finally:
+            await sync.stop()
+
+    asyncio.run(run())
+
+
+def test_remote_change_invalidates_local_caches():
+    params = {"date": "2099-12-31", "service": "car_spa"}
+    etag = client.get("/api/availability", params=params).headers["etag"]
+    sub = slot_events.subscribe(datetime(2099, 12, 31).date())
+    try:
+        apply_remote_changes([datetime(2099, 12, 31).date()])
+        assert sub.queue.get_nowait() == RESET
+    finally:
+        slot_events.unsubscribe(sub)
+    assert client.get("/api/availability", params=params, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_import_does_no_io(tmp_path):
+    # фабрика: настройки, схема, почта и шаблоны — только в lifespan/по требованию
+    env = {k: v for k, v in os.environ.items() if not k.startswith(("MAIL_", "ADMIN_"))}
+    env["DATABASE_URL"] = f"sqlite:///{tmp_path}/lazy.db"
+    result = subprocess.run([sys.executable, "-c", "import backend.main"], cwd=BASE_DIR, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert not os.path.exists(tmp_path / "lazy.db")
+
+
+def test_day_cache_is_bounded():
+    cache = DayCache(max_entries=2, ttl=60)
+    day = datetime(2099, 12, 31).date()
+    for key in ("a", "b", "c"):
+        cache.put(day, key, cache.version(day), key.encode())
+    assert cache.get(day, "a") is None
+    assert cache.get(day, "c") == b"c"
+
+    # запись, прочитанная до инвалидации, не кэшируется
+    version = cache.version(day)
+    cache.invalidate(day)
+    cache.put(day, "d", version, b"stale")
+    assert cache.get(day, "d") is None
+
+
+# ------------------ outbox ------------------
+class RecordingHandler:
+    def __init__(self):
+        self.messages = []
+        self.sessions = set()
+
+    async def handle_DATA(self, server, session, envelope):
+        self.sessions.add(id(session))
+        self.messages.append(envelope)
+        return "250 OK"
+
+
+@pytest.fixture
+def smtp_server():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    yield handler, port
+    controller.stop()
+
+
+def _smtp_conf(port):
+    return ConnectionConfig(
+        MAIL_USERNAME="test", MAIL_PASSWORD="test", MAIL_FROM="noreply@test.com",
+        MAIL_SERVER="127.0.0.1", MAIL_PORT=port,
+        MAIL_STARTTLS=False, MAIL_SSL_TLS=False, USE_CREDENTIALS=False,
+    )
+
+
+def _outbox():
+    db = SessionLocal()
+    rows = db.query(OutboxMessage).order_by(OutboxMessage.id).all()
+    db.close()
+    return rows
+
+
+def test_booking_writes_outbox_in_same_transaction():
+    _book("2099-12-31T10:00:00")
+    _book("2099-12-31T10:00:00")  # конфликт — писем нет
+
+    rows = _outbox()
+    # администратору — не письмо, а событие для сводки (термин не скоро)
+    assert [r.subject for r in rows] == ["Bestätigung Ihrer Buchung"]
+    assert rows[0].recipients == "a@test.com"
+    assert all(r.status == "pending" for r in rows)
+    assert len(_admin_events()) == 1
+
+
+def _admin_events():
+    with SessionLocal() as db:
+        return db.query(AdminEvent).order_by(AdminEvent.id).all()
+
+
+def test_admin_notifications_are_coalesced_into_one_digest():
+    for hour in (9, 10, 11):
+        _book(f"2099-12-31T{hour:02d}:00:00")
+    token = _book("2099-12-30T10:00:00").json()["cancel_token"]
+    client.get(f"/cancel/{token}")
+    assert [e.kind for e in _admin_events()] == ["booking"] * 4 + ["cancel"]
+
+    assert asyncio.run(admin_digest.flush()) == 5
+    admin_mail = [r for r in _outbox() if r.recipients == "admin@test.com"]
+    assert [r.subject for r in admin_mail] == ["Zusammenfassung: 4 neue Buchungen, 1 Stornierungen"]
+    assert "31.12.2099 11:00" in admin_mail[0].body
+    assert _admin_events() == []
+    # пустое окно — письма нет
+    assert asyncio.run(admin_digest.flush()) == 0
+    assert len(_outbox()) == 5
+
+
+def test_urgent_admin_notification_is_sent_immediately(monkeypatch):
+    monkeypatch.setattr(admin_digest, "urgent_within", timedelta(days=365 * 100))
+    _book("2099-12-31T10:00:00")
+    assert [r.subject for r in _outbox()] == ["Bestätigung Ihrer Buchung", "Neue Buchung eingegangen"]
+    assert _admin_events() == []
+
+
+def test_urgent_admin_notification_goes_to_whatsapp_when_configured(monkeypatch):
+    import types
+    monkeypatch.setattr(admin_digest, "urgent_within", timedelta(days=365 * 100))
+    monkeypatch.setattr(admin_digest, "whatsapp_to", "+491700000000")
+    _book("2099-12-31T10:00:00")
+    whatsapp = [r for r in _outbox() if r.channel == "whatsapp"]
+    assert [(r.recipients, r.body.split(":")[0]) for r in whatsapp] == [("+491700000000", "Neue Buchung eingegangen")]
+
+    # доставка — тем же воркером; Twilio подменяем
+    sent = []
+    fake = types.ModuleType("whatsapp_service")
+    fake.send_whatsapp = lambda body, to=None: sent.append((to, body))
+    monkeypatch.setitem(sys.modules, "backend.my_services.whatsapp_service", fake)
+    with SessionLocal() as db:
+        db.query(OutboxMessage).filter(OutboxMessage.channel == "email").delete()
+        db.commit()
+    assert asyncio.run(OutboxWorker(AsyncSessionLocal, None).process_batch()) == 1
+    assert sent == [("+491700000000", whatsapp[0].body)]
+    assert [r.status for r in _outbox()] == ["sent"]
+
+
+def test_digest_windows_align_across_workers():
+    digest = AdminDigest(AsyncSessionLocal, lambda: [], interval=300)
+    assert digest.next_window(datetime(2099, 1, 1, 10, 3, 7)) == datetime(2099, 1, 1, 10, 5)
+    daily = AdminDigest(AsyncSessionLocal, lambda: [], interval=86400)
+    assert daily.next_window(datetime(2099, 1, 1, 10, 3)) == datetime(2099, 1, 2)
+
+
+def _book_batch(*items):
+    return client.post("/api/book/batch", json={
+        "name": "Fuhrpark GmbH",
+        "phone": "1",
+        "email": "fleet@test.com",
+        "items": [{"service": service, "start_time": start} for service, start in items]
+    })
+
+
+def test_batch_booking_is_all_or_nothing():
+    response = _book_batch(("car_spa", "2099-12-31T10:00:00"),
+                           ("car_intense", "2099-12-31T10:00:00"),
+                           ("car_spa", "2099-12-30T10:00:00"))
+    assert response.status_code == 200
+    assert len(response.json()["bookings"]) == 3
+    # одно общее письмо клиенту и одно событие для сводки администратору
+    assert [r.subject for r in _outbox()] == ["Bestätigung Ihrer Buchungen"]
+    assert [e.kind for e in _admin_events()] == ["booking"]
+
+    # вторая заявка пакета конфликтует с первой — не сохраняется ничего
+    response = _book_batch(("car_spa", "2099-12-29T10:00:00"), ("car_soft", "2099-12-29T10:00:00"))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Fahrzeug 2: Zeit bereits belegt"
+    # конфликт с уже существующей бронью
+    response = _book_batch(("car_spa", "2099-12-29T11:00:00"), ("car_easy", "2099-12-31T09:30:00"))
+    assert response.status_code == 400
+    assert len(client.get("/api/admin/bookings").json()) == 3
+    assert len(_outbox()) == 1
+
+
+def test_batch_booking_validates_every_item():
+    response = _book_batch(("car_spa", "2099-12-31T10:00:00"), ("car_spa", "2099-12-31T17:45:00"))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Fahrzeug 2: Außerhalb der Arbeitszeiten"
+    assert _book_batch().status_code == 400
+    response = _book_batch(("car_spa", "2099-12-31T10:00:00"), ("car_spa", "31.12.2099 11:00"))
+    assert (response.status_code, response.json()["detail"]) == (400, "Fahrzeug 2: Ungültiges Datum")
+    response = client.post("/api/book/batch", json={
+        "name": "Fuhrpark GmbH", "phone": "1", "email": "fleet@test.com",
+        "items": [{"service": "car_spa", "start_time": "2099-12-31T10:00:00"}, {"service": "car_spa"}]})
+    assert (response.status_code, response.json()["detail"]) == (400, "Fahrzeug 2: Service und Startzeit erforderlich")
+    # поля заявки целиком проверяются до записи, а не KeyError после flush
+    item = {"service": "car_spa", "start_time": "2099-12-31T10:00:00"}
+    response = client.post("/api/book/batch", json={"name": "Fuhrpark GmbH", "phone": "1", "items": [item]})
+    assert (response.status_code, response.json()["detail"]) == (400, "E-Mail erforderlich")
+    response = client.post("/api/book/batch", json={
+        "name": "Fuhrpark GmbH", "phone": "1", "email": "fleet@test.com", "items": 5})
+    assert response.status_code == 400
+    assert client.get("/api/admin/bookings").json() == []
+
+
+def test_book_and_hold_require_their_fields():
+    response = client.post("/api/book", json={"name": "A", "phone": "1", "start_time": "2099-12-31T10:00:00"})
+    assert (response.status_code, response.json()["detail"]) == (400, "Service, E-Mail erforderlich")
+    response = client.post("/api/book", json={"service": "car_spa", "start_time": "2099-12-31T10:00:00"})
+    assert (response.status_code, response.json()["detail"]) == (400, "Name, Telefon, E-Mail erforderlich")
+    response = client.post("/api/hold", json={"service": "car_spa"})
+    assert (response.status_code, response.json()["detail"]) == (400, "Startzeit erforderlich")
+    with SessionLocal() as db:
+        assert db.query(Booking).count() == 0 and db.query(SlotHold).count() == 0
+
+
+def test_outbox_worker_batches_over_one_connection(smtp_server, monkeypatch):
+    handler, port = smtp_server
+    monkeypatch.setattr(admin_digest, "interval", 0)  # без сводок: письмо администратору на каждую бронь
+    for i in range(5):
+        _book(f"2099-12-31T{10 + i}:00:00")
+
+    worker = OutboxWorker(AsyncSessionLocal, _smtp_conf(port))
+
+    async def run():
+        handled = await worker.process_batch()
+        await worker.smtp.close()
+        return handled
+
+    assert asyncio.run(run()) == 10
+    assert len(handler.messages) == 10
+    assert len(handler.sessions) == 1
+    assert worker.smtp.connects == 1
+    assert {r.status for r in _outbox()} == {"sent"}
+
+
+def test_outbox_retries_with_backoff_when_smtp_down(monkeypatch):
+    monkeypatch.setattr(admin_digest, "interval", 0)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        closed_port = sock.getsockname()[1]
+    _book("2099-12-31T10:00:00")
+
+    worker = OutboxWorker(AsyncSessionLocal, _smtp_conf(closed_port))
+    assert asyncio.run(worker.process_batch()) == 2
+
+    rows = _outbox()
+    assert all(r.status == "pending" and r.attempts == 1 and r.last_error for r in rows)
+    assert all(r.next_attempt_at > datetime.now() for r in rows)
+    # до истечения backoff повторно не берём
+    assert asyncio.run(worker.process_batch()) == 0
+
+
+# ------------------ админка: пагинация / экспорт ------------------
+def _seed(n, day=datetime(2099, 1, 1, 8), status="confirmed", service="car_spa"):
+    db = SessionLocal()
+    for i in range(n):
+        start = day + timedelta(days=i // 10, minutes=30 * (i % 10))
+        db.add(Booking(name=f"N{i}", phone=str(i), email=f"n{i}@test.com", service=service,
+                       start_time=start, end_time=start + timedelta(minutes=30),
+                       status=status, cancel_token=f"{status}-{service}-{i}"))
+    db.commit()
+    db.close()
+
+
+def test_admin_bookings_keyset_pagination():
+    _seed(25)
+    seen, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": 10}
+        if cursor:
+            params["cursor"] = cursor
+        response = client.get("/api/admin/bookings", params=params)
+        seen += [b["id"] for b in response.json()]
+        pages += 1
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+
+    assert pages == 3
+    assert len(seen) == len(set(seen)) == 25
+
+
+def test_admin_bookings_filters():
+    _seed(20)
+    _seed(5, day=datetime(2099, 1, 1, 8), status="canceled", service="car_easy")
+
+    response = client.get("/api/admin/bookings", params={"date_from": "2099-01-02", "date_to": "2099-01-02"})
+    assert len(response.json()) == 10
+
+    response = client.get("/api/admin/bookings", params={"status": "canceled"})
+    assert len(response.json()) == 5
+    assert {b["service"] for b in response.json()} == {"CAR EASY"}
+
+    response = client.get("/api/admin/bookings", params={"cursor": "kaputt"})
+    assert response.status_code == 400
+
+    # кривая дата — 400, а не 500 из fromisoformat; выгрузка проверяет до начала потока
+    for url in ("/api/admin/bookings", "/api/admin/bookings/export"):
+        for params in ({"date_from": "garbage"}, {"date_to": "31.12.2099"}):
+            response = client.get(url, params=params)
+            assert response.status_code == 400, (url, params)
+            assert response.json()["detail"] == "Ungültiges Datum"
+
+
+def test_admin_export_streams_csv_and_ndjson():
+    _seed(12)
+
+    response = client.get("/api/admin/bookings/export", params={"format": "csv", "date_to": "2099-01-01"})
+    assert response.headers["content-type"].startswith("text/csv")
+    rows = list(csv.reader(io.StringIO(response.text)))
+    assert rows[0] == ["id", "name", "phone", "email", "service", "start_time", "end_time", "status"]
+    assert len(rows) == 11
+    assert rows[1][5] == "2099-01-01T08:00:00"
+
+    response = client.get("/api/admin/bookings/export", params={"format": "ndjson"})
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 12
+    assert lines[0]["email"] == "n0@test.com"
+
+
+# ------------------ страницы / static ------------------
+def test_archive_moves_past_and_canceled_bookings():
+    now = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    _seed(3, day=now - timedelta(days=400))                      # давно прошли
+    _seed(2, day=now - timedelta(days=5), service="car_soft")    # недавние — остаются
+    _seed(2, day=datetime(2099, 1, 1, 8), status="canceled")     # отменённые
+    _seed(1, day=datetime(2099, 1, 2, 8), service="car_easy")    # будущие
+    db = SessionLocal()
+    old_id = db.query(Booking.id).order_by(Booking.start_time).first()[0]
+    db.add(SlotReservation(day=(now - timedelta(days=400)).date(), resource="bay1", slot=480, booking_id=old_id))
+    db.commit()
+    db.close()
+
+    worker = ArchiveWorker(AsyncSessionLocal, async_engine, batch_size=2)
+    assert asyncio.run(worker.run_once()) == 5
+    assert asyncio.run(worker.run_once()) == 0
+
+    db = SessionLocal()
+    assert db.query(Booking).count() == 3
+    assert db.query(ArchivedBooking).count() == 5
+    assert db.query(SlotReservation).count() == 0
+    db.close()
+
+    # админка и выгрузка читают обе таблицы в общем порядке
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/api/admin/bookings", params=params)
+        seen += response.json()
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == 8
+    assert [b["archived"] for b in seen] == [True] * 3 + [False] * 2 + [True] * 2 + [False]
+    assert [b["status"] for b in seen if b["archived"]][-2:] == ["canceled", "canceled"]
+    export = client.get("/api/admin/bookings/export", params={"format": "ndjson"}).text.splitlines()
+    assert [json.loads(line)["id"] for line in export] == [b["id"] for b in seen]
+
+    # ссылка отмены из старого письма всё ещё открывается
+    assert client.get("/cancel/canceled-car_spa-0").status_code == 200
+
+
+def _stats(**params):
+    response = client.get("/api/admin/stats", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def _daily_stats_rows():
+    with SessionLocal() as db:
+        return sorted((r.day, r.service, r.bookings, r.canceled, r.minutes, r.revenue)
+                      for r in db.query(DailyStat).all())
+
+
+def test_parallel_cancels_of_one_booking_count_once():
+    tokens = [_book(f"2099-12-30T{hour:02d}:00:00").json()["cancel_token"] for hour in (9, 11)]
+    admin_id = int(tokens[1].split(".")[1], 36)
+    with TestClient(app) as parallel, ThreadPoolExecutor(max_workers=10) as pool:
+        link = pool.map(lambda _: parallel.get(f"/cancel/{tokens[0]}").status_code, range(5))
+        admin = pool.map(lambda _: parallel.post(f"/api/admin/cancel/{admin_id}").status_code, range(5))
+        assert set(link) == set(admin) == {200}
+        # до остановки: при выходе сводка забирает события в outbox
+        with SessionLocal() as db:
+            assert db.query(AdminEvent).filter(AdminEvent.kind == "cancel").count() == 1
+
+    total = _stats(**{"from": "2099-12-30", "to": "2099-12-30"})["total"]
+    assert (total["bookings"], total["canceled"], total["revenue"]) == (0, 2, 0)
+
+
+def test_daily_stats_follow_bookings_and_cancels():
+    _book("2099-12-30T09:00:00")
+    token = _book("2099-12-30T10:00:00", service="car_soft").json()["cancel_token"]
+    _book_batch(("car_spa", "2099-12-31T09:00:00"), ("car_intense", "2099-12-31T09:00:00"))
+    client.get(f"/cancel/{token}")
+    booking_id = client.get("/api/admin/bookings").json()[0]["id"]
+    client.post(f"/api/admin/cancel/{booking_id}")
+    client.post(f"/api/admin/cancel/{booking_id}")  # повторная отмена не считается дважды
+
+    stats = _stats(**{"from": "2099-12-30", "to": "2099-12-31"})
+    first, second = stats["days"]
+    assert (first["date"], first["bookings"], first["canceled"]) == ("2099-12-30", 0, 2)
+    assert first["revenue"] == 0 and first["minutes"] == 0
+    spa, intense = SERVICES["car_spa"], SERVICES["car_intense"]
+    assert second["bookings"] == 2
+    assert second["minutes"] == spa["duration"] + intense["duration"]
+    assert second["revenue"] == spa["price"] + intense["price"]
+    assert stats["total"]["canceled"] == 2
+
+    # пересчёт с нуля даёт те же строки, что и инкременты
+    incremental = _daily_stats_rows()
+    with engine.begin() as conn:
+        rebuild_stats(conn)
+    assert _daily_stats_rows() == incremental
+
+
+def test_stats_backfill_counts_archived_bookings():
+    old = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) - timedelta(days=400)
+    _seed(3, day=old)
+    asyncio.run(ArchiveWorker(AsyncSessionLocal, async_engine).run_once())
+    with engine.begin() as conn:
+        assert rebuild_stats(conn) == 1
+
+    stats = _stats(**{"from": old.date().isoformat(), "to": old.date().isoformat()})
+    assert stats["total"]["bookings"] == 3
+    assert stats["days"][0]["services"]["car_spa"]["revenue"] == 3 * SERVICES["car_spa"]["price"]
+    assert client.get("/api/admin/stats", params={"from": "2099-12-31", "to": "2099-01-01"}).status_code == 400
+
+
+def test_archived_ids_are_never_reused():
+    token = _book("2099-12-30T10:00:00").json()["cancel_token"]
+    client.get(f"/cancel/{token}")
+    # отменённая бронь с наибольшим id уходит в архив
+    worker = ArchiveWorker(AsyncSessionLocal, async_engine)
+    assert asyncio.run(worker.run_once()) == 1
+
+    _book("2099-12-30T10:00:00")
+    _book("2099-12-30T11:00:00")
+    confirmed = client.get("/api/admin/bookings", params={"status": "confirmed"}).json()
+    client.post(f"/api/admin/cancel/{confirmed[-1]['id']}")
+    assert asyncio.run(worker.run_once()) == 1
+    with SessionLocal() as db:
+        archived = sorted(b.id for b in db.query(ArchivedBooking).all())
+        live = [b.id for b in db.query(Booking).all()]
+    assert len(set(archived)) == 2 and not set(archived) & set(live)
+
+
+def test_new_sqlite_database_uses_incremental_vacuum():
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2
+
+
+def test_pages_served_from_memory_with_etag_and_gzip():
+    response = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Autowasch-Buchung" in response.text
+    etag = response.headers["etag"]
+
+    response = client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    last_modified = client.get("/admin").headers["last-modified"]
+    response = client.get("/admin", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+
+def test_static_assets_have_hashed_immutable_urls():
+    html = client.get("/").text
+    url = re.search(r'src="(/static/booking\.[0-9a-f]{10}\.js)"', html).group(1)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert "immutable" in response.headers["cache-control"]
+    assert "loadBusySlots" in response.text
+
+    # старое имя без хэша работает, но без долгого кэша
+    response = client.get("/static/booking.js")
+    assert response.headers["cache-control"] == "no-cache"
+    assert client.get("/static/missing.js").status_code == 404
+
+
+# ------------------ бенчмарки ------------------
+def test_benchmark_gate_flags_regressions():
+    baseline = {"slots": {"p50_ms": 10.0, "p99_ms": 40.0, "errors": 0}}
+
+    assert compare({"slots": {"p50_ms": 11.0, "p99_ms": 45.0, "errors": 0}}, baseline, 0.25) == []
+    failures = compare({"slots": {"p50_ms": 13.0, "p99_ms": 45.0, "errors": 0}}, baseline, 0.25)
+    assert failures and failures[0].startswith("slots.p50_ms")
+    assert compare({"slots": {"p50_ms": 10.0, "p99_ms": 40.0, "errors": 2}}, baseline, 0.25)
+    assert percentile([5, 1, 3, 2, 4], 50) == 3
+
+
+def test_benchmark_counts_client_errors_as_failures():
+    # сценарий, который начал отвечать 400, быстрый, но сломан
+    import httpx
+
+    class Workload:
+        def request(self, scenario, i):
+            return "GET", f"/{i}", {}
+
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(400 if request.url.path == "/1" else 200))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as bench_client:
+            return await run_scenario(bench_client, Workload(), "slots", 4, 2)
+
+    assert asyncio.run(run())["errors"] == 1
+
+
+def test_benchmark_smoke(tmp_path):
+    out = tmp_path / "results.json"
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--bookings", "300", "--requests", "20",
+         "--concurrency", "4", "--warmup", "0", "--db", str(tmp_path / "bench.db"),
+         "--out", str(out), "--baseline", str(tmp_path / "baseline.json"), "--update-baseline", "--check"],
+        cwd=BASE_DIR, capture_output=True, text=True, timeout=120,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    results = json.loads(out.read_text())["inprocess-300-c4"]
+    assert set(results) == {"book", "slots", "busy_slots", "admin_bookings", "cancel", "cancel_legacy"}
+    assert all(r["errors"] == 0 and r["requests"] == 20 for r in results.values())
+    # абсолютные миллисекунды сравнимы только на той же машине
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    assert list(baseline) == [machine_key()] and list(baseline[machine_key()]) == ["inprocess-300-c4"]
+
+
+# ------------------ метрики ------------------
+def test_metrics_endpoint_reports_routes_and_queries():
+    client.get("/api/availability", params={"date": "2099-11-30", "service": "car_spa"})
+    _book("2099-11-30T10:00:00")
+
+    body = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/api/availability",status="200"}' in body
+    assert 'http_request_duration_seconds_count{method="POST",route="/api/book"}' in body
+    assert 'db_queries_per_request_count{route="/api/availability"}' in body
+    assert 'db_query_duration_seconds_count{operation="INSERT"}' in body
+    assert 'outbox_pending_messages{channel="email"} 1' in body
+    assert "http_requests_in_flight" in body
+
+
+def test_slow_request_log_names_sql(monkeypatch, caplog):
+    monkeypatch.setattr("backend.metrics.SLOW_REQUEST_MS", 0)
+    with caplog.at_level("WARNING", logger="carwash.slow"):
+        client.get("/api/busy-slots", params={"date": "2099-11-29"})
+    assert any("/api/busy-slots" in r.getMessage() and "FROM bookings" in r.getMessage()
+               for r in caplog.records)